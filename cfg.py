@@ -1,6 +1,7 @@
 import json
+from functools import lru_cache
 
-LANG_DICT = json.load(open("data/external/marc_lang_codes.json", "r"))
+LANG_DICT_PATH = "data/external/marc_lang_codes.json"
 P5_ROOT = (
     "G:/DigiSchol/Digital Research and Curator Team/Projects & Proposals/00_Current Projects"
     "/LibCrowds Convert-a-Card (Adi)/OCR/20230504 TKB Export P5 175 GT pp/1016992/P5_for_Transkribus"
@@ -9,3 +10,16 @@ P5_ROOT = (
 COL_ID = 2142572
 DOC_ID = 10223347
 PRINT_M1_ID = 39995
+
+
+@lru_cache(maxsize=None)
+def load_lang_dict():
+    with open(LANG_DICT_PATH, "r") as f:
+        return json.load(f)
+
+
+def __getattr__(name):
+    # LANG_DICT is only read the first time it's used rather than whenever cfg is imported
+    if name == "LANG_DICT":
+        return load_lang_dict()
+    raise AttributeError(f"module 'cfg' has no attribute '{name}'")
@@ -4,60 +4,119 @@ import glob
 import logging
 import pickle
 import os
-import re
+import threading
+import time
 import xml.etree.ElementTree as ET
 
 from dotenv import load_dotenv
+import pandas as pd
 import requests
 from tqdm import tqdm
 import bookops_worldcat as bw
-from TranskribusPyClient.src.TranskribusPyClient import client
 
-from src.data.oclc_api import process_queue, cac_search_kwargs
+from src.data.bib_extraction import extract_bib_table, cluster_cards
+from src.data.oclc_api import (
+    process_queue, batch_search_brief_bib_isbn, cac_search_kwargs, ISBN_BATCH_SIZE, RateBudget, BriefBibSearch,
+    MarcXmlParser, fetch_full_bibs, FULL_BIB_TOP_K
+)
 from cfg import COL_ID, DOC_ID, PRINT_M1_ID
 
 load_dotenv()
 
-def authorise():
-    auth_url = "https://account.readcoop.eu/auth/realms/readcoop/protocol/openid-connect/token"
-    data = {
-        "grant_type": "password",
-        "username": os.environ["TKB_USERNAME"],
-        "password": os.environ["TKB_PASSWORD"],
-        "client_id": "processing-api-client"
-    }
+AUTH_URL = "https://account.readcoop.eu/auth/realms/readcoop/protocol/openid-connect/token"
+TKB_BASE_URL = "https://transkribus.eu/TrpServer/rest"
+
+
+def authorise(refresh_token=None):
+    if refresh_token:
+        data = {"grant_type": "refresh_token", "refresh_token": refresh_token, "client_id": "processing-api-client"}
+    else:
+        data = {
+            "grant_type": "password",
+            "username": os.environ["TKB_USERNAME"],
+            "password": os.environ["TKB_PASSWORD"],
+            "client_id": "processing-api-client"
+        }
 
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
 
-    resp = requests.post(auth_url, data=data, headers=headers)
+    resp = requests.post(AUTH_URL, data=data, headers=headers)
     return resp
 
+
+class TranskribusSession(requests.Session):
+    """
+    Pooled keep-alive session for the Transkribus API shared by all the TKB functions
+    The bearer token is cached and refreshed shortly before it expires, and once more on a 401
+    Safe to share between the threads used by the async job orchestrator/pipeline
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=16, refresh_margin=60):
+        super().__init__()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.mount("https://", adapter)
+        self.refresh_margin = refresh_margin
+        self._access_token = None
+        self._expires_at = 0.0
+        self._refresh_token = None
+        self._refresh_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+    def refresh_access_token(self, force=False):
+        """
+        Fetch a new access token if the cached one is missing/close to expiry, or force
+        Uses the refresh token while it's valid, otherwise logs in again
+        """
+        with self._token_lock:
+            now = time.monotonic()
+            if not force and self._access_token and now < self._expires_at - self.refresh_margin:
+                return self._access_token
+
+            use_refresh = self._refresh_token and now < self._refresh_expires_at - self.refresh_margin
+            resp = authorise(refresh_token=self._refresh_token if use_refresh else None)
+            if use_refresh and resp.status_code in (400, 401):  # refresh token revoked
+                resp = authorise()
+            resp.raise_for_status()
+
+            token = resp.json()
+            self._access_token = token["access_token"]
+            self._expires_at = now + token.get("expires_in", 300)
+            self._refresh_token = token.get("refresh_token")
+            self._refresh_expires_at = now + token.get("refresh_expires_in", 0)
+            return self._access_token
+
+    def request(self, method, url, *args, **kwargs):
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["Authorization"] = f"Bearer {self.refresh_access_token()}"
+        resp = super().request(method, url, *args, headers=headers, **kwargs)
+
+        if resp.status_code == 401:
+            headers["Authorization"] = f"Bearer {self.refresh_access_token(force=True)}"
+            resp = super().request(method, url, *args, headers=headers, **kwargs)
+        return resp
+
+
 # Retrieve the ColID for DocScan - Uploads
-# collection_ids = requests.get("https://transkribus.eu/TrpServer/rest/collections", headers=headers)
+# collection_ids = TranskribusSession().get(f"{TKB_BASE_URL}/collections")
 # ColID is 2142572, stored in cfg.py
 
 
-def run_text_recognition(access_token, collection_id, doc_id, model_id, pages="all"):
+def run_text_recognition(session, collection_id, doc_id, model_id, pages="all"):
     """
     Run text recognition on a Transkribus collection
 
     Args:
-        access_token (str): Tkb access token
+        session (TranskribusSession): Authenticated Tkb session
         collection_id (int): ID of the collection to process
+        doc_id (int): ID of the document to process
         model_id (int): ID of the HTR model to use
         pages (str): Pages to process (default: "all")
 
     Returns:
         dict: API response containing job information
     """
-
-    # Base URL for Transkribus API
-    base_url = "https://transkribus.eu/TrpServer/rest"
-    session = requests.Session()
-
     try:
         # Step 2: Start text recognition job
-        recognition_url = f"{base_url}/recognition/htr"
+        recognition_url = f"{TKB_BASE_URL}/recognition/htr"
 
         # Parameters for the recognition job
         recognition_params = {
@@ -74,10 +133,7 @@ def run_text_recognition(access_token, collection_id, doc_id, model_id, pages="a
         recognition_response = session.post(
             recognition_url,
             params=recognition_params,
-            headers={
-                "Authorization": f"Bearer {access_token}",
-                "Content-Type": "application/x-www-form-urlencoded"
-            }
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
         )
         recognition_response.raise_for_status()
 
@@ -99,26 +155,22 @@ def run_text_recognition(access_token, collection_id, doc_id, model_id, pages="a
         return None
 
 
-def check_job_status(access_token, collection_id, job_id):
+def check_job_status(session, collection_id, job_id):
     """
     Check the status of a recognition job
 
     Args:
-        access_token (str): Tkb access token
+        session (TranskribusSession): Authenticated Tkb session
         collection_id (int): ID of the collection
         job_id (str): ID of the job to check
 
     Returns:
         dict: Job status information
     """
-    base_url = "https://transkribus.eu/TrpServer/rest"
-    session = requests.Session()
-
     try:
-        headers = {"Authorization": f"Bearer {access_token}"}
         # Check job status
-        status_url = f"{base_url}/jobs/{job_id}"
-        status_response = session.get(status_url, headers=headers)
+        status_url = f"{TKB_BASE_URL}/jobs/{job_id}"
+        status_response = session.get(status_url)
         status_response.raise_for_status()
 
         job_status = status_response.json()
@@ -133,222 +185,547 @@ def check_job_status(access_token, collection_id, job_id):
         return None
 
 
-def download_document(access_token, collection_id, doc_id):
+def parse_pages(pages="all"):
     """
-    Check the status of a recognition job
+    Convert a Transkribus pages string e.g. "1,2,5-7" to a set of page numbers
 
     Args:
-        access_token (str): Tkb access token
-        collection_id (int): ID of the collection
-        job_id (str): ID of the job to check
+        pages (str): Pages string, "all" returns None
 
     Returns:
-        dict: Job status information
+        set[int] | None: Page numbers
     """
-    base_url = "https://transkribus.eu/TrpServer/rest"
-    session = requests.Session()
+    if pages == "all":
+        return None
+    page_nrs = set()
+    for part in str(pages).split(","):
+        start, _, end = part.strip().partition("-")
+        page_nrs.update(range(int(start), int(end or start) + 1))
+    return page_nrs
 
-    try:
-        headers = {"Authorization": f"Bearer {access_token}"}
-        # Check job status
-        get_doc_url = f"{base_url}/collections/{collection_id}/{doc_id}/fulldoc"
-        doc_response = session.get(get_doc_url, headers=headers)
-        doc_contents = doc_response.json()
-        n = len(doc_contents["pageList"]["pages"])
 
-        # TODO link title and ISBN pages
-        print("Downloading images and xmls")
-        for i, page in tqdm(enumerate(doc_contents["pageList"]["pages"]), total=n):
-            if i / 2 == float(i // 2):
-                suffix = "title"
-            else:
-                suffix = "isbn"
+def download_document(session, collection_id, doc_id, pages="all"):
+    """
+    Download the page images and transcription xmls of a document
 
-            work = (int(page['pageNr']) - 1) // 2
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        collection_id (int): ID of the collection
+        doc_id (int): ID of the document to download
+        pages (str): Pages to download (default: "all")
 
-            img_resp = requests.get(page["url"])
-            xml_resp = requests.get(page['tsList']['transcripts'][0]['url'])
-            if not os.path.exists(f"data/raw/{doc_id}"):
-                os.mkdir(f"data/raw/{doc_id}")
-            with open(f"data/raw/{doc_id}/{work}_{suffix}.jpg", "wb") as f:
-                f.write(img_resp.content)
-            with open(f"data/raw/{doc_id}/{work}_{suffix}.xml", "wb") as f:
-                f.write(xml_resp.content)
+    Returns:
+        None
+    """
+    try:
+        doc_pages = get_document_pages(session, collection_id, doc_id, pages)
+        n = len(doc_pages)
 
-        print(f"Images and xml downloaded for {len(doc_contents['pageList']['pages']) // 2} works")
+        print("Downloading images and xmls")
+        for i, page in tqdm(doc_pages, total=n):
+            download_page(session, page, i, doc_id)
 
-        return doc_response.raise_for_status()
+        print(f"Images and xml downloaded for {n // 2} works")
 
     except requests.exceptions.RequestException as e:
         print(f"Error downloading doc: {e}")
         return None
 
 
+def get_collection_documents(session, collection_id):
+    """
+    List the IDs of the documents in a collection
+
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        collection_id (int): ID of the collection
+
+    Returns:
+        list[int]: document IDs
+    """
+    list_url = f"{TKB_BASE_URL}/collections/{collection_id}/list"
+    list_response = session.get(list_url)
+    list_response.raise_for_status()
+    return [doc["docId"] for doc in list_response.json()]
+
+
+def get_document_pages(session, collection_id, doc_id, pages="all"):
+    """
+    List the pages of a document
+
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        collection_id (int): ID of the collection
+        doc_id (int): ID of the document
+        pages (str): Pages to include (default: "all")
+
+    Returns:
+        list[tuple[int, dict]]: (index in document, page info) for each page
+    """
+    get_doc_url = f"{TKB_BASE_URL}/collections/{collection_id}/{doc_id}/fulldoc"
+    doc_response = session.get(get_doc_url)
+    doc_response.raise_for_status()
+    doc_contents = doc_response.json()
+
+    page_nrs = parse_pages(pages)
+    return [(i, p) for i, p in enumerate(doc_contents["pageList"]["pages"]) if not page_nrs or int(p["pageNr"]) in page_nrs]
+
+
+def download_page(session, page, i, doc_id, overwrite=True):
+    """
+    Download the image and latest transcription xml of a page
+    Pages alternate title/ISBN so page i is saved as data/raw/{doc_id}/{work}_{title|isbn}
+
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        page (dict): Page info from get_document_pages
+        i (int): Index of the page in the document
+        doc_id (int): ID of the document
+        overwrite (bool): Download again if the xml already exists
+
+    Returns:
+        str: Path to the downloaded xml
+    """
+    # TODO link title and ISBN pages
+    if i / 2 == float(i // 2):
+        suffix = "title"
+    else:
+        suffix = "isbn"
+
+    work = (int(page['pageNr']) - 1) // 2
+    xml_path = f"data/raw/{doc_id}/{work}_{suffix}.xml"
+    if not overwrite and os.path.exists(xml_path):
+        return xml_path
+
+    img_resp = session.get(page["url"])
+    xml_resp = session.get(page['tsList']['transcripts'][0]['url'])
+    if not os.path.exists(f"data/raw/{doc_id}"):
+        os.makedirs(f"data/raw/{doc_id}", exist_ok=True)
+    with open(f"data/raw/{doc_id}/{work}_{suffix}.jpg", "wb") as f:
+        f.write(img_resp.content)
+    with open(xml_path, "wb") as f:
+        f.write(xml_resp.content)
+
+    return xml_path
+
+
+JOB_FINAL_STATES = {"FINISHED", "FAILED", "CANCELED"}
+JOB_TIMEOUT = 6 * 60 * 60  # seconds
+JOB_MAX_ERRORS = 10  # consecutive failed status checks
+
+
+async def poll_job(
+    session, collection_id, job_id, min_interval=2.0, max_interval=60.0, backoff=1.5, timeout=JOB_TIMEOUT,
+    max_errors=JOB_MAX_ERRORS
+):
+    """
+    Poll a recognition job until it reaches a final state
+    The interval grows by backoff while progress is unchanged and resets to min_interval when it moves,
+    so short jobs are picked up quickly and long ones aren't polled needlessly
+
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        collection_id (int): ID of the collection
+        job_id (str): ID of the job to poll
+        min_interval (float): Shortest wait between polls in seconds
+        max_interval (float): Longest wait between polls in seconds
+        backoff (float): Interval multiplier when progress hasn't changed
+        timeout (float): Seconds to wait for the job to finish
+        max_errors (int): Status checks in a row that can fail before giving up
+
+    Returns:
+        dict: Final job status information
+
+    Raises:
+        TimeoutError: If the job hasn't finished within timeout
+        RuntimeError: If max_errors status checks in a row failed
+    """
+    deadline = time.monotonic() + timeout
+    interval, last_progress, errors = min_interval, None, 0
+    while True:
+        status = await asyncio.to_thread(check_job_status, session, collection_id, job_id)
+        if status is None:  # request errors are retried on the next poll
+            errors += 1
+            if errors >= max_errors:
+                raise RuntimeError(f"Job {job_id} status couldn't be checked {errors} times in a row")
+        else:
+            errors = 0
+        status = status or {}
+        if status.get("state") in JOB_FINAL_STATES:
+            return status
+
+        progress = status.get("progress")
+        interval = min_interval if progress != last_progress else min(interval * backoff, max_interval)
+        last_progress = progress
+        if time.monotonic() + interval > deadline:
+            raise TimeoutError(f"Job {job_id} not finished after {timeout}s, last state {status.get('state')}")
+        await asyncio.sleep(interval)
+
+
+async def run_recognition_job(session, collection_id, doc_id, model_id, pages="all", download=True, **poll_kwargs):
+    """
+    Start a recognition job, wait for it to finish and download its pages
+
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        collection_id (int): ID of the collection
+        doc_id (int): ID of the document to process
+        model_id (int): ID of the HTR model to use
+        pages (str): Pages to process (default: "all")
+        download (bool): Download the pages once the job has finished
+        **poll_kwargs: Passed to poll_job
+
+    Returns:
+        dict: doc_id, pages, job_id and final state of the job
+    """
+    result = {"doc_id": doc_id, "pages": pages, "job_id": None, "state": "NOT_STARTED"}
+    job_info = await asyncio.to_thread(run_text_recognition, session, collection_id, doc_id, model_id, pages)
+    if not job_info or "jobId" not in job_info:
+        return result
+
+    result["job_id"] = job_info["jobId"]
+    status = await poll_job(session, collection_id, result["job_id"], **poll_kwargs)
+    result["state"] = status.get("state")
+
+    if download and result["state"] == "FINISHED":
+        await asyncio.to_thread(download_document, session, collection_id, doc_id, pages)
+
+    return result
+
+
+async def run_recognition_jobs(session, collection_id, jobs, model_id, max_concurrent=4, **job_kwargs):
+    """
+    Run recognition jobs for many documents/page ranges concurrently
+    Each job downloads as soon as it finishes, so a batch is never blocked on its slowest job
+
+    Args:
+        session (TranskribusSession): Authenticated Tkb session
+        collection_id (int): ID of the collection
+        jobs (list[int | tuple[int, str]]): Document IDs, or (document ID, pages) pairs
+        model_id (int): ID of the HTR model to use
+        max_concurrent (int): Most jobs submitted to Transkribus at once
+        **job_kwargs: Passed to run_recognition_job
+
+    Returns:
+        list[dict]: Result of each job, see run_recognition_job
+    """
+    semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def run_job(job):
+        doc_id, pages = job if isinstance(job, tuple) else (job, "all")
+        async with semaphore:
+            return await run_recognition_job(session, collection_id, doc_id, model_id, pages=pages, **job_kwargs)
+
+    return await asyncio.gather(*[run_job(job) for job in jobs])
+
+
+def load_xml(file: str) -> ET:
+    file = os.fsdecode(file)
+    attempts = 0
+    while attempts < 3:
+        try:
+            tree = ET.parse(file)
+            break
+        except FileNotFoundError:
+            attempts += 1
+            continue
+    else:
+        raise FileNotFoundError(f"Failed to connect to: {file}")
+    return tree.getroot()
+
+
 def load_xmls(xml_path: str) -> dict[str: ET]:
     xmls = glob.glob(xml_path)
     xml_roots = {}
     for file in xmls:
         page_id = os.path.basename(file)
-        file = os.fsdecode(file)
-        attempts = 0
-        while attempts < 3:
-            try:
-                tree = ET.parse(file)
-                break
-            except FileNotFoundError:
-                attempts += 1
-                continue
-        else:
-            raise FileNotFoundError(f"Failed to connect to: {file}")
-        root = tree.getroot()
-        xml_roots[page_id] = root
+        xml_roots[page_id] = load_xml(file)
 
     return xml_roots
 
 
-def extract_lines(xml_roots: dict[str: ET]) -> dict[str: list[str]]:
-    page_lines = {}
-    for id, root in xml_roots.items():
-        lines = []
-        text_regions = [x for x in root[1] if len(x) > 2]  # Empty Text Regions Removed
+def extract_root_lines(root: ET) -> list[str]:
+    lines = []
+    text_regions = [x for x in root[1] if len(x) > 2]  # Empty Text Regions Removed
 
-        for text_region in text_regions:
-            text_lines = text_region[1:-1]  # Skip coordinate data in first child
-            for text_line in text_lines:
-                lines.append(text_line[-1][0].text)  # Text equivalent for line
-        page_lines[id] = [l for l in lines if l]
+    for text_region in text_regions:
+        text_lines = text_region[1:-1]  # Skip coordinate data in first child
+        for text_line in text_lines:
+            lines.append(text_line[-1][0].text)  # Text equivalent for line
+    return [l for l in lines if l]
 
-    return page_lines
+
+def extract_lines(xml_roots: dict[str: ET]) -> dict[str: list[str]]:
+    return {id: extract_root_lines(root) for id, root in xml_roots.items()}
 
 
 def extract_bib_info(page_lines: dict[str: list[str]]):
     """
     Extract bibliographic info from transcribed book pages
-    @param page_lines:
-    @return:
+    Wraps extract_bib_table, only checksum valid ISBNs (as ISBN-13) are kept
+    so cards with OCR'd ISBN errors go straight to a title/author search
+    @param page_lines: dict[str: list[str]]
+    @return: dict[str: dict[str: str]]
     """
-    isbn_regex = re.compile("ISBN\s(?P<ISBN>[0-9\-\s]+)")
-    work_bib_info = {page_nr.split("_")[0]: {} for page_nr, _ in page_lines.items()}
     # TODO at the moment the title page transcription is bad due to the large font sizes
-    # Just use ISBN for now
-
-    for page_nr, lines in page_lines.items():
-        if "isbn" in page_nr:
-            page_nr = page_nr.split("_")[0]
-            ISBN = None
-            for line in lines:
-                match = isbn_regex.search(line)
-                if match:
-                    ISBN = match.group("ISBN")
-                    clean_isbn = ISBN.replace("-", "").replace(" ", "")
-                    work_bib_info[page_nr]["ISBN"] = clean_isbn
-
-        elif "title" in page_nr:
-            page_nr = page_nr.split("_")[0]
-            if len(lines) == 2:
-                title, author = lines
-                work_bib_info[page_nr]["title"] = title
-                work_bib_info[page_nr]["author"] = author
-            elif len(lines) > 2:
-                title = " ".join(lines[:-1])
-                author = lines[-1]
-                work_bib_info[page_nr]["title"] = title
-                work_bib_info[page_nr]["author"] = author
-
-    return work_bib_info
-
-
-async def oclc_record_fetch(work_bib_info, out_path):
+    bib_table = extract_bib_table(page_lines).set_index("work")
+    bib_table = bib_table.rename(columns={"isbn": "ISBN"})[["title", "author", "ISBN"]]
+
+    return {work: row.dropna().to_dict() for work, row in bib_table.astype(object).iterrows()}
 
-    brief_bibs = {}
-    full_bibs = {}
-    full_bibs = {k: [] for k in full_bibs}
 
-    async with bw.AsyncMetadataSession(authorization=token, headers={"User-Agent": "Convert-a-Card/1.0"}) as session:
+def cluster_bib_info(work_bib_info):
+    """
+    Group works that are copies/volumes of the same thing, see cluster_cards
+    @param work_bib_info: dict[str: dict[str: str]], output of extract_bib_info
+    @return: dict[str: list[str]], {representative work: [every work in its cluster]}
+    """
+    if not work_bib_info:
+        return {}
+    bib_df = pd.DataFrame.from_dict(work_bib_info, orient="index").reindex(columns=["title", "author", "ISBN"])
+    clusters = cluster_cards(bib_df, isbn="ISBN")
+    return {rep: members.tolist() for rep, members in clusters.index.to_series().groupby(clusters.to_numpy(), sort=False)}
 
-        queue = asyncio.Queue()
-        for work, bib_info in work_bib_info.items():
 
-            title, author, isbn = bib_info["title"], bib_info["author"], bib_info["ISBN"]
-            await queue.put((work, title, author, isbn))
+def get_worldcat_token():
+    return bw.WorldcatAccessToken(
+        key=os.environ["CLIENT_ID"],
+        secret=os.environ["CLIENT_SECRET"],
+        scopes="WorldCatMetadataAPI",
+        agent="ConvertACard/1.0"
+    )
 
-        print("Creating workers")
-        print("brief bib search API call progress:")
-        tracker = tqdm(total=queue.qsize())
 
-        tasks = []
-        n_workers = 50  # 25 gave no errors for 5000 records
+NO_SEARCH_FIELDS = "No title or ISBN to search"  # brief bibs of a card with neither
 
-        for i in range(n_workers):  # create workers
-            task = asyncio.create_task(
-                process_queue(
-                    queue=queue,
-                    name=f'worker-{i}',
-                    session=session,
-                    search_kwargs=cac_search_kwargs,
-                    brief_bibs_out=brief_bibs,
-                    full_bibs_out=full_bibs,
-                    tracker=tracker
-                )
-            )
 
-            tasks.append(task)
+async def queue_oclc_searches(
+    work_bib_info, queue, session, brief_bibs_out, batch_isbns=True, isbn_batch_size=ISBN_BATCH_SIZE, budget=None,
+    on_result=None
+):
+    """
+    Put the brief bib searches for a set of works on the worker queue
+    With batch_isbns the ISBNs are first searched in OR'd batches, works resolved by a batch
+    go straight to brief_bibs_out (and on_result) and only the rest are queued
+    Works with neither a title nor an ISBN left to search aren't queued, their brief bibs are NO_SEARCH_FIELDS
+    or the batch's empty result
+    @param work_bib_info: Dict[str, Dict[str, str]], output of extract_bib_info
+    @param queue: asyncio.PriorityQueue, consumed by process_queue workers
+    @param session: AsyncMetadataSession
+    @param brief_bibs_out: Dict
+    @param batch_isbns: bool
+    @param isbn_batch_size: int
+    @param budget: RateBudget
+    @param on_result: Callable[[str, Dict], None]
+    @return: int, number of works queued
+    """
+    ambiguous, resolved, no_hits = list(work_bib_info), {}, {}
+    if batch_isbns:
+        isbns = {work: bib_info["ISBN"] for work, bib_info in work_bib_info.items() if bib_info.get("ISBN")}
+        resolved, ambiguous = await batch_search_brief_bib_isbn(
+            isbns, session=session, search_kwargs=cac_search_kwargs, batch_size=isbn_batch_size, budget=budget
+        )
+        no_hits = {work: res for work, res in resolved.items() if res["numberOfRecords"] == 0}
+        resolved = {work: res for work, res in resolved.items() if res["numberOfRecords"] > 0}
+        ambiguous += [work for work in work_bib_info if work not in isbns]
+
+    for work, res in resolved.items():
+        brief_bibs_out[work] = res
+        if on_result:
+            on_result(work, res)
+
+    n_queued = 0
+    for work, bib_info in work_bib_info.items():
+        if work in resolved:
+            continue
+
+        title, author = bib_info.get("title"), bib_info.get("author")
+        isbn = bib_info.get("ISBN") if work in ambiguous else None  # ISBN already searched in a batch
+        if not title and not isbn:
+            if work in no_hits:
+                brief_bibs_out[work] = no_hits[work]
+                if on_result:
+                    on_result(work, no_hits[work])
+            else:
+                brief_bibs_out[work] = NO_SEARCH_FIELDS
+            continue
+        await queue.put(BriefBibSearch.for_card(work, title, author, isbn))
+        n_queued += 1
 
-        global run_id
-        t0 = time.perf_counter()
-        logging.info(f"{run_id} OCLC query queue joined")
+    return n_queued
 
-        await queue.join()
 
-        t1 = time.perf_counter()
-        logging.info(f"{run_id} OCLC query queue complete - elapsed: {t1 - t0}")
+def card_row(work, bib_info, brief_bibs, records):
+    """
+    A card as the review app shows it, for a ResultSink
+    @param work: str
+    @param bib_info: dict[str: str], the work's output of extract_bib_info
+    @param brief_bibs: dict, the work's brief bibs
+    @param records: list[pymarc.Record], the work's full records, best ranked first, None if the search found nothing
+    @return: dict
+    """
+    return {
+        "work": work, "xml": None, "lines": [bib_info[x] for x in ["title", "author", "ISBN"] if bib_info.get(x)],
+        "shelfmark": None, "title": bib_info.get("title", ""), "author": bib_info.get("author", ""),
+        "isbn": bib_info.get("ISBN"), "brief_bibs": brief_bibs, "num_records": brief_bibs["numberOfRecords"],
+        "worldcat_matches": records, "selected_match_ocn": None, "selected_match": None, "derivation_complete": None
+    }
 
-        for task in tasks:
-            task.cancel()
 
-        # await asyncio.gather(*tasks, return_exceptions=True)
+async def oclc_record_fetch(
+    work_bib_info, out_path, batch_isbns=True, isbn_batch_size=ISBN_BATCH_SIZE, speculative=False, token=None,
+    cluster=True, full_bibs_path=None, top_k=FULL_BIB_TOP_K, sink=None
+):
+    """
+    Query Worldcat for every work and pickle the brief bibs
+    With batch_isbns the ISBNs are first searched in OR'd batches, only cards that can't be
+    resolved from a batch are sent through the per card queue
+    With speculative the per card queue runs title/author searches alongside ISBN searches
+    while the shared RateBudget has headroom
+    With cluster copies/volumes of the same work are only searched once, see cluster_bib_info
+    With full_bibs_path the full records of each work's top_k ranked brief records are fetched
+    and pickled there, see fetch_full_bibs
+    With a sink each work's full records are fetched as soon as its search completes and the work is added
+    to the sink as a card the review app can show, so review can start while the rest are still being fetched.
+    Works already in the sink, from a fetch that crashed, aren't searched again, their brief bibs are read back from it.
+    @param work_bib_info: Dict[str, Dict[str, str]], output of extract_bib_info
+    @param out_path: str
+    @param batch_isbns: bool
+    @param isbn_batch_size: int
+    @param speculative: bool
+    @param token: WorldcatAccessToken, created from CLIENT_ID/CLIENT_SECRET if not given
+    @param cluster: bool
+    @param full_bibs_path: str
+    @param top_k: int
+    @param sink: ResultSink, closed once every work has been added
+    @return: None
+    """
+    stored_brief_bibs = {}
+    if sink is not None:  # resuming, works already in the sink aren't searched again
+        stored = sink.stored()
+        if len(stored):
+            stored_brief_bibs = dict(zip(stored["work"], stored["brief_bibs"]))
+        work_bib_info = {work: info for work, info in work_bib_info.items() if work not in stored_brief_bibs}
 
-        # records_df["brief_bibs"] = brief_bibs
-        # records_df["worldcat_matches"] = full_bibs
-        pickle.dump(brief_bibs, open(out_path, "wb"))
+    clusters = cluster_bib_info(work_bib_info) if cluster else {work: [work] for work in work_bib_info}
+    all_bib_info, work_bib_info = work_bib_info, {rep: work_bib_info[rep] for rep in clusters}
 
+    brief_bibs = {}
+    budget = RateBudget()
+    full_bibs = {}
+    parser = MarcXmlParser()  # full records are parsed in a process pool, not on the event loop
+    token = token or get_worldcat_token()
+    tasks, streams = [], []
+    try:
+        async with bw.AsyncMetadataSession(authorization=token, headers={"User-Agent": "Convert-a-Card/1.0"}) as session:
+
+            async def stream_result(rep, res):
+                full_bibs.update(await fetch_full_bibs(
+                    {rep: res}, work_bib_info, session, top_k=top_k, n_workers=top_k, budget=budget, parser=parser
+                ))
+                records = full_bibs[rep]["records"]
+                # cards the search found nothing for are stored too so a resumed fetch doesn't search them again,
+                # the app only shows cards with Worldcat results. Records that failed to fetch are tried on a resume
+                if records or res["numberOfRecords"] == 0:
+                    for work in clusters[rep]:
+                        await asyncio.to_thread(sink.add, card_row(work, all_bib_info[work], res, records or None))
+
+            def on_result(rep, res):
+                streams.append(asyncio.create_task(stream_result(rep, res)))
+
+            on_result = on_result if sink is not None else None
+            queue = asyncio.PriorityQueue()
+            await queue_oclc_searches(
+                work_bib_info, queue, session, brief_bibs, batch_isbns=batch_isbns, isbn_batch_size=isbn_batch_size,
+                budget=budget, on_result=on_result
+            )
 
-if __name__ == "__main__":
-    login_response = authorise()
-    login_response.raise_for_status()
+            print("Creating workers")
+            print("brief bib search API call progress:")
+            tracker = tqdm(total=queue.qsize())
+
+            n_workers = 50  # 25 gave no errors for 5000 records
+
+            for i in range(n_workers):  # create workers
+                task = asyncio.create_task(
+                    process_queue(
+                        queue=queue,
+                        name=f'worker-{i}',
+                        session=session,
+                        search_kwargs=cac_search_kwargs,
+                        brief_bibs_out=brief_bibs,
+                        tracker=tracker,
+                        speculative=speculative,
+                        budget=budget,
+                        on_result=on_result,
+                        parser=parser
+                    )
+                )
 
-    print(f"Login successful. Status code: {login_response.status_code}")
-    access_token = login_response.json()["access_token"]
+                tasks.append(task)
 
-    ## Running the transcription
-    ATR = False
-    if ATR:
-        # Start text recognition
-        job_info = run_text_recognition(
-            access_token=access_token,
-            collection_id=DOC_ID,
-            model_id=PRINT_M1_ID,
-            pages="all"  # or specific pages like "1,2,3"
-        )
+            t0 = time.perf_counter()
+            logging.info(f"{out_path} OCLC query queue joined")
 
-        if job_info and 'jobId' in job_info:
-            job_id = job_info['jobId']
+            await queue.join()
 
-            # Check job status
-            import time
+            t1 = time.perf_counter()
+            logging.info(f"{out_path} OCLC query queue complete - elapsed: {t1 - t0}")
 
-            time.sleep(5)  # Wait a bit before checking status
+            for task in tasks:
+                task.cancel()
+
+            if sink is not None:
+                for res in await asyncio.gather(*streams, return_exceptions=True):
+                    if isinstance(res, Exception):
+                        logging.error(f"{out_path} result not added to the sink: {res!r}")
+                await asyncio.to_thread(sink.close)
+            elif full_bibs_path:
+                full_bibs = await fetch_full_bibs(
+                    brief_bibs, work_bib_info, session, top_k=top_k, n_workers=n_workers, budget=budget, parser=parser
+                )
+
+            # await asyncio.gather(*tasks, return_exceptions=True)
+
+            # records_df["brief_bibs"] = brief_bibs
+            # records_df["worldcat_matches"] = full_bibs
+            brief_bibs = {
+                work: brief_bibs[rep] for rep, works in clusters.items() if rep in brief_bibs for work in works
+            }
+            brief_bibs.update(stored_brief_bibs)
+            pickle.dump(brief_bibs, open(out_path, "wb"))
+            if full_bibs_path:
+                full_bibs = {
+                    work: full_bibs[rep] for rep, works in clusters.items() if rep in full_bibs for work in works
+                }
+                pickle.dump(full_bibs, open(full_bibs_path, "wb"))
+    finally:  # the workers and the parser's process pool don't outlive a failed fetch
+        for task in tasks + streams:
+            task.cancel()
+        parser.close()
 
-            status = check_job_status(
-                access_token=access_token,
-                collection_id=DOC_ID,
-                job_id=job_id
-            )
+
+if __name__ == "__main__":
+    session = TranskribusSession()
+    session.refresh_access_token()
+    print("Login successful")
+
+    ## Running the transcription
+    ATR = False
+    if ATR:
+        # Start text recognition, each document downloads as soon as its job finishes
+        results = asyncio.run(run_recognition_jobs(
+            session=session,
+            collection_id=COL_ID,
+            jobs=[DOC_ID],  # or (doc_id, pages) pairs like (DOC_ID, "1-50")
+            model_id=PRINT_M1_ID
+        ))
+        print(results)
 
     ## DL outputs
     DL = False
     if DL:
-        download_document(access_token=access_token, collection_id=COL_ID, doc_id=DOC_ID)
+        download_document(session=session, collection_id=COL_ID, doc_id=DOC_ID)
 
     # Extract titles/ISBNs
     xml_roots = load_xmls(f"data/raw/{DOC_ID}/*.xml")
@@ -357,17 +734,9 @@ if __name__ == "__main__":
     print(bib_info)
 
     # Query OCLC
-    client_id = os.environ["CLIENT_ID"]
-    client_secret = os.environ["CLIENT_SECRET"]
-
-    # token = bw.WorldcatAccessToken(
-    #     key=client_id,
-    #     secret=client_secret,
-    #     scopes="WorldCatMetadataAPI",
-    #     agent="ConvertACard/1.0"
-    # )
-
     # asyncio.run(oclc_record_fetch(bib_info, "data/processed/accession_test_brief_bibs.p"))
+    # add sink=ResultSink(fsspec.filesystem("file"), sink_root(save_file)) to review cards as they're fetched
+    # or run every stage with bounded queues between them: python -m src.data.pipeline --help
 
     # Make results available for ST app
     # St app should be used side by side with Record Manager, so this automated part ends there
\ No newline at end of file
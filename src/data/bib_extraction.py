@@ -0,0 +1,186 @@
+import re
+import unicodedata
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+# Characters the HTR model commonly confuses with digits
+OCR_DIGIT_FIXES = str.maketrans({"O": "0", "o": "0", "Q": "0", "D": "0", "l": "1", "I": "1", "|": "1", "S": "5", "B": "8"})
+ISBN_REGEX = re.compile(r"ISBN[\s:.]*(?P<ISBN>[0-9OoQDlI|SB][0-9OoQDlI|SBXx\-\s]{8,20})")
+
+ISBN13_WEIGHTS = np.array([1, 3] * 6 + [1])
+ISBN10_WEIGHTS = np.arange(10, 0, -1)
+
+BIB_TABLE_DTYPES = {
+    "work": "string", "title": "string", "author": "string",
+    "isbn_raw": "string", "isbn": "string", "isbn_valid": "boolean"
+}
+
+
+def clean_isbns(raw: pd.Series) -> pd.Series:
+    """
+    Fix OCR digit confusions and strip separators from raw ISBN strings
+    @param raw: pd.Series
+    @return: pd.Series
+    """
+    return raw.str.translate(OCR_DIGIT_FIXES).str.upper().str.replace(r"[^0-9X]", "", regex=True)
+
+
+def digit_matrix(isbns: pd.Series, width: int) -> np.ndarray:
+    """
+    Convert the first width chars of each string to a row of ints, X -> 10, anything missing -> -1
+    @param isbns: pd.Series
+    @param width: int
+    @return: np.ndarray, shape (len(isbns), width)
+    """
+    padded = isbns.fillna("").str.slice(0, width).str.pad(width, side="right", fillchar="#")
+    chars = np.array(padded.tolist(), dtype=f"S{width}").view(np.uint8).reshape(-1, width).astype(np.int64)
+    digits = chars - ord("0")
+    digits[chars == ord("X")] = 10
+    digits[(chars < ord("0")) | ((chars > ord("9")) & (chars != ord("X")))] = -1
+    return digits
+
+
+def valid_isbn13(digits: np.ndarray) -> np.ndarray:
+    in_range = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    return in_range & ((digits @ ISBN13_WEIGHTS) % 10 == 0)
+
+
+def valid_isbn10(digits: np.ndarray) -> np.ndarray:
+    in_range = ((digits[:, :9] >= 0) & (digits[:, :9] <= 9)).all(axis=1) & (digits[:, 9] >= 0)
+    return in_range & ((digits @ ISBN10_WEIGHTS) % 11 == 0)
+
+
+def isbn13_check_digits(digits: np.ndarray) -> np.ndarray:
+    """
+    Check digits for rows of the first 12 digits of ISBN-13s
+    @param digits: np.ndarray, shape (n, 12)
+    @return: np.ndarray
+    """
+    return (10 - (digits @ ISBN13_WEIGHTS[:12]) % 10) % 10
+
+
+def validate_isbns(raw: pd.Series) -> pd.DataFrame:
+    """
+    Checksum validate raw ISBN strings
+    Anything 13 chars or longer once cleaned must start with a valid ISBN-13, shorter strings a valid ISBN-10
+    Valid ISBN-10s are converted to ISBN-13
+    @param raw: pd.Series
+    @return: pd.DataFrame, cols isbn (ISBN-13 or NA) and isbn_valid, same index as raw
+    """
+    cleaned = clean_isbns(raw.fillna(""))
+    long = (cleaned.str.len() >= 13).to_numpy()
+    d13, d10 = digit_matrix(cleaned, 13), digit_matrix(cleaned, 10)
+    is13, is10 = long & valid_isbn13(d13), ~long & valid_isbn10(d10)
+
+    prefixed = np.hstack([np.tile([9, 7, 8], (len(d10), 1)), d10[:, :9]])
+    converted = np.hstack([prefixed, isbn13_check_digits(prefixed)[:, None]])
+    isbn_digits = np.where(is13[:, None], d13, converted)
+
+    isbn = pd.Series(["".join(map(str, row)) for row in isbn_digits.clip(0)], index=raw.index, dtype="string")
+    valid = pd.Series(is13 | is10, index=raw.index, dtype="boolean")
+    return pd.DataFrame({"isbn": isbn.where(valid), "isbn_valid": valid})
+
+
+def isbn10_to_isbn13(isbn: str) -> str:
+    """
+    Convert a single ISBN-10 to ISBN-13, see validate_isbns for the vectorised version
+    @param isbn: str
+    @return: str
+    """
+    prefixed = digit_matrix(pd.Series(["978" + isbn[:9]]), 12)
+    return "978" + isbn[:9] + str(isbn13_check_digits(prefixed)[0])
+
+
+def page_lines_to_df(page_lines: Dict[str, List[str]]) -> pd.DataFrame:
+    """
+    Flatten {page_id: lines} to one row per line, page ids are of the form {work}_{title|isbn}.xml
+    @param page_lines: Dict[str, List[str]]
+    @return: pd.DataFrame
+    """
+    lines_df = pd.Series(page_lines, dtype=object).explode().dropna().rename("line").rename_axis("page").reset_index()
+    page_parts = lines_df["page"].astype("string").str.extract(r"^(?P<work>[^_]+)_(?P<page_type>title|isbn)")
+    return pd.concat([page_parts, lines_df["line"].astype("string")], axis=1)
+
+
+def extract_bib_table(page_lines: Dict[str, List[str]]) -> pd.DataFrame:
+    """
+    Extract title/author/ISBN for every work from all transcribed pages at once
+    Title pages: the last line is the author, the rest the title
+    ISBN pages: the last "ISBN ..." match is checksum validated and converted to ISBN-13
+    Invalid ISBNs have isbn_valid False and no isbn so go straight to a title/author search
+    @param page_lines: Dict[str, List[str]]
+    @return: pd.DataFrame, one row per work with dtypes BIB_TABLE_DTYPES
+    """
+    works = pd.Index(sorted({page.split("_")[0] for page in page_lines}), name="work")
+    lines_df = page_lines_to_df(page_lines)
+
+    title_lines = lines_df.query("page_type == 'title'").groupby("work")["line"]
+    n_lines = title_lines.size()
+    titles = pd.DataFrame({
+        "title": title_lines.agg(lambda x: " ".join(x.iloc[:-1])),
+        "author": title_lines.last()
+    })[n_lines >= 2]
+
+    isbn_lines = lines_df.query("page_type == 'isbn'")
+    raw = isbn_lines["line"].str.extract(ISBN_REGEX)["ISBN"].str.strip()
+    isbns = raw.groupby(isbn_lines["work"]).last().rename("isbn_raw").to_frame()
+    isbns = isbns.join(validate_isbns(isbns["isbn_raw"]))
+
+    bib_table = titles.join(isbns, how="outer").reindex(works).reset_index()
+    bib_table["isbn_valid"] = bib_table["isbn_valid"].fillna(False)
+    return bib_table.astype(BIB_TABLE_DTYPES)[list(BIB_TABLE_DTYPES)]
+
+
+def strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def normalise_text(text: pd.Series) -> pd.Series:
+    """
+    Lowercase, strip accents and punctuation, collapse whitespace, for matching titles/authors between cards
+    @param text: pd.Series
+    @return: pd.Series
+    """
+    text = text.astype("string").map(strip_accents, na_action="ignore").astype("string").str.lower()
+    text = text.str.replace(r"[^\w\s]", " ", regex=True).str.split().str.join(" ")
+    return text.mask(text == "")
+
+
+def cluster_keys(df: pd.DataFrame, title: str = "title", author: str = "author", isbn: str = "isbn") -> pd.DataFrame:
+    """
+    Keys identifying cards for the same work, a checksum valid ISBN-13 and normalised title/author
+    @param df: pd.DataFrame, one row per card
+    @param title: str, col name
+    @param author: str, col name
+    @param isbn: str, col name, raw or validated ISBNs
+    @return: pd.DataFrame, cols isbn_key and ti_au_key, NA where a card doesn't have one
+    """
+    isbn_key = validate_isbns(df[isbn].astype("string")) if isbn in df else pd.DataFrame({"isbn": pd.NA}, index=df.index)
+    ti = normalise_text(df[title])
+    au = normalise_text(df[author]).fillna("") if author in df else ""
+    return pd.DataFrame({"isbn_key": isbn_key["isbn"].astype("string"), "ti_au_key": (ti + "|" + au).astype("string")})
+
+
+def cluster_cards(df: pd.DataFrame, title: str = "title", author: str = "author", isbn: str = "isbn") -> pd.Series:
+    """
+    Group cards for the same work (copies, volumes) so they're queried and reviewed once
+    Cards are grouped on ISBN, cards without one are grouped on title/author. A card without an ISBN joins
+    an ISBN group with the same title/author if there's only one, cards with different ISBNs are never grouped.
+    @param df: pd.DataFrame, one row per card
+    @param title: str, col name
+    @param author: str, col name
+    @param isbn: str, col name
+    @return: pd.Series, the index label of the first card in each card's cluster, which stands for the cluster
+    """
+    keys = cluster_keys(df, title, author, isbn)
+    has_isbn = keys["isbn_key"].notna()
+
+    isbns_per_ti_au = keys[has_isbn].groupby("ti_au_key")["isbn_key"].agg(["nunique", "first"])
+    unique_isbn = isbns_per_ti_au.query("nunique == 1")["first"]
+    joined_isbn = keys["ti_au_key"].map(unique_isbn).astype("string")
+
+    key = ("isbn:" + keys["isbn_key"]).fillna("isbn:" + joined_isbn).fillna("ti_au:" + keys["ti_au_key"])
+    labels = pd.Series(df.index, index=df.index)
+    return labels.groupby(key.to_numpy(), dropna=True, sort=False).transform("first").reindex(df.index).fillna(labels)
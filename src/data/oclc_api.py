@@ -1,14 +1,24 @@
+import asyncio
 from asyncio import Queue
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+import difflib
 import io
+import itertools
 import logging
+import re
+import threading
 import time
-from typing import Dict, List, Optional, Union
+from typing import Callable, Dict, Hashable, List, Optional, Tuple, Union
 
 from bookops_worldcat import MetadataSession, AsyncMetadataSession
 from bookops_worldcat.errors import WorldcatRequestError
 from pymarc import marcxml, Record
 from tqdm import tqdm
 
+from src.data.bib_extraction import isbn10_to_isbn13, strip_accents
+
 cac_search_kwargs = {
     "inCatalogLanguage": None,
     "limit": 50,
@@ -23,37 +33,261 @@ music_search_kwargs = {
     "itemSubType": "msscr-mss, msscr-"
 }
 
+# Number of bn: terms OR'd into one brief bibs query
+# Most ISBNs return 1-3 records so 10 keeps a batch comfortably inside the 50 record limit
+ISBN_BATCH_SIZE = 10
+
+# Worldcat calls allowed per RATE_PERIOD seconds, tune to the limits on the WSKey in use
+RATE_MAX_CALLS = 50
+RATE_PERIOD = 1.0
+
+# Full records are parsed in a process pool, documents arriving within PARSE_BATCH_DELAY seconds
+# are sent to a worker process together, up to PARSE_BATCH_SIZE at a time
+PARSE_BATCH_SIZE = 32
+PARSE_BATCH_DELAY = 0.05
+
+# Full records are fetched up front for each card's FULL_BIB_TOP_K best ranked brief records,
+# the rest only when the reviewer asks for more, see rank_brief_records and fetch_more_full_bibs
+FULL_BIB_TOP_K = 5
+RANK_WEIGHTS = {"title": 3, "author": 2, "isbn": 3, "date": 1, "language": 1, "format": 0.5}
+RANK_LANGUAGE = "eng"  # cataloguing language of the records we derive from
+RANK_FORMAT = "Book"
+
+
+class RateBudget:
+    """
+    Sliding window count of Worldcat API calls
+    Shared between workers so optional extra queries (e.g. speculative title/author searches)
+    can be switched off when close to the rate limit
+    """
+    def __init__(self, max_calls: int = RATE_MAX_CALLS, period: float = RATE_PERIOD, headroom: float = 0.8):
+        self.max_calls = max_calls
+        self.period = period
+        self.headroom = headroom
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float) -> None:
+        while self._calls and now - self._calls[0] > self.period:
+            self._calls.popleft()
+
+    def record(self, n: int = 1) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            self._calls.extend([now] * n)
+
+    def used(self) -> int:
+        with self._lock:
+            self._trim(time.monotonic())
+            return len(self._calls)
+
+    def near_limit(self) -> bool:
+        return self.used() >= self.headroom * self.max_calls
+
+    def try_acquire(self, n: int = 1) -> bool:
+        """
+        Record n calls if they fit under the headroom without waiting, for calls that can be skipped
+        @param n: int
+        @return: bool, False if the calls weren't recorded and shouldn't be made
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            if len(self._calls) + n > self.headroom * self.max_calls:
+                return False
+            self._calls.extend([now] * n)
+            return True
+
+    async def acquire(self, n: int = 1) -> None:
+        """
+        Wait until n more calls fit in the window then record them
+        Every async search goes through this so all the documents in a batch run share one rate limit
+        @param n: int
+        @return: None
+        """
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                self._trim(now)
+                if len(self._calls) + n <= self.max_calls:
+                    self._calls.extend([now] * n)
+                    return
+                wait = self.period - (now - self._calls[0])
+            await asyncio.sleep(max(wait, 0.001))
+
+
+def speculate(
+    ti: Optional[str],
+    isbn: Optional[Union[str, int]],
+    speculative: bool,
+    budget: Optional[RateBudget]
+) -> bool:
+    """
+    Decide whether to fire the title/author search alongside the ISBN search
+    Only worthwhile if there's both an ISBN and a title, and skipped when the budget is close to the rate limit
+    """
+    if not (speculative and isbn and ti):
+        return False
+    return budget is None or not budget.near_limit()
+
+
+# Runs the sync speculative title/author searches, shared so a thread isn't started for every search
+_speculative_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative-search")
+
 
 def search_brief_bib(
     ti: Optional[str] = None,
     au: Optional[str] = None,
     isbn: Optional[Union[str, int]] = None,
     session: MetadataSession = None,
-    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {}
+    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {},
+    speculative: bool = False,
+    budget: Optional[RateBudget] = None,
+    executor: Optional[Executor] = None
 ) -> Dict[str, str]:
     """
     search_brief_bib applicable to df
     Known issue with specifying offset/limit
     So specify acceptable itemSubTypes and hope correct result is in first 50 records
+    With speculative the title/author search runs on executor alongside the ISBN search,
+    an in flight request can't be cancelled so its response is discarded if the ISBN search finds records.
+    Both searches are charged to the budget before they're sent and the speculative one is skipped if they don't fit.
+    @param executor: Optional[Executor], for the speculative search, a shared thread pool if not given
     """
 
     res = None
 
+    if speculate(ti, isbn, speculative, budget) and (budget is None or budget.try_acquire(n=2)):
+        executor = executor or _speculative_executor
+        ti_au_future = executor.submit(session.brief_bibs_search, q=f'ti:"{ti}" and au:"{au}"', **search_kwargs)
+
+        res = session.brief_bibs_search(q=f'bn:{isbn}', **search_kwargs)
+        if res.json()["numberOfRecords"] > 0:
+            ti_au_future.cancel()
+            return res.json()
+        return ti_au_future.result().json()
+
     if isbn:
         query = f'bn:{isbn}'
         res = session.brief_bibs_search(q=query, **search_kwargs)
+        if budget:
+            budget.record()
 
     if not res or res.json()["numberOfRecords"] == 0:
         query = f'ti:"{ti}" and au:"{au}"'
         res = session.brief_bibs_search(q=query, **search_kwargs)
+        if budget:
+            budget.record()
 
     return res.json()
 
 
+def parse_marcxml(xml: str) -> Record:
+    """
+    @param xml: str, a MARCXML document holding one record, e.g. a bib_get response
+    @return: Record
+    """
+    return marcxml.parse_xml_to_array(io.StringIO(xml))[0]
+
+
+def parse_marcxml_batch(xmls: List[str]) -> List[Union[Record, Exception]]:
+    """
+    Parse several documents in one call, run in a worker process by MarcXmlParser
+    A document that fails to parse gets its exception in place of a record, the rest are still returned
+    @param xmls: List[str]
+    @return: List[Union[Record, Exception]]
+    """
+    records = []
+    for xml in xmls:
+        try:
+            records.append(parse_marcxml(xml))
+        except Exception as e:
+            records.append(e)
+    return records
+
+
+class MarcXmlParser:
+    """
+    Parses MARCXML off the event loop so the workers' requests keep going while records are parsed
+    parse() collects documents for up to delay seconds, or until batch_size have arrived, and sends them to
+    the executor as one submission, a process pool by default so parsing uses every core
+    """
+    def __init__(self, executor: Optional[Executor] = None, batch_size: int = PARSE_BATCH_SIZE,
+                 delay: float = PARSE_BATCH_DELAY):
+        """
+        @param executor: Optional[Executor], owned and shut down by close() if not given
+        @param batch_size: int
+        @param delay: float, seconds
+        """
+        self.own_executor = executor is None
+        self.executor = executor or ProcessPoolExecutor()  # worker processes only start on the first batch
+        self.batch_size = batch_size
+        self.delay = delay
+        self.pending = []  # (xml, future) waiting for the next batch
+        self.timer = None
+
+    async def parse(self, xml: str) -> Record:
+        """
+        @param xml: str
+        @return: Record
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((xml, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        """
+        Submit the documents collected so far
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        parsed = asyncio.get_running_loop().run_in_executor(self.executor, parse_marcxml_batch, [x for x, _ in batch])
+        parsed.add_done_callback(lambda f: self.resolve(batch, f))
+
+    @staticmethod
+    def resolve(batch: List[Tuple[str, asyncio.Future]], parsed: asyncio.Future) -> None:
+        if parsed.cancelled():
+            results = [None] * len(batch)
+        elif parsed.exception():
+            results = [parsed.exception()] * len(batch)  # e.g. a worker process died
+        else:
+            results = parsed.result()
+        for (_, future), res in zip(batch, results):
+            if future.done():  # its worker was cancelled
+                continue
+            if parsed.cancelled():
+                future.cancel()
+            elif isinstance(res, Exception):
+                future.set_exception(res)
+            else:
+                future.set_result(res)
+
+    def close(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 def get_full_bib(
     brief_bibs: Dict[str, Union[int, Dict[str, str]]],
-    session: MetadataSession
+    session: MetadataSession,
+    executor: Optional[Executor] = None
 ) -> Union[None, List[Record]]:
+    """
+    Fetch and parse the full record for each brief bib
+    With an executor each record is parsed there while the next one is fetched
+    """
     if brief_bibs["numberOfRecords"] == 0:
         return None
     else:
@@ -61,82 +295,190 @@ def get_full_bib(
         oclc_nums = [x["oclcNumber"] for x in recs]
         if len(set(oclc_nums)) != len(oclc_nums):
             raise ValueError("Non unique OCLC numbers returned by brief bibs search")
-        matched_xml = [session.bib_get(rec["oclcNumber"]).text for rec in recs]
-        matched_records = [marcxml.parse_xml_to_array(io.StringIO(x))[0] for x in matched_xml]
-        return matched_records
+        if executor is None:
+            return [parse_marcxml(session.bib_get(rec["oclcNumber"]).text) for rec in recs]
+        parsed = [executor.submit(parse_marcxml, session.bib_get(rec["oclcNumber"]).text) for rec in recs]
+        return [x.result() for x in parsed]
 
 
-async def process_queue(
-    queue: Queue,
-    name: Optional[str] = None,
-    session: AsyncMetadataSession = None,
-    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {},
-    brief_bibs_out: Dict[int, Union[None, str, Dict[str, str]]] = {},
-    full_bibs_out: Dict[int, List[Union[Record, str]]] = {},
-    tracker: tqdm = None
-):
-    while True:
-        work_item = await queue.get()
+# Work item priorities, lower runs first
+PRIORITY_ISBN = 0  # single card ISBN searches, cheap and usually decisive
+PRIORITY_FULL_BIB = 1  # full records, ranked by how soon their card will be reviewed
+PRIORITY_FALLBACK = 2  # title/author and music searches
+PRIORITY_RETRY = 3  # searches that raised an error
 
-        if len(work_item) == 400:  # idx, ti, au, year from music_records_df
-            t0 = time.perf_counter()
-            logging.debug(f"{name} api brief call start {t0}")
+# Times a search that raised an error, e.g. a WorldcatRequestError, is requeued before the error is kept as its result
+MAX_RETRIES = 1
 
-            idx, ti, au, year = work_item
-            try:
-                brief_bibs = await async_search_brief_bib_music(ti=ti, au=au, year=year, session=session, search_kwargs=search_kwargs)
-                brief_bibs_out[idx] = brief_bibs
+_work_item_seq = itertools.count()  # FIFO within a priority
+_requeue_tasks = set()  # the event loop only keeps weak references to tasks
 
-                # if brief_bibs["numberOfRecords"] > 0:
-                #     await asyncio.gather(*[queue.put((idx, res["oclcNumber"])) for res in brief_bibs["briefRecords"]])
 
-                tracker.update(n=1)
-                t1 = time.perf_counter()
-                logging.debug(f"{name} api brief call finished. Elapsed: {t1 - t0}")
-                queue.task_done()
-            except WorldcatRequestError as e:
-                brief_bibs_out[idx] = f"{e}"
-                queue.task_done()
+@dataclass
+class WorkItem:
+    """
+    Base for items on the worker queue, ordered by (priority, rank, seq) whatever their type
+    rank orders items of the same priority, e.g. a card's position in the review order
+    """
+    priority: int
+    rank: int = 0
+    seq: int = field(default_factory=lambda: next(_work_item_seq))
+    idx: Hashable = None
+    attempts: int = 0
 
-        elif len(work_item) == 4:  # idx, ti, au, isbn from cards_df
-            t0 = time.perf_counter()
-            logging.debug(f"{name} api brief call start {t0}")
+    def __lt__(self, other: "WorkItem") -> bool:
+        return (self.priority, self.rank, self.seq) < (other.priority, other.rank, other.seq)
 
-            idx, ti, au, isbn = work_item
-            try:
-                brief_bibs = await async_search_brief_bib_cac(ti=ti, au=au, isbn=isbn, session=session, search_kwargs=search_kwargs)
-                brief_bibs_out[idx] = brief_bibs
+    def retry(self) -> "WorkItem":
+        return replace(self, priority=PRIORITY_RETRY, seq=next(_work_item_seq), attempts=self.attempts + 1)
 
-                # if brief_bibs["numberOfRecords"] > 0:
-                #     await asyncio.gather(*[queue.put((idx, res["oclcNumber"])) for res in brief_bibs["briefRecords"]])
 
-                tracker.update(n=1)
-                t1 = time.perf_counter()
-                logging.debug(f"{name} api brief call finished. Elapsed: {t1 - t0}")
-                queue.task_done()
-            except WorldcatRequestError as e:
-                brief_bibs_out[idx] = f"{e}"
-                queue.task_done()
+@dataclass
+class BriefBibSearch(WorkItem):
+    """
+    Card search, by ISBN falling back to title/author, or title/author only if isbn is None
+    """
+    ti: Optional[str] = None
+    au: Optional[str] = None
+    isbn: Optional[Union[str, int]] = None
 
-        elif len(work_item) == 2:  # idx, oclc number from a brief bib
+    @classmethod
+    def for_card(cls, idx: Hashable, ti: Optional[str], au: Optional[str], isbn: Optional[Union[str, int]], rank: int = 0):
+        return cls(priority=PRIORITY_ISBN if isbn else PRIORITY_FALLBACK, rank=rank, idx=idx, ti=ti, au=au, isbn=isbn)
 
-            t0 = time.perf_counter()
-            logging.debug(f"{name} api full call start {t0}")
+    def fallback(self) -> "BriefBibSearch":
+        return replace(self, priority=PRIORITY_FALLBACK, seq=next(_work_item_seq), isbn=None)
 
-            idx, oclc_num = work_item
-            try:
-                xml = await session.bib_get(oclc_num)
-                record = marcxml.parse_xml_to_array(io.StringIO(xml.text))[0]
-                full_bibs_out[idx].append(record)
 
-                t1 = time.perf_counter()
-                logging.debug(f"{name} api full call finished. Elapsed: {t1 - t0}")
-                queue.task_done()
-                tracker.update(n=1)
-            except WorldcatRequestError as e:
-                full_bibs_out[idx].append(f"{e}")
+@dataclass
+class MusicSearch(WorkItem):
+    ti: Optional[str] = None
+    au: Optional[str] = None
+    year: Optional[int] = None
+
+    @classmethod
+    def for_record(cls, idx: Hashable, ti: Optional[str], au: Optional[str], year: Optional[int], rank: int = 0):
+        return cls(priority=PRIORITY_FALLBACK, rank=rank, idx=idx, ti=ti, au=au, year=year)
+
+
+@dataclass
+class FullBibFetch(WorkItem):
+    oclc_num: Optional[str] = None
+
+    @classmethod
+    def for_record(cls, idx: Hashable, oclc_num: str, rank: int = 0):
+        return cls(priority=PRIORITY_FULL_BIB, rank=rank, idx=idx, oclc_num=oclc_num)
+
+
+async def _requeue(queue: Queue, work_item: WorkItem) -> None:
+    await queue.put(work_item)
+    queue.task_done()
+
+
+def requeue(queue: Queue, work_item: WorkItem) -> None:
+    """
+    Put a follow up item on the queue without blocking the worker on a full queue
+    The item it replaces is only marked done once this one is queued so queue.join() can't finish in between
+    """
+    if queue.maxsize <= 0:
+        queue.put_nowait(work_item)
+        queue.task_done()
+        return
+    task = asyncio.create_task(_requeue(queue, work_item))
+    _requeue_tasks.add(task)  # otherwise the task can be garbage collected before it runs and queue.join() hangs
+    task.add_done_callback(_requeue_tasks.discard)
+
+
+async def process_queue(
+    queue: Queue,
+    name: Optional[str] = None,
+    session: AsyncMetadataSession = None,
+    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {},
+    brief_bibs_out: Dict[int, Union[None, str, Dict[str, str]]] = {},
+    full_bibs_out: Dict[int, List[Union[Record, str]]] = {},
+    tracker: tqdm = None,
+    speculative: bool = False,
+    budget: Optional[RateBudget] = None,
+    on_result: Optional[Callable[[Hashable, Dict[str, str]], None]] = None,
+    parser: Optional[MarcXmlParser] = None,
+    on_full_bib: Optional[Callable[[Hashable], None]] = None,
+    on_error: Optional[Callable[[Hashable, str], None]] = None
+):
+    """
+    Worker consuming WorkItems from a PriorityQueue, cheapest and most useful searches first
+    An ISBN search that finds nothing is requeued as a title/author search at PRIORITY_FALLBACK
+    and a search that raises is requeued at PRIORITY_RETRY up to MAX_RETRIES times
+    Results go to brief_bibs_out/full_bibs_out, on_result is also called with (idx, brief_bibs)
+    for each successful brief bib search so callers can stream results out, on_error with (idx, error) for
+    each brief bib search that failed for good, and on_full_bib with idx once a FullBibFetch's record or error
+    has been added to full_bibs_out
+    Full records are parsed by parser, shared between the workers, or on the event loop without one
+    """
+    while True:
+        work_item = await queue.get()
+        follow_up = None
+        t0 = time.perf_counter()
+        logging.debug(f"{name} api {type(work_item).__name__} call start {t0}")
+
+        try:
+            if isinstance(work_item, MusicSearch):
+                if budget:
+                    await budget.acquire()
+                brief_bibs = await async_search_brief_bib_music(
+                    ti=work_item.ti, au=work_item.au, year=work_item.year, session=session, search_kwargs=search_kwargs
+                )
+
+            elif isinstance(work_item, BriefBibSearch):
+                fallback = speculative or not work_item.ti  # nothing to gain from queueing the fallback
+                brief_bibs = await async_search_brief_bib_cac(
+                    ti=work_item.ti, au=work_item.au, isbn=work_item.isbn, session=session, search_kwargs=search_kwargs,
+                    speculative=speculative, budget=budget, fallback=fallback
+                )
+                if work_item.isbn and brief_bibs["numberOfRecords"] == 0 and not fallback:
+                    follow_up = work_item.fallback()
+
+            elif isinstance(work_item, FullBibFetch):
+                if budget:
+                    await budget.acquire()
+                xml = await session.bib_get(work_item.oclc_num)
+                try:
+                    record = await parser.parse(xml.text) if parser else parse_marcxml(xml.text)
+                except Exception as e:  # a malformed record, not worth requesting again
+                    logging.warning(f"{name} full record {work_item.oclc_num} didn't parse: {e!r}")
+                    record = f"{e!r}"
+                full_bibs_out[work_item.idx].append(record)
+                if on_full_bib:
+                    on_full_bib(work_item.idx)
+
+            else:
+                raise TypeError(f"Unknown work item {work_item!r}")
+
+        except Exception as e:  # a WorldcatRequestError, or e.g. a dropped connection or a malformed response
+            if not isinstance(e, WorldcatRequestError):
+                logging.warning(f"{name} {type(work_item).__name__} {work_item.idx} failed: {e!r}")
+            if work_item.attempts < MAX_RETRIES:
+                follow_up = work_item.retry()
+            elif isinstance(work_item, FullBibFetch):
+                full_bibs_out[work_item.idx].append(f"{e}")
+                if on_full_bib:
+                    on_full_bib(work_item.idx)
+            else:
+                brief_bibs_out[work_item.idx] = f"{e}"
+                if on_error:
+                    on_error(work_item.idx, f"{e}")
+        else:
+            if follow_up is None and not isinstance(work_item, FullBibFetch):
+                brief_bibs_out[work_item.idx] = brief_bibs
+                if on_result:
+                    on_result(work_item.idx, brief_bibs)
+        finally:  # whatever happens the item is requeued or marked done, so queue.join() can't hang
+            logging.debug(f"{name} api {type(work_item).__name__} call finished. Elapsed: {time.perf_counter() - t0}")
+            if follow_up is not None:
+                requeue(queue, follow_up)
+            else:
+                if tracker is not None:  # tqdm without a total has no truth value
+                    tracker.update(n=1)
                 queue.task_done()
-                tracker.update(n=1)
 
 
 async def async_search_brief_bib_cac(
@@ -144,21 +486,49 @@ async def async_search_brief_bib_cac(
     au: Optional[str],
     isbn: Optional[int],
     session: AsyncMetadataSession = None,
-    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {}
+    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {},
+    speculative: bool = False,
+    budget: Optional[RateBudget] = None,
+    fallback: bool = True
 ) -> Dict[str, str]:
     """
     Async version of search_brief_bib
     Known issue with specifying offset/limit
     So specify acceptable itemSubTypes and hope correct result is in first 50 records
+    With speculative the title/author search is fired concurrently with the ISBN search
+    and cancelled if the ISBN search returns records
+    Without fallback an ISBN search that finds nothing is returned as is, e.g. for process_queue to requeue
     """
     res = None
 
+    if speculate(ti, isbn, speculative, budget):
+        if budget:
+            await budget.acquire(n=2)
+        isbn_task = asyncio.create_task(session.brief_bibs_search(q=f'bn:{isbn}', **search_kwargs))
+        ti_au_task = asyncio.create_task(session.brief_bibs_search(q=f'ti:"{ti}" and au:"{au}"', **search_kwargs))
+
+        try:
+            res = await isbn_task
+        except BaseException:
+            ti_au_task.cancel()
+            raise
+
+        if res.json()["numberOfRecords"] > 0:
+            ti_au_task.cancel()
+            return res.json()
+        res = await ti_au_task
+        return res.json()
+
     if isbn:
         query = f'bn:{isbn}'
+        if budget:
+            await budget.acquire()
         res = await session.brief_bibs_search(q=query, **search_kwargs)
 
-    if not res or res.json()["numberOfRecords"] == 0:
+    if ti and (not res or (fallback and res.json()["numberOfRecords"] == 0)):  # nothing to gain without a title
         query = f'ti:"{ti}" and au:"{au}"'
+        if budget:
+            await budget.acquire()
         res = await session.brief_bibs_search(q=query, **search_kwargs)
 
     return res.json()
@@ -180,3 +550,340 @@ async def async_search_brief_bib_music(
     res = await session.brief_bibs_search(q=query, **search_kwargs)
 
     return res.json()
+
+
+def isbn_match_key(isbn: Union[str, int]) -> str:
+    """
+    Normalise an ISBN so those on cards can be compared with those in brief records
+    Hyphens/spaces are removed and ISBN-10s are converted to ISBN-13
+    @param isbn: Union[str, int]
+    @return: str
+    """
+    isbn = re.sub(r"[^0-9X]", "", str(isbn).upper())
+    if len(isbn) == 10:
+        return isbn10_to_isbn13(isbn)
+    return isbn
+
+
+def match_text(text: Optional[str]) -> str:
+    """
+    Lowercase, strip accents and punctuation and sort the words, for comparing card text with brief records
+    Sorting the words means "Dickens, Charles" and "Charles Dickens" compare as equal
+    @param text: Optional[str]
+    @return: str
+    """
+    if not text:
+        return ""
+    return " ".join(sorted(re.sub(r"[^\w\s]", " ", strip_accents(str(text)).lower()).split()))
+
+
+def text_similarity(a: Optional[str], b: Optional[str]) -> float:
+    """
+    @return: float, 0-1, 0 if either text is missing
+    """
+    a, b = match_text(a), match_text(b)
+    if not a or not b:
+        return 0.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def brief_record_year(brief_record: Dict) -> Optional[int]:
+    year = re.search(r"\d{4}", str(brief_record.get("machineReadableDate") or brief_record.get("date") or ""))
+    return int(year.group()) if year else None
+
+
+def score_brief_record(
+    brief_record: Dict,
+    ti: Optional[str] = None,
+    au: Optional[str] = None,
+    isbn: Optional[Union[str, int]] = None,
+    year: Optional[Union[str, int]] = None
+) -> float:
+    """
+    Weighted score of how well a brief record matches a card, see RANK_WEIGHTS
+    Title and author score their similarity, ISBN, date (within a year), cataloguing language and format
+    score all or nothing. Criteria the card has no value for score 0 for every record.
+    @param brief_record: Dict, one of a brief bibs search's briefRecords
+    @param ti: Optional[str]
+    @param au: Optional[str]
+    @param isbn: Optional[Union[str, int]]
+    @param year: Optional[Union[str, int]]
+    @return: float
+    """
+    record_year = brief_record_year(brief_record)
+    scores = {
+        "title": text_similarity(ti, brief_record.get("title")),
+        "author": text_similarity(au, brief_record.get("creator")),
+        "isbn": bool(isbn) and isbn_match_key(isbn) in {isbn_match_key(x) for x in brief_record.get("isbns", [])},
+        "date": bool(year) and record_year is not None and abs(record_year - int(year)) <= 1,
+        "language": (brief_record.get("catalogingInfo") or {}).get("catalogingLanguage") == RANK_LANGUAGE,
+        "format": brief_record.get("generalFormat") == RANK_FORMAT,
+    }
+    return sum(RANK_WEIGHTS[k] * float(v) for k, v in scores.items())
+
+
+def rank_brief_records(
+    brief_bibs: Union[str, Dict[str, Union[int, List[Dict[str, str]]]]],
+    ti: Optional[str] = None,
+    au: Optional[str] = None,
+    isbn: Optional[Union[str, int]] = None,
+    year: Optional[Union[str, int]] = None
+) -> List[str]:
+    """
+    Order a card's brief records best match first, see score_brief_record
+    The sort is stable so Worldcat's bestMatch order breaks ties
+    @param brief_bibs: Union[str, Dict], json from a brief bibs search or the error string kept in its place
+    @return: List[str], OCLC numbers
+    """
+    if not isinstance(brief_bibs, dict) or not brief_bibs.get("numberOfRecords"):
+        return []
+    recs = brief_bibs.get("briefRecords", [])
+    scores = [score_brief_record(rec, ti=ti, au=au, isbn=isbn, year=year) for rec in recs]
+    order = sorted(range(len(recs)), key=lambda i: -scores[i])
+    return list(dict.fromkeys(recs[i]["oclcNumber"] for i in order))
+
+
+def ocn_key(ocn: str) -> str:
+    """
+    OCLC number without the ocm/ocn/on prefix a full record's 001 has
+    """
+    return re.sub(r"^\D+", "", str(ocn))
+
+
+def full_bib_fetches(
+    work_brief_bibs: Dict[Hashable, Union[str, Dict[str, str]]],
+    work_bib_info: Dict[Hashable, Dict[str, str]],
+    top_k: int = FULL_BIB_TOP_K
+) -> Tuple[Dict[Hashable, List[str]], Dict[str, List], List[FullBibFetch]]:
+    """
+    Rank each work's brief records against its bib info and make a FullBibFetch for each of the top_k
+    A record in several works' results is only fetched once
+    @param work_brief_bibs: Dict, brief bibs per work
+    @param work_bib_info: Dict, output of extract_bib_info, a work's "year" is used if there is one
+    @param top_k: int
+    @return: Tuple, ({work: [OCLC numbers, best first]}, {OCLC number: []} for process_queue's full_bibs_out, fetches)
+    """
+    ranked = {}
+    for work, brief_bibs in work_brief_bibs.items():
+        info = work_bib_info.get(work, {})
+        ranked[work] = rank_brief_records(
+            brief_bibs, ti=info.get("title"), au=info.get("author"), isbn=info.get("ISBN"), year=info.get("year")
+        )
+
+    fetched, fetches = {}, []
+    for work, ocns in ranked.items():
+        for rank, ocn in enumerate(ocns[:top_k]):
+            if ocn not in fetched:
+                fetched[ocn] = []
+                fetches.append(FullBibFetch.for_record(ocn, ocn, rank=rank))
+    return ranked, fetched, fetches
+
+
+def collect_full_bibs(
+    ranked: Dict[Hashable, List[str]], fetched: Dict[str, List], top_k: int = FULL_BIB_TOP_K
+) -> Dict[Hashable, Dict[str, List]]:
+    """
+    Each work's fetched full records, see full_bib_fetches
+    @return: Dict, {work: {"ranked": [OCLC numbers, best first], "records": [Record, in rank order]}}
+    """
+    records = {}
+    for ocn, res in fetched.items():
+        if res and isinstance(res[0], Record):
+            records[ocn] = res[0]
+        else:  # an empty list is a fetch that recorded no result at all
+            logging.warning(f"Full record {ocn} not fetched: {res[0] if res else 'no result'}")
+    logging.info(f"{len(records)} of {len(fetched)} full records fetched for {len(ranked)} works")
+
+    return {
+        work: {"ranked": ocns, "records": [records[x] for x in ocns[:top_k] if x in records]}
+        for work, ocns in ranked.items()
+    }
+
+
+async def fetch_full_bibs(
+    work_brief_bibs: Dict[Hashable, Union[str, Dict[str, str]]],
+    work_bib_info: Dict[Hashable, Dict[str, str]],
+    session: AsyncMetadataSession,
+    top_k: int = FULL_BIB_TOP_K,
+    n_workers: int = 50,
+    budget: Optional[RateBudget] = None,
+    parser: Optional[MarcXmlParser] = None
+) -> Dict[Hashable, Dict[str, List]]:
+    """
+    Rank each work's brief records against its bib info and fetch the full records of the top_k
+    A record in several works' results is only fetched once. Fetches are queued by rank so every work
+    gets its best match before any work gets its second. Records that can't be fetched or parsed are logged
+    and left out, so a work can have fewer than top_k records.
+    @param work_brief_bibs: Dict, brief bibs per work
+    @param work_bib_info: Dict, output of extract_bib_info, a work's "year" is used if there is one
+    @param session: AsyncMetadataSession
+    @param top_k: int
+    @param n_workers: int
+    @param budget: RateBudget
+    @param parser: MarcXmlParser, one is created and closed here if not given
+    @return: Dict, {work: {"ranked": [OCLC numbers, best first], "records": [Record, in rank order]}},
+    see fetch_more_full_bibs for the records after the top_k
+    """
+    ranked, fetched, fetches = full_bib_fetches(work_brief_bibs, work_bib_info, top_k=top_k)
+    queue = asyncio.PriorityQueue()
+    for work_item in fetches:
+        queue.put_nowait(work_item)
+
+    if fetched:
+        own_parser = parser is None
+        parser = parser or MarcXmlParser()
+        workers = [
+            asyncio.create_task(process_queue(
+                queue, name=f"full-bib-worker-{i}", session=session, full_bibs_out=fetched, budget=budget, parser=parser
+            ))
+            for i in range(min(n_workers, len(fetched)))
+        ]
+        try:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            if own_parser:
+                parser.close()
+
+    return collect_full_bibs(ranked, fetched, top_k=top_k)
+
+
+def fetch_more_full_bibs(
+    full_bibs: Dict[str, List],
+    session: MetadataSession,
+    n: int = FULL_BIB_TOP_K,
+    executor: Optional[Executor] = None
+) -> List[Record]:
+    """
+    Fetch the next n ranked records a work doesn't have the full record for yet, for a reviewer who
+    hasn't found the match in the top ranked records. Records that failed to fetch before are tried again.
+    @param full_bibs: Dict, a work's entry in the output of fetch_full_bibs, its records are extended in place
+    @param session: MetadataSession
+    @param n: int
+    @param executor: Executor, see get_full_bib
+    @return: List[Record], the records fetched
+    """
+    have = {ocn_key(f.data) for rec in full_bibs["records"] for f in rec.get_fields("001")}
+    more = [ocn for ocn in full_bibs["ranked"] if ocn_key(ocn) not in have][:n]
+    if not more:
+        return []
+    records = get_full_bib(
+        {"numberOfRecords": len(more), "briefRecords": [{"oclcNumber": ocn} for ocn in more]}, session, executor
+    )
+    full_bibs["records"].extend(records)
+    return records
+
+
+def batch_isbn_query(isbns: List[Union[str, int]]) -> str:
+    """
+    Combine ISBNs into a single OR'd brief bibs query
+    @param isbns: List[Union[str, int]]
+    @return: str
+    """
+    return " OR ".join(f"bn:{isbn}" for isbn in dict.fromkeys(isbns))
+
+
+def demux_isbn_batch(
+    brief_bibs: Dict[str, Union[int, List[Dict[str, str]]]],
+    isbns: Dict[Hashable, Union[str, int]]
+) -> Tuple[Dict[Hashable, Dict[str, Union[int, List[Dict[str, str]]]]], List[Hashable]]:
+    """
+    Split the response to a batched ISBN query back out to the cards in the batch
+    Brief records are assigned to every card whose ISBN appears in the record's isbns
+    Cards are ambiguous, and returned for a single card query, if:
+    the response was truncated by the record limit (any card could be missing records)
+    or the card matched nothing but some returned records couldn't be assigned to a card
+    @param brief_bibs: Dict, json from a batched brief_bibs_search
+    @param isbns: Dict[Hashable, Union[str, int]], card idx: ISBN
+    @return: Tuple[Dict, List], brief bibs per resolved card and the ambiguous card idxs
+    """
+    records = brief_bibs.get("briefRecords", [])
+    if brief_bibs["numberOfRecords"] > len(records):
+        return {}, list(isbns)
+
+    cards_by_key = {}
+    for idx, isbn in isbns.items():
+        cards_by_key.setdefault(isbn_match_key(isbn), []).append(idx)
+
+    matched = {idx: [] for idx in isbns}
+    unassigned = False
+    for rec in records:
+        rec_cards = {idx for x in rec.get("isbns", []) for idx in cards_by_key.get(isbn_match_key(x), [])}
+        if not rec_cards:
+            unassigned = True
+        for idx in rec_cards:
+            matched[idx].append(rec)
+
+    resolved, ambiguous = {}, []
+    for idx, recs in matched.items():
+        if not recs and unassigned:
+            ambiguous.append(idx)
+        else:
+            resolved[idx] = {"numberOfRecords": len(recs), "briefRecords": recs}
+
+    return resolved, ambiguous
+
+
+async def async_search_brief_bib_isbn_batch(
+    isbns: Dict[Hashable, Union[str, int]],
+    session: AsyncMetadataSession = None,
+    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {},
+    budget: Optional[RateBudget] = None
+) -> Tuple[Dict[Hashable, Dict[str, str]], List[Hashable]]:
+    """
+    Search for several cards' ISBNs in one brief bibs query and demultiplex the results
+    @param isbns: Dict[Hashable, Union[str, int]], card idx: ISBN
+    @param session: AsyncMetadataSession
+    @param search_kwargs: Dict
+    @param budget: RateBudget
+    @return: Tuple[Dict, List], see demux_isbn_batch
+    """
+    if budget:
+        await budget.acquire()
+    res = await session.brief_bibs_search(q=batch_isbn_query(list(isbns.values())), **search_kwargs)
+    return demux_isbn_batch(res.json(), isbns)
+
+
+async def batch_search_brief_bib_isbn(
+    isbns: Dict[Hashable, Union[str, int]],
+    session: AsyncMetadataSession = None,
+    search_kwargs: Optional[Dict[str, Union[None, int, str]]] = {},
+    batch_size: int = ISBN_BATCH_SIZE,
+    n_concurrent: int = 10,
+    budget: Optional[RateBudget] = None
+) -> Tuple[Dict[Hashable, Dict[str, str]], List[Hashable]]:
+    """
+    Run batched ISBN searches for all cards with an ISBN
+    Cards that resolve with no records are included in the output with numberOfRecords == 0
+    so the caller can go straight to a title/author search for them.
+    Cards in batches that were ambiguous or raised a WorldcatRequestError are returned for single card queries.
+    @param isbns: Dict[Hashable, Union[str, int]], card idx: ISBN
+    @param session: AsyncMetadataSession
+    @param search_kwargs: Dict
+    @param batch_size: int, ISBNs per query
+    @param n_concurrent: int, max batch queries in flight
+    @param budget: RateBudget
+    @return: Tuple[Dict, List], brief bibs per resolved card and the card idxs needing a single card query
+    """
+    idxs = list(isbns)
+    batches = [{idx: isbns[idx] for idx in idxs[i:i + batch_size]} for i in range(0, len(idxs), batch_size)]
+    semaphore = asyncio.Semaphore(n_concurrent)
+
+    async def run_batch(batch):
+        async with semaphore:
+            try:
+                return await async_search_brief_bib_isbn_batch(
+                    batch, session=session, search_kwargs=search_kwargs, budget=budget
+                )
+            except WorldcatRequestError as e:
+                logging.debug(f"ISBN batch failed, falling back to single card queries: {e}")
+                return {}, list(batch)
+
+    resolved, ambiguous = {}, []
+    for batch_resolved, batch_ambiguous in await asyncio.gather(*[run_batch(b) for b in batches]):
+        resolved.update(batch_resolved)
+        ambiguous.extend(batch_ambiguous)
+
+    logging.info(f"{len(batches)} ISBN batch queries resolved {len(resolved)} of {len(isbns)} cards")
+    return resolved, ambiguous
@@ -0,0 +1,565 @@
+"""
+Run the accession workflow as a pipeline of stages joined by bounded queues
+download -> parse -> bib -> oclc
+Parsing starts while pages are still downloading and Worldcat searches start as soon as a card's
+bib info is ready. Once the searches finish the full records of each card's top ranked matches are fetched. Every stage checkpoints its outputs to data/interim/{doc_id} so a rerun can
+resume from any stage, skipping work already done.
+
+python -m src.data.pipeline --doc-id 10223347 --from-stage parse
+python -m src.data.pipeline --docs 2142572:10223347 2142572:10223348 --collections 2142573
+"""
+import argparse
+import asyncio
+import contextlib
+import glob
+import json
+import logging
+import os
+import pickle
+from dataclasses import replace
+
+import bookops_worldcat as bw
+import pandas as pd
+from tqdm import tqdm
+
+from cfg import COL_ID, DOC_ID
+from src.data.accession_workflow import (
+    TranskribusSession, get_collection_documents, get_document_pages, download_page, load_xml, extract_root_lines,
+    extract_bib_info, get_worldcat_token, queue_oclc_searches
+)
+from src.data.bib_extraction import cluster_keys
+from src.data.oclc_api import (
+    process_queue, cac_search_kwargs, ISBN_BATCH_SIZE, MarcXmlParser, RateBudget, fetch_full_bibs, FULL_BIB_TOP_K,
+    full_bib_fetches, collect_full_bibs
+)
+
+STAGES = ["download", "parse", "bib", "oclc"]
+DONE = None  # end of stream marker passed between stages
+
+
+def checkpoint_path(doc_id, name):
+    return os.path.join("data/interim", str(doc_id), name)
+
+
+def read_checkpoint(path):
+    """
+    Read a jsonl checkpoint, a partly written last line from a crash is ignored
+    @param path: str
+    @return: list[dict]
+    """
+    if not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return records
+
+
+def append_checkpoint(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+async def download_stage(tkb_session, collection_id, doc_id, out_q, n_concurrent=8):
+    """
+    Download pages concurrently, putting each xml path on out_q as soon as it's saved
+    Pages already on disk aren't downloaded again
+    Each download runs in a thread but they all share tkb_session's connection pool and token
+    """
+    pages = await asyncio.to_thread(get_document_pages, tkb_session, collection_id, doc_id)
+    semaphore = asyncio.Semaphore(n_concurrent)
+
+    async def fetch(i, page):
+        async with semaphore:  # put inside the semaphore so a full queue pauses downloads
+            xml_path = await asyncio.to_thread(download_page, tkb_session, page, i, doc_id, False)
+            await out_q.put(xml_path)
+
+    await asyncio.gather(*[fetch(i, page) for i, page in pages])
+    await out_q.put(DONE)
+
+
+async def files_stage(doc_id, out_q):
+    """
+    Resume from the parse stage using the pages already downloaded
+    """
+    for xml_path in sorted(glob.glob(f"data/raw/{doc_id}/*.xml")):
+        await out_q.put(xml_path)
+    await out_q.put(DONE)
+
+
+async def parse_stage(doc_id, in_q, out_q):
+    """
+    Extract the lines from each page and put {page_id: lines} for a work on out_q once
+    both its title and ISBN pages have been parsed
+    """
+    path = checkpoint_path(doc_id, "lines.jsonl")
+    parsed = {x["page"]: x["lines"] for x in read_checkpoint(path)}
+    pending = {}
+
+    while (xml_path := await in_q.get()) is not DONE:
+        page_id = os.path.basename(xml_path)
+        if page_id not in parsed:
+            root = await asyncio.to_thread(load_xml, xml_path)
+            parsed[page_id] = extract_root_lines(root)
+            append_checkpoint(path, {"page": page_id, "lines": parsed[page_id]})
+
+        work = page_id.split("_")[0]
+        pending.setdefault(work, {})[page_id] = parsed[page_id]
+        if len(pending[work]) == 2:
+            await out_q.put(pending.pop(work))
+
+    for page_lines in pending.values():  # works missing a page
+        await out_q.put(page_lines)
+    await out_q.put(DONE)
+
+
+async def lines_checkpoint_stage(doc_id, out_q):
+    """
+    Resume from the bib stage using the lines checkpoint
+    """
+    works = {}
+    for x in read_checkpoint(checkpoint_path(doc_id, "lines.jsonl")):
+        works.setdefault(x["page"].split("_")[0], {})[x["page"]] = x["lines"]
+    for page_lines in works.values():
+        await out_q.put(page_lines)
+    await out_q.put(DONE)
+
+
+async def bib_stage(doc_id, in_q, out_q):
+    """
+    Extract bib info for whatever works are ready, batching everything waiting on in_q
+    so the vectorised extraction isn't run one work at a time
+    """
+    path = checkpoint_path(doc_id, "bib_info.jsonl")
+    finished = False
+    while not finished:
+        batch = [await in_q.get()]
+        while not in_q.empty():
+            batch.append(in_q.get_nowait())
+        finished = DONE in batch
+
+        page_lines = {page: lines for x in batch if x is not DONE for page, lines in x.items()}
+        bib_info = extract_bib_info(page_lines) if page_lines else {}
+        for work, info in bib_info.items():
+            append_checkpoint(path, {"work": work, **info})
+        if bib_info:
+            await out_q.put(bib_info)
+
+    await out_q.put(DONE)
+
+
+async def bib_checkpoint_stage(doc_id, out_q):
+    """
+    Resume from the oclc stage using the bib info checkpoint
+    """
+    bib_info = {x.pop("work"): x for x in read_checkpoint(checkpoint_path(doc_id, "bib_info.jsonl"))}
+    if bib_info:
+        await out_q.put(bib_info)
+    await out_q.put(DONE)
+
+
+def batch_cluster_keys(bib_info):
+    """
+    ISBN, or title/author if there isn't one, identifying copies/volumes of the same work
+    @param bib_info: Dict[str, Dict[str, str]]
+    @return: Dict[str, Optional[str]]
+    """
+    bib_df = pd.DataFrame.from_dict(bib_info, orient="index").reindex(columns=["title", "author", "ISBN"])
+    keys = cluster_keys(bib_df, isbn="ISBN")
+    key = ("isbn:" + keys["isbn_key"]).fillna("ti_au:" + keys["ti_au_key"])
+    return {work: None if pd.isna(k) else k for work, k in key.items()}
+
+
+class DocQueue:
+    """
+    A document's view of the shared worker queue, work items are tagged with the doc ID
+    so the pool can route results back, see OclcWorkerPool
+    """
+    def __init__(self, pool, doc_id):
+        self.pool = pool
+        self.doc_id = doc_id
+
+    async def put(self, work_item):
+        self.pool.pending[self.doc_id] += 1
+        self.pool.idle[self.doc_id].clear()
+        await self.pool.queue.put(replace(work_item, idx=(self.doc_id, work_item.idx)))
+
+
+class _FullBibsOut:
+    """
+    process_queue's full_bibs_out for a pool, routes (doc_id, OCLC number) to the document's fetched records
+    """
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getitem__(self, key):
+        doc_id, ocn = key
+        return self.pool.full_bibs[doc_id][ocn]
+
+
+class OclcWorkerPool:
+    """
+    Worldcat search workers shared by every document in a run, all searches go through one
+    session and RateBudget so the API limit holds however many documents are running.
+    Documents' work items share one bounded priority queue, FIFO within a priority, so a large document
+    can't starve a small one, a document waiting on a full queue gets the next free slot in turn.
+    Results are written back by doc ID: process_queue sets pool[(doc_id, work)], which lands in that
+    document's brief bibs, and on_result and on_error are forwarded to the document's callbacks.
+    Full records are fetched by the same workers, see fetch_full_bibs, and parsed in one MarcXmlParser's process pool.
+    """
+    def __init__(self, session, n_workers=50, queue_size=100, speculative=False, budget=None, parser=None):
+        self.session = session
+        self.budget = budget or RateBudget()
+        self.own_parser = parser is None
+        self.parser = parser or MarcXmlParser()
+        self.queue = asyncio.PriorityQueue(maxsize=queue_size)
+        self.brief_bibs, self.full_bibs, self.pending, self.idle = {}, {}, {}, {}
+        self.callbacks, self.error_callbacks = {}, {}
+        self.tracker = tqdm(desc="brief bib searches")
+        self.workers = [
+            asyncio.create_task(process_queue(
+                queue=self.queue, name=f"worker-{i}", session=session, search_kwargs=cac_search_kwargs,
+                brief_bibs_out=self, tracker=self.tracker, speculative=speculative, budget=self.budget,
+                on_result=self.on_result, parser=self.parser, full_bibs_out=_FullBibsOut(self),
+                on_full_bib=self.on_full_bib, on_error=self.on_error
+            ))
+            for i in range(n_workers)
+        ]
+
+    def register(self, doc_id, brief_bibs, on_result=None, on_error=None):
+        """
+        @param doc_id: int
+        @param brief_bibs: Dict[str, Dict], the document's results are added here
+        @param on_result: Callable[[str, Dict], None], called with (work, brief bibs) for each successful search
+        @param on_error: Callable[[str, str], None], called with (work, error) for each failed search
+        @return: DocQueue
+        """
+        self.brief_bibs[doc_id] = brief_bibs
+        self.full_bibs[doc_id] = {}
+        self.callbacks[doc_id] = on_result
+        self.error_callbacks[doc_id] = on_error
+        self.pending[doc_id] = 0
+        self.idle[doc_id] = asyncio.Event()
+        self.idle[doc_id].set()
+        return DocQueue(self, doc_id)
+
+    def __setitem__(self, key, value):
+        doc_id, work = key
+        self.brief_bibs[doc_id][work] = value
+        self.done(doc_id)
+
+    def done(self, doc_id):
+        self.pending[doc_id] -= 1  # every queued search or fetch ends in exactly one result or error
+        if self.pending[doc_id] == 0:
+            self.idle[doc_id].set()
+
+    def on_full_bib(self, key):
+        self.done(key[0])
+
+    def on_result(self, key, res):
+        doc_id, work = key
+        if self.callbacks[doc_id]:
+            self.callbacks[doc_id](work, res)
+
+    def on_error(self, key, error):
+        doc_id, work = key
+        if self.error_callbacks[doc_id]:
+            self.error_callbacks[doc_id](work, error)
+
+    async def join(self, doc_id):
+        """
+        Wait for all of a document's queued searches, other documents' searches may still be running
+        """
+        await self.idle[doc_id].wait()
+
+    def unregister(self, doc_id):
+        for d in (self.brief_bibs, self.full_bibs, self.callbacks, self.error_callbacks, self.pending, self.idle):
+            d.pop(doc_id, None)
+
+    async def fetch_full_bibs(self, doc_id, work_brief_bibs, work_bib_info, top_k=FULL_BIB_TOP_K):
+        """
+        fetch_full_bibs on the pool's workers, sharing its queue with other documents' searches
+        @param doc_id: int
+        @param work_brief_bibs: Dict, brief bibs per work
+        @param work_bib_info: Dict, output of extract_bib_info
+        @param top_k: int
+        @return: Dict, see fetch_full_bibs
+        """
+        ranked, fetched, fetches = full_bib_fetches(work_brief_bibs, work_bib_info, top_k=top_k)
+        queue = self.register(doc_id, {})
+        self.full_bibs[doc_id] = fetched
+        try:
+            for work_item in fetches:
+                await queue.put(work_item)
+            await self.join(doc_id)
+        finally:
+            self.unregister(doc_id)
+        return collect_full_bibs(ranked, fetched, top_k=top_k)
+
+    def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.tracker.close()
+        if self.own_parser:
+            self.parser.close()
+
+
+async def oclc_stage(
+    doc_id, in_q, session, n_workers=50, queue_size=100, batch_isbns=True, isbn_batch_size=ISBN_BATCH_SIZE,
+    speculative=False, budget=None, cluster=True, pool=None
+):
+    """
+    Search Worldcat for each batch of bib info as it arrives
+    Works with a brief bibs checkpoint are skipped, results are checkpointed as each search completes
+    With cluster a work with the same ISBN or title/author as one already seen isn't searched,
+    it gets a copy of the first work's results
+    Searches run on pool's workers, shared with other documents, or on a pool of n_workers for this document
+    @return: Dict[str, Dict], brief bibs for every work
+    """
+    path = checkpoint_path(doc_id, "brief_bibs.jsonl")
+    brief_bibs = {x["work"]: x["brief_bibs"] for x in read_checkpoint(path)}
+    done = set(brief_bibs)
+    rep_of, members = {}, {}  # cluster key: first work seen, first work: other works waiting on its results
+
+    def on_result(work, res):
+        append_checkpoint(path, {"work": work, "brief_bibs": res})
+        for member in members.pop(work, []):
+            brief_bibs[member] = res
+            append_checkpoint(path, {"work": member, "brief_bibs": res})
+
+    def on_error(work, error):  # not checkpointed, so a rerun searches the cluster again
+        for member in members.pop(work, []):
+            brief_bibs[member] = error
+
+    def dedupe(bib_info):
+        keys = batch_cluster_keys(bib_info) if cluster else {}
+        to_search = {}
+        for work, info in bib_info.items():
+            key = keys.get(work)
+            rep = rep_of.setdefault(key, work) if key else work
+            if work in done:
+                continue
+            if rep == work:
+                to_search[work] = info
+            elif rep in brief_bibs:
+                brief_bibs[work] = brief_bibs[rep]
+                if not isinstance(brief_bibs[rep], str):  # errors aren't checkpointed
+                    append_checkpoint(path, {"work": work, "brief_bibs": brief_bibs[rep]})
+            else:
+                members.setdefault(rep, []).append(work)
+        return to_search
+
+    own_pool = pool is None
+    if own_pool:
+        pool = OclcWorkerPool(session, n_workers=n_workers, queue_size=queue_size, speculative=speculative, budget=budget)
+    queue = pool.register(doc_id, brief_bibs, on_result, on_error)
+
+    try:
+        while (bib_info := await in_q.get()) is not DONE:
+            bib_info = dedupe(bib_info)
+            await queue_oclc_searches(
+                bib_info, queue, pool.session, brief_bibs, batch_isbns=batch_isbns, isbn_batch_size=isbn_batch_size,
+                budget=pool.budget, on_result=on_result
+            )
+        await pool.join(doc_id)
+    finally:
+        pool.unregister(doc_id)
+        if own_pool:
+            pool.close()
+
+    return brief_bibs
+
+
+async def full_bibs_stage(
+    doc_id, brief_bibs, session, top_k=FULL_BIB_TOP_K, n_workers=50, budget=None, parser=None, pool=None
+):
+    """
+    Fetch the full records of each work's top_k ranked brief records, see fetch_full_bibs
+    Runs once the searches are done, on pool's workers if there is one or on n_workers for this document
+    Works already in the full bibs checkpoint are skipped, works with a record that couldn't be fetched
+    aren't checkpointed so a rerun tries them again
+    @return: Dict[str, Dict], {"ranked": [OCLC numbers], "records": [Record]} for every work
+    """
+    path = checkpoint_path(doc_id, "full_bibs.p")
+    full_bibs = pickle.load(open(path, "rb")) if os.path.exists(path) else {}
+    to_fetch = {work: res for work, res in brief_bibs.items() if work not in full_bibs}
+    if not to_fetch:
+        return full_bibs
+
+    bib_info = {x.pop("work"): x for x in read_checkpoint(checkpoint_path(doc_id, "bib_info.jsonl"))}
+    if pool is None:
+        fetched = await fetch_full_bibs(
+            to_fetch, bib_info, session, top_k=top_k, n_workers=n_workers, budget=budget, parser=parser
+        )
+    else:
+        fetched = await pool.fetch_full_bibs(doc_id, to_fetch, bib_info, top_k=top_k)
+    complete = {work: x for work, x in fetched.items() if len(x["records"]) == len(x["ranked"][:top_k])}
+    full_bibs.update(complete)
+    pickle.dump(full_bibs, open(path, "wb"))
+    logging.info(f"{doc_id} full records for {len(complete)} works saved to {path}, {len(fetched) - len(complete)} failed")
+    return {**full_bibs, **fetched}
+
+
+async def run_pipeline(
+    collection_id=COL_ID, doc_id=DOC_ID, from_stage="download", queue_size=100, n_workers=50, batch_isbns=True,
+    speculative=False, tkb_session=None, token=None, budget=None, cluster=True, pool=None, top_k=FULL_BIB_TOP_K
+):
+    """
+    Run the pipeline stages concurrently from from_stage onwards
+    @param collection_id: int
+    @param doc_id: int
+    @param from_stage: str, one of STAGES
+    @param queue_size: int, max items waiting between stages
+    @param n_workers: int, Worldcat search workers
+    @param batch_isbns: bool, see queue_oclc_searches
+    @param speculative: bool, see async_search_brief_bib_cac
+    @param tkb_session: TranskribusSession, created if not given for the download stage
+    @param token: WorldcatAccessToken, created from CLIENT_ID/CLIENT_SECRET if not given
+    @param budget: RateBudget
+    @param cluster: bool, search copies/volumes of the same work once, see oclc_stage
+    @param pool: OclcWorkerPool, shared with other documents in a batch run, its workers search and fetch full records
+    @param top_k: int, full records fetched per work, 0 to skip fetching them, see full_bibs_stage
+    @return: Dict[str, Dict], brief bibs for every work
+    """
+    if from_stage not in STAGES:
+        raise ValueError(f"from_stage must be one of {STAGES}")
+    start = STAGES.index(from_stage)
+    xml_q, lines_q, bib_q = (asyncio.Queue(maxsize=queue_size) for _ in range(3))
+    budget = budget or RateBudget()
+
+    stages = []
+    if start == 0:
+        stages.append(download_stage(tkb_session or TranskribusSession(), collection_id, doc_id, xml_q))
+    elif start == 1:
+        stages.append(files_stage(doc_id, xml_q))
+    if start <= 1:
+        stages.append(parse_stage(doc_id, xml_q, lines_q))
+    elif start == 2:
+        stages.append(lines_checkpoint_stage(doc_id, lines_q))
+    if start <= 2:
+        stages.append(bib_stage(doc_id, lines_q, bib_q))
+    else:
+        stages.append(bib_checkpoint_stage(doc_id, bib_q))
+
+    async with contextlib.AsyncExitStack() as stack:
+        if pool is None:
+            token = token or get_worldcat_token()
+            session = await stack.enter_async_context(
+                bw.AsyncMetadataSession(authorization=token, headers={"User-Agent": "Convert-a-Card/1.0"})
+            )
+        else:
+            session = pool.session
+        oclc = oclc_stage(
+            doc_id, bib_q, session, n_workers=n_workers, queue_size=queue_size, batch_isbns=batch_isbns,
+            speculative=speculative, budget=budget, cluster=cluster, pool=pool
+        )
+        *_, brief_bibs = await asyncio.gather(*stages, oclc)
+        if top_k:
+            await full_bibs_stage(
+                doc_id, brief_bibs, session, top_k=top_k, n_workers=n_workers, budget=budget, pool=pool
+            )
+
+    out_path = checkpoint_path(doc_id, "brief_bibs.p")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    pickle.dump(brief_bibs, open(out_path, "wb"))
+    logging.info(f"{doc_id} brief bibs for {len(brief_bibs)} works saved to {out_path}")
+    return brief_bibs
+
+
+async def run_batch(
+    docs, from_stage="download", queue_size=100, n_workers=50, batch_isbns=True, speculative=False, tkb_session=None,
+    token=None, budget=None, cluster=True, top_k=FULL_BIB_TOP_K
+):
+    """
+    Run the pipeline for several documents at once, each with its own checkpoints and output in data/interim/{doc_id}
+    Every document's searches go through one Worldcat session, worker pool and RateBudget
+    and its downloads through one TranskribusSession. A document that fails is logged and doesn't stop the others.
+    @param docs: List[Tuple[int, int]], (collection_id, doc_id)
+    @param from_stage: str, one of STAGES
+    @param queue_size: int
+    @param n_workers: int, Worldcat search workers shared by all documents
+    @param batch_isbns: bool
+    @param speculative: bool
+    @param tkb_session: TranskribusSession, created if not given for the download stage
+    @param token: WorldcatAccessToken, created from CLIENT_ID/CLIENT_SECRET if not given
+    @param budget: RateBudget
+    @param cluster: bool, clustering is within each document
+    @param top_k: int, full records fetched per work
+    @return: Dict[int, Union[Dict[str, Dict], Exception]], brief bibs, or the error raised, per doc_id
+    """
+    tkb_session = tkb_session or (TranskribusSession() if from_stage == "download" else None)
+    token = token or get_worldcat_token()
+    async with bw.AsyncMetadataSession(authorization=token, headers={"User-Agent": "Convert-a-Card/1.0"}) as session:
+        pool = OclcWorkerPool(session, n_workers=n_workers, queue_size=queue_size, speculative=speculative, budget=budget)
+        try:
+            results = await asyncio.gather(*[
+                run_pipeline(
+                    collection_id=col_id, doc_id=doc_id, from_stage=from_stage, queue_size=queue_size,
+                    n_workers=n_workers, batch_isbns=batch_isbns, tkb_session=tkb_session, cluster=cluster, pool=pool,
+                    top_k=top_k
+                )
+                for col_id, doc_id in docs
+            ], return_exceptions=True)
+        finally:
+            pool.close()
+
+    for (_, doc_id), res in zip(docs, results):
+        if isinstance(res, Exception):
+            logging.error(f"{doc_id} failed: {res!r}")
+    return {doc_id: res for (_, doc_id), res in zip(docs, results)}
+
+
+def batch_docs(docs=(), collections=(), tkb_session=None):
+    """
+    (collection_id, doc_id) pairs from --docs col:doc values and every document in --collections
+    @param docs: Iterable[str]
+    @param collections: Iterable[int]
+    @param tkb_session: TranskribusSession
+    @return: List[Tuple[int, int]]
+    """
+    pairs = [tuple(int(x) for x in doc.split(":")) for doc in docs]
+    for col_id in collections:
+        pairs += [(col_id, doc_id) for doc_id in get_collection_documents(tkb_session, col_id)]
+    return list(dict.fromkeys(pairs))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Run the accession workflow with checkpointed, streaming stages")
+    parser.add_argument("--col-id", type=int, default=COL_ID)
+    parser.add_argument("--doc-id", type=int, default=DOC_ID)
+    parser.add_argument("--from-stage", choices=STAGES, default="download", help="Resume from this stage's inputs")
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=50)
+    parser.add_argument("--no-batch-isbns", action="store_true", help="Search ISBNs one card at a time")
+    parser.add_argument("--speculative", action="store_true", help="Run title/author searches alongside ISBN searches")
+    parser.add_argument("--no-cluster", action="store_true", help="Search every card, even copies of the same work")
+    parser.add_argument("--top-k", type=int, default=FULL_BIB_TOP_K, help="Full records fetched per card, 0 for none")
+    parser.add_argument("--docs", nargs="+", default=[], metavar="COL_ID:DOC_ID", help="Batch run these documents")
+    parser.add_argument("--collections", nargs="+", type=int, default=[], help="Batch run every document in these collections")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    if args.docs or args.collections:
+        tkb_session = TranskribusSession() if args.collections or args.from_stage == "download" else None
+        asyncio.run(run_batch(
+            batch_docs(args.docs, args.collections, tkb_session), from_stage=args.from_stage,
+            queue_size=args.queue_size, n_workers=args.workers, batch_isbns=not args.no_batch_isbns,
+            speculative=args.speculative, tkb_session=tkb_session, cluster=not args.no_cluster, top_k=args.top_k
+        ))
+        return
+    asyncio.run(run_pipeline(
+        collection_id=args.col_id, doc_id=args.doc_id, from_stage=args.from_stage, queue_size=args.queue_size,
+        n_workers=args.workers, batch_isbns=not args.no_batch_isbns, speculative=args.speculative,
+        cluster=not args.no_cluster, top_k=args.top_k
+    ))
+
+
+if __name__ == "__main__":
+    main()
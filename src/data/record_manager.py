@@ -0,0 +1,218 @@
+"""
+Export cataloguers' selections as a batch file for Record Manager import
+Replaces copying the OCLC number, shelfmark (852) and OCR text (500) from the app one card at a time.
+Cards are streamed straight to the output file as MARC (one record per card, 001 set to the OCLC number)
+or CSV. Every export records the card store version of each card it wrote so --since-last only exports
+cards that have been matched or edited since the previous export.
+
+python -m src.data.record_manager --cards data/processed/chinese_matches.p --out data/processed/rm_batch.mrc --since-last
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import posixpath
+import re
+import time
+from typing import Dict, Iterator, Optional
+
+import fsspec
+import pandas as pd
+from pymarc import Field, MARCWriter, Record, Subfield
+
+from src.utils.card_store import CardStore, compact, store_root
+
+FORMATS = ["marc", "csv"]
+CSV_COLUMNS = ["card_id", "oclc_number", "shelfmark", "ocr_text", "derivation_complete"]
+SHELFMARK_SUBFIELD = "j"  # 852 $j shelving control number
+OCN_PREFIX = re.compile(r"^(ocm|ocn|on)")
+
+
+def export_state_path(store: CardStore) -> str:
+    return posixpath.join(store.root, "record_manager_exports.json")
+
+
+def read_export_state(store: CardStore) -> Dict[str, int]:
+    """
+    Card store version of every card at the time it was last exported
+    @param store: CardStore
+    @return: Dict[str, int]
+    """
+    try:
+        with store.fs.open(export_state_path(store), "rb") as f:
+            return json.load(f)["versions"]
+    except FileNotFoundError:
+        return {}
+
+
+def write_export_state(store: CardStore, versions: Dict[str, int]) -> None:
+    state = {"versions": versions, "exported": time.time()}
+    store.fs.pipe_file(export_state_path(store), json.dumps(state).encode("utf-8"))
+
+
+def strip_ocn_prefix(ocn: str) -> str:
+    return OCN_PREFIX.sub("", str(ocn).strip())
+
+
+def exportable(cards_df: pd.DataFrame, derivation: Optional[bool] = None) -> pd.Series:
+    """
+    Cards with a selected Worldcat record, "No match" cards are left out
+    @param cards_df: pd.DataFrame
+    @param derivation: Optional[bool], only export cards with/without derivation complete, None for both
+    @return: pd.Series[bool]
+    """
+    ocn = cards_df["selected_match_ocn"]
+    mask = ocn.notna() & (ocn.astype(str) != "No match")
+    if derivation is not None:
+        mask &= (cards_df["derivation_complete"].fillna(False).astype(bool) == derivation)
+    return mask
+
+
+def select_cards(
+        cards_df: pd.DataFrame, store: CardStore, since: Optional[Dict[str, int]] = None, derivation: Optional[bool] = None
+) -> pd.DataFrame:
+    """
+    Cards to export, with the latest edits from the card store already applied to cards_df
+    @param cards_df: pd.DataFrame
+    @param store: CardStore, synced
+    @param since: Optional[Dict[str, int]], previous export's card versions, only newer versions are exported
+    @param derivation: Optional[bool], see exportable
+    @return: pd.DataFrame
+    """
+    mask = exportable(cards_df, derivation)
+    if since is not None:
+        versions = pd.Series([store.version(x) for x in cards_df.index], index=cards_df.index)
+        last_exported = pd.Series([since.get(str(x), -1) for x in cards_df.index], index=cards_df.index)
+        mask &= versions > last_exported
+    return cards_df[mask]
+
+
+def ocr_text(lines, sep: str) -> str:
+    return sep.join(lines) if isinstance(lines, list) else ""
+
+
+def shelfmark(card: pd.Series) -> Optional[str]:
+    """
+    @param card: pd.Series, row of cards_df
+    @return: Optional[str], None if the card has no shelfmark, logged so it can be added by hand
+    """
+    value = card.get("shelfmark")
+    if pd.isna(value) or not str(value).strip():
+        logging.warning(f"Card {card.name} has no shelfmark, exported without one")
+        return None
+    return str(value).strip()
+
+
+def card_to_marc(card: pd.Series) -> Record:
+    """
+    Minimal record for Record Manager to match on 001 and take the 852/500 from
+    A card without a shelfmark has no 852
+    @param card: pd.Series, row of cards_df
+    @return: Record
+    """
+    record = Record(force_utf8=True)
+    record.add_field(Field(tag="001", data=strip_ocn_prefix(card["selected_match_ocn"])))
+    record.add_field(Field(tag="003", data="OCoLC"))
+    mark = shelfmark(card)
+    if mark is not None:
+        record.add_field(Field(tag="852", indicators=[" ", " "], subfields=[Subfield(SHELFMARK_SUBFIELD, mark)]))
+    text = ocr_text(card["lines"], " ")
+    if text:
+        record.add_field(Field(tag="500", indicators=[" ", " "], subfields=[Subfield("a", text)]))
+    return record
+
+
+def card_to_row(card: pd.Series) -> Dict:
+    return {
+        "card_id": card["simple_id"],
+        "oclc_number": strip_ocn_prefix(card["selected_match_ocn"]),
+        "shelfmark": shelfmark(card) or "",
+        "ocr_text": ocr_text(card["lines"], "\n"),
+        "derivation_complete": bool(card["derivation_complete"]) if pd.notna(card["derivation_complete"]) else False,
+    }
+
+
+def write_cards(cards: pd.DataFrame, f: io.BufferedIOBase, fmt: str = "marc") -> Iterator:
+    """
+    Write each card to f as it's converted, yielding its index once written
+    @param cards: pd.DataFrame, see select_cards
+    @param f: binary file handle
+    @param fmt: str, one of FORMATS
+    @return: Iterator of card indices
+    """
+    if fmt == "marc":
+        writer = MARCWriter(f)
+        for idx, card in cards.iterrows():
+            writer.write(card_to_marc(card))
+            yield idx
+    elif fmt == "csv":
+        text_f = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        writer = csv.DictWriter(text_f, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+        for idx, card in cards.iterrows():
+            writer.writerow(card_to_row(card))
+            yield idx
+        text_f.detach()  # leave f open for the caller
+    else:
+        raise ValueError(f"Unknown export format {fmt}, expected one of {FORMATS}")
+
+
+def export_cards(
+        cards_df: pd.DataFrame, store: CardStore, out_path: str, fmt: str = "marc", since_last: bool = False,
+        derivation: Optional[bool] = None, out_fs: Optional[fsspec.AbstractFileSystem] = None
+) -> int:
+    """
+    Write a Record Manager batch file of matched cards and record what was exported
+    The export state is only updated once the whole file has been written
+    @param cards_df: pd.DataFrame, base cards pickle, not modified
+    @param store: CardStore, edits to cards_df
+    @param out_path: str
+    @param fmt: str, one of FORMATS
+    @param since_last: bool, only export cards matched or edited since the last export
+    @param derivation: Optional[bool], see exportable
+    @param out_fs: Optional[fsspec.AbstractFileSystem], defaults to the card store's filesystem
+    @return: int, number of cards exported
+    """
+    out_fs = store.fs if out_fs is None else out_fs
+    cards_df = compact(store, cards_df)
+    exported_versions = read_export_state(store)
+    cards = select_cards(cards_df, store, exported_versions if since_last else None, derivation)
+
+    n = 0
+    with out_fs.open(out_path, "wb") as f:
+        for idx in write_cards(cards, f, fmt):
+            exported_versions[str(idx)] = store.version(idx)
+            n += 1
+    write_export_state(store, exported_versions)
+    return n
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Export selected matches as a Record Manager batch file")
+    parser.add_argument("--cards", default="data/processed/chinese_matches.p", help="Cards pickle, local or s3")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--format", choices=FORMATS, default="marc")
+    parser.add_argument("--since-last", action="store_true", help="Only cards matched or edited since the last export")
+    derivation = parser.add_mutually_exclusive_group()
+    derivation.add_argument("--derived-only", action="store_true", help="Only cards with derivation complete")
+    derivation.add_argument("--underived-only", action="store_true", help="Only cards without derivation complete")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    fs, cards_path = fsspec.core.url_to_fs(args.cards)
+    with fs.open(cards_path, "rb") as f:
+        cards_df = pd.read_pickle(f)
+    derivation = True if args.derived_only else False if args.underived_only else None
+    store = CardStore(fs, store_root(cards_path))
+    n = export_cards(
+        cards_df, store, args.out, fmt=args.format, since_last=args.since_last, derivation=derivation,
+        out_fs=fsspec.core.url_to_fs(args.out)[0]
+    )
+    print(f"Exported {n} cards to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,94 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import glob
 import os
 import re
-import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional, Tuple, Union
 
+from lxml import etree
+import pandas as pd
 
-def extract_labelled_xml(xml: os.PathLike, namespace):
-    root = ET.parse(xml).getroot()
+LABELS = ("shelfmark", "title", "author")
+STRUCTURE_REGEX = re.compile(r"structure\s*\{[^}]*?type:(?P<type>[^;}]+)")
 
-    shelfmarks = []
-    titles = []
-    authors = []
 
-    text_line = f'./{namespace}TextLine/{namespace}TextEquiv/{namespace}Unicode'
+@lru_cache(maxsize=None)
+def structure_type(custom: str) -> Optional[str]:
+    """
+    Parse the structure tag type from a TextRegion's custom attribute
+    e.g. "readingOrder {index:0;} structure {type:shelfmark;}" -> "shelfmark"
+    Cached as cards share a handful of distinct custom strings
+    @param custom: str
+    @return: Optional[str]
+    """
+    match = STRUCTURE_REGEX.search(custom)
+    return match.group("type").strip() if match else None
 
-    for tr in root.iter(namespace + 'TextRegion'):
-        if re.search('shelfmark', tr.attrib['custom']):
-            shelfmarks.append(tr.find(text_line).text)
-            continue
 
-        if re.search('title', tr.attrib['custom']):
-            titles.append(tr.find(text_line).text)
-            continue
+@lru_cache(maxsize=None)
+def compiled_xpaths(namespace: str) -> Tuple[etree.XPath, etree.XPath]:
+    """
+    Precompiled XPaths for structure tagged TextRegions and the text of their TextLines
+    @param namespace: str, namespace URI ("" if the xml has none)
+    @return: Tuple[etree.XPath, etree.XPath]
+    """
+    ns = {"pc": namespace} if namespace else None
+    p = "pc:" if namespace else ""
+    regions = etree.XPath(f"//{p}TextRegion[contains(@custom, 'structure')]", namespaces=ns)
+    lines = etree.XPath(f"./{p}TextLine/{p}TextEquiv/{p}Unicode/text()", namespaces=ns, smart_strings=False)
+    return regions, lines
 
-        if re.search('author', tr.attrib['custom']):
-            authors.append(tr.find(text_line).text)
 
-    record = {'card_xml': xml, 'title': titles, 'author': authors, 'shelfmark': shelfmarks}
+def detect_namespace(root: etree._Element) -> str:
+    """
+    Namespace URI of the root element, PAGE xml namespaces differ between Transkribus versions
+    @param root: etree._Element
+    @return: str
+    """
+    return etree.QName(root).namespace or ""
 
-    return record
\ No newline at end of file
+
+def extract_labelled_xml(xml: os.PathLike, namespace: Optional[str] = None) -> Dict[str, Union[os.PathLike, List[str]]]:
+    """
+    Extract the text of shelfmark/title/author tagged TextRegions from a PAGE xml
+    All TextLines in a region are joined so multi-line titles are kept
+    @param xml: os.PathLike
+    @param namespace: Optional[str], "{uri}" or "uri", detected from the root element if not given
+    @return: Dict[str, Union[os.PathLike, List[str]]]
+    """
+    root = etree.parse(os.fspath(xml)).getroot()
+    namespace = namespace.strip("{}") if namespace else detect_namespace(root)
+    regions, lines = compiled_xpaths(namespace)
+
+    record = {"card_xml": xml, "title": [], "author": [], "shelfmark": []}
+    for tr in regions(root):
+        label = structure_type(tr.get("custom", ""))
+        if label in LABELS:
+            text = " ".join(line for line in lines(tr) if line)
+            record[label].append(text)
+
+    return record
+
+
+def extract_labelled_xml_dir(
+    xml_dir: os.PathLike,
+    pattern: str = "*.xml",
+    n_workers: Optional[int] = None,
+    chunksize: int = 64
+) -> pd.DataFrame:
+    """
+    Run extract_labelled_xml over every matching card xml in a directory using all cores
+    @param xml_dir: os.PathLike
+    @param pattern: str, glob pattern for card xmls
+    @param n_workers: Optional[int], defaults to os.cpu_count(), 1 runs in process
+    @param chunksize: int, files sent to a worker at a time
+    @return: pd.DataFrame, one row per card xml
+    """
+    xmls = sorted(glob.glob(os.path.join(xml_dir, pattern)))
+    if n_workers == 1 or len(xmls) <= chunksize:
+        records = [extract_labelled_xml(x) for x in xmls]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            records = list(executor.map(extract_labelled_xml, xmls, chunksize=chunksize))
+
+    return pd.DataFrame(records, columns=["card_xml", "title", "author", "shelfmark"])
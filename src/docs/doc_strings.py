@@ -9,6 +9,33 @@ The recorded OCLC number of the selected match and its actual OCLC number do not
 Contact harry.lloyd@bl.uk to debug
 """
 
+next_card_help = """
+Takes you to the next unmatched card nobody else is working on and reserves it for you.
+The reservation lapses if you leave the card untouched for 15 minutes.
+"""
+
+card_leased_warning = """
+Another cataloguer is working on this card. Use Next card to be given one nobody else has.
+"""
+
+cluster_info = """
+This card has {n} copies or volumes in the batch with the same ISBN or title/author (IDs {ids}).
+Selecting a match, clearing it or completing derivation here applies to all of them.
+"""
+
+card_conflict_warning = """
+This card has been saved by another cataloguer since you opened it, so your change wasn't saved.
+Their selection is now shown, check it and save again if it needs changing.
+"""
+
+fetch_running_info = """
+Worldcat results are still being fetched, {n} cards so far. New cards are added to the table as they arrive.
+"""
+
+fetch_waiting_info = """
+Worldcat results are being fetched, the first cards will appear here shortly.
+"""
+
 min_cat_help_text = """
 Minimal cataloguing view shows only:  
 100 - Author  
@@ -31,6 +58,16 @@ In full cataloguing view the following are excluded:
 These were agreed with the Chinese cataloguing/curatorial team but can be changed. 
 """
 
+align_subjects_help = """
+Line up identical 6xx subject headings and 880 fields across records so common headings share a row.
+Other repeated fields are shown in the order they appear in each record.
+"""
+
+differences_only_help = """
+Only show the MARC fields that differ between the displayed records.
+Fields that are the same in every record are listed once below the table.
+"""
+
 max_to_display_help = """
 Select the number of records to display in the MARC table above.  
 Setting this value very high can lead to lots of mostly blank rows to scroll through.
@@ -40,7 +77,8 @@ date_select_help = """
 Records with no publication date will remain included in the MARC table. 
 All records including records with no publication date are included by default
 when the sliders are in their default end positions. 
-Publication year defined as a 4-digit number in 260$c
+Publication dates come from the 008 fixed field, or 4-digit years in 264$c/260$c if it has none.
+Records published over a range of years are included if any of the range is selected.
 """
 
 generic_field_search_help = """
@@ -0,0 +1,221 @@
+"""
+Per-card versioned storage of the edits cataloguers make in the app
+The cards pickle is treated as a read-only base and edits are stored beside it:
+    {root}/edits/{idx}/{version}.json   <- immutable, one file per saved version of a card
+    {root}/manifest/{version}.json      <- immutable, latest version of every edited card, used for change detection
+    {root}/manifest/latest.json         <- hint of the newest manifest version, readers look past it
+A version file is created with exclusive create ("xb", If-None-Match on S3) so two sessions can't both
+write the same version of a card, the second gets a CardConflict instead of silently overwriting the first.
+Manifest versions are created the same way, a session whose update loses the race merges into the winner's.
+"""
+import json
+import posixpath
+import time
+from typing import Dict, List, Optional
+
+import fsspec
+import pandas as pd
+
+CARD_FIELDS = ["selected_match", "selected_match_ocn", "derivation_complete", "shelfmark"]
+MANIFEST_RETRIES = 5
+LEGACY_MANIFEST = "manifest.json"  # single manifest overwritten in place, read as version 0
+
+
+class CardConflict(Exception):
+    """
+    Raised when a card has been saved by another session since this session last read it
+    """
+    def __init__(self, idx: str, record: Dict):
+        super().__init__(f"Card {idx} has been edited elsewhere (now version {record['version']})")
+        self.idx = idx
+        self.record = record
+
+
+class ManifestConflict(Exception):
+    """
+    Raised when other sessions keep updating the manifest first, the card versions need merging again later
+    """
+
+
+def store_root(save_file: str) -> str:
+    """
+    Edits for a cards pickle are stored next to it, e.g. cac-bucket/chinese_matches.p -> cac-bucket/chinese_matches_edits
+    @param save_file: str
+    @return: str
+    """
+    return posixpath.splitext(str(save_file).replace("\\", "/"))[0] + "_edits"
+
+
+def to_json(x):
+    return x.item() if hasattr(x, "item") else str(x)  # numpy scalars from the cards df
+
+
+class CardStore:
+    """
+    One per app session, keeps the latest record it has seen for every edited card
+    records: {str(idx): {"version": int, **fields}}
+    """
+    def __init__(self, fs: fsspec.AbstractFileSystem, root: str):
+        self.fs = fs
+        self.root = root
+        self.records = {}
+        self.manifest_version = None  # newest manifest synced, None before the first sync
+
+    def edit_path(self, idx: str, version: int) -> str:
+        return posixpath.join(self.root, "edits", str(idx), f"{version}.json")
+
+    def manifest_path(self, version: int) -> str:
+        return posixpath.join(self.root, "manifest", f"{version}.json")
+
+    @property
+    def latest_path(self) -> str:
+        return posixpath.join(self.root, "manifest", "latest.json")
+
+    def version(self, idx) -> int:
+        return self.records.get(str(idx), {}).get("version", 0)
+
+    def read_manifest(self, version: int) -> Dict[str, int]:
+        path = self.manifest_path(version) if version else posixpath.join(self.root, LEGACY_MANIFEST)
+        try:
+            with self.fs.open(path, "rb") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def latest_manifest_version(self) -> int:
+        """
+        A single HEAD request unless the manifest has changed since it was last synced
+        @return: int, 0 if there's no manifest yet
+        """
+        version = self.manifest_version or 0
+        if version == 0:
+            try:
+                with self.fs.open(self.latest_path, "rb") as f:
+                    version = json.load(f)["version"]
+            except FileNotFoundError:
+                pass
+        while self.fs.exists(self.manifest_path(version + 1)):  # the hint can lag, or be overwritten by an older one
+            version += 1
+        return version
+
+    def read_record(self, idx: str, version: int) -> Dict:
+        with self.fs.open(self.edit_path(idx, version), "rb") as f:
+            return json.load(f)
+
+    def latest_record(self, idx: str, version: int) -> Dict:
+        """
+        The manifest can lag a new version so look past the version it gives
+        """
+        record = self.read_record(idx, version)
+        while self.fs.exists(self.edit_path(idx, version + 1)):
+            version += 1
+            record = self.read_record(idx, version)
+        return record
+
+    def sync(self) -> List[str]:
+        """
+        Pick up edits saved by other sessions
+        Only the next manifest version is looked for unless there is one, then only changed cards are read
+        @return: List[str], ids of cards that changed
+        """
+        version = self.latest_manifest_version()
+        if version == self.manifest_version:
+            return []
+
+        changed = []
+        for idx, card_version in self.read_manifest(version).items():
+            if card_version > self.version(idx):
+                self.records[idx] = self.latest_record(idx, card_version)
+                changed.append(idx)
+        self.manifest_version = version
+        return changed
+
+    def update_manifest(self, versions: Dict[str, int]) -> None:
+        """
+        Merge new card versions into a new manifest version, one write for any number of cards
+        @param versions: Dict[str, int], card idx: new version
+        @raise ManifestConflict: if every attempt lost the race to another session's update
+        """
+        for _ in range(MANIFEST_RETRIES):
+            version = self.latest_manifest_version()
+            manifest = self.read_manifest(version)
+            if all(manifest.get(idx, 0) >= card_version for idx, card_version in versions.items()):
+                return
+            for idx, card_version in versions.items():
+                manifest[idx] = max(manifest.get(idx, 0), card_version)
+
+            path = self.manifest_path(version + 1)
+            self.fs.makedirs(posixpath.dirname(path), exist_ok=True)
+            try:
+                with self.fs.open(path, "xb") as f:
+                    f.write(json.dumps(manifest).encode("utf-8"))
+            except FileExistsError:
+                continue  # another session's update won, merge into theirs
+            self.fs.pipe_file(self.latest_path, json.dumps({"version": version + 1}).encode("utf-8"))
+            return
+        raise ManifestConflict(f"Manifest not updated after {MANIFEST_RETRIES} attempts: {versions}")
+
+    def write(self, idx, fields: Dict, manifest: bool = True) -> Dict:
+        """
+        Save a new version of a card
+        @param idx: card index in the cards df
+        @param fields: Dict, values for some of CARD_FIELDS
+        @param manifest: bool, update the manifest now, False to batch the update with other cards' writes
+        @return: Dict, the saved record
+        @raise CardConflict: if another session has saved this card since it was last synced
+        """
+        idx = str(idx)
+        record = {**self.records.get(idx, {}), **fields, "version": self.version(idx) + 1, "saved": time.time()}
+        path = self.edit_path(idx, record["version"])
+        self.fs.makedirs(posixpath.dirname(path), exist_ok=True)
+        try:
+            with self.fs.open(path, "xb") as f:
+                f.write(json.dumps(record, default=to_json).encode("utf-8"))
+        except FileExistsError:
+            self.records[idx] = self.latest_record(idx, record["version"])
+            raise CardConflict(idx, self.records[idx])
+
+        self.records[idx] = record
+        if manifest:
+            self.update_manifest({idx: record["version"]})
+        return record
+
+    def apply(self, df: pd.DataFrame, idxs: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Overlay the stored edits onto the cards df, in place
+        @param df: pd.DataFrame
+        @param idxs: Optional[List[str]], only apply these cards' edits
+        @return: pd.DataFrame
+        """
+        records = self.records if idxs is None else {idx: self.records[idx] for idx in idxs}
+        return overlay(df, records)
+
+
+def overlay(df: pd.DataFrame, edits: Dict[str, Dict]) -> pd.DataFrame:
+    """
+    Set the CARD_FIELDS in edits on the cards df, in place
+    @param df: pd.DataFrame
+    @param edits: Dict[str, Dict], {str(idx): fields}
+    @return: pd.DataFrame
+    """
+    str_index = df.index.astype(str)
+    for idx, record in edits.items():
+        pos = str_index.get_indexer([idx])[0]
+        if pos == -1:
+            continue
+        for field in CARD_FIELDS:
+            if field in record:
+                df.at[df.index[pos], field] = record[field]
+    return df
+
+
+def compact(store: CardStore, df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Fold every stored edit into a copy of the cards df, e.g. to write a new base pickle offline
+    @param store: CardStore
+    @param df: pd.DataFrame
+    @return: pd.DataFrame
+    """
+    store.manifest_version = None
+    store.sync()
+    return store.apply(df.copy())
@@ -0,0 +1,40 @@
+"""
+matplotlib's "Blues" colormap as 256 hex colours, so the app doesn't import matplotlib to highlight the MARC table
+Generated with:
+    from matplotlib import colormaps
+    ["#{:02x}{:02x}{:02x}".format(*colormaps["Blues"](i / 256, bytes=True)[:3]) for i in range(256)]
+"""
+BLUES = (
+    "#f7fbff", "#f6fafe", "#f5f9fe", "#f4f9fe", "#f3f8fd", "#f3f8fd", "#f2f7fd", "#f1f7fd",
+    "#f0f6fc", "#eff6fc", "#eff5fc", "#eef5fc", "#edf4fb", "#ecf4fb", "#ecf3fb", "#ebf3fb",
+    "#eaf2fa", "#e9f2fa", "#e8f1fa", "#e8f1fa", "#e7f0f9", "#e6f0f9", "#e5eff9", "#e4eff9",
+    "#e4eef8", "#e3eef8", "#e2edf8", "#e1edf8", "#e1ecf7", "#e0ecf7", "#dfebf7", "#deebf7",
+    "#ddeaf6", "#ddeaf6", "#dce9f6", "#dbe9f6", "#dae8f5", "#dae8f5", "#d9e7f5", "#d8e7f5",
+    "#d7e6f4", "#d7e6f4", "#d6e5f4", "#d5e5f4", "#d4e4f3", "#d4e4f3", "#d3e3f3", "#d2e3f3",
+    "#d1e2f2", "#d1e2f2", "#d0e1f2", "#cfe1f2", "#cee0f1", "#cee0f1", "#cddff1", "#ccdff1",
+    "#cbdef0", "#cbdef0", "#caddf0", "#c9ddf0", "#c8dcef", "#c8dcef", "#c7dbef", "#c6dbef",
+    "#c5daee", "#c4daee", "#c3d9ee", "#c1d9ed", "#c0d8ed", "#bfd8ec", "#bed7ec", "#bcd7eb",
+    "#bbd6eb", "#bad6ea", "#b9d5ea", "#b7d4ea", "#b6d4e9", "#b5d3e9", "#b4d3e8", "#b2d2e8",
+    "#b1d2e7", "#b0d1e7", "#afd1e6", "#add0e6", "#acd0e6", "#abcfe5", "#aacfe5", "#a8cee4",
+    "#a7cee4", "#a6cde3", "#a5cde3", "#a3cce3", "#a2cbe2", "#a1cbe2", "#a0cae1", "#9ecae1",
+    "#9dc9e0", "#9bc8e0", "#9ac7e0", "#98c7df", "#97c6df", "#95c5df", "#93c4de", "#92c3de",
+    "#90c2de", "#8fc1dd", "#8dc0dd", "#8bc0dd", "#8abfdc", "#88bedc", "#87bddc", "#85bcdb",
+    "#83bbdb", "#82badb", "#80b9da", "#7fb8da", "#7db8d9", "#7bb7d9", "#7ab6d9", "#78b5d8",
+    "#77b4d8", "#75b3d8", "#73b2d7", "#72b1d7", "#70b1d7", "#6fb0d6", "#6dafd6", "#6baed6",
+    "#6aadd5", "#69acd5", "#67abd4", "#66aad4", "#65aad3", "#63a9d3", "#62a8d2", "#61a7d2",
+    "#60a6d1", "#5ea5d1", "#5da4d0", "#5ca3d0", "#5aa3cf", "#59a2cf", "#58a1ce", "#57a0ce",
+    "#559fcd", "#549ecd", "#539dcc", "#519ccc", "#509bcb", "#4f9bcb", "#4e9aca", "#4c99ca",
+    "#4b98c9", "#4a97c9", "#4896c8", "#4795c8", "#4694c7", "#4594c7", "#4393c6", "#4292c6",
+    "#4191c5", "#4090c5", "#3f8fc4", "#3e8ec4", "#3d8dc3", "#3c8cc3", "#3b8bc2", "#3a8ac1",
+    "#3989c1", "#3888c0", "#3787c0", "#3585bf", "#3484bf", "#3383be", "#3282be", "#3181bd",
+    "#3080bd", "#2f7fbc", "#2e7ebc", "#2d7dbb", "#2c7cbb", "#2b7bba", "#2a7ab9", "#2979b9",
+    "#2878b8", "#2777b8", "#2676b7", "#2575b7", "#2474b6", "#2373b6", "#2272b5", "#2171b5",
+    "#2070b4", "#1f6fb3", "#1e6eb2", "#1e6db2", "#1d6cb1", "#1c6bb0", "#1b6aaf", "#1a69ae",
+    "#1a68ae", "#1967ad", "#1866ac", "#1765ab", "#1764ab", "#1663aa", "#1562a9", "#1461a8",
+    "#1360a7", "#135fa7", "#125ea6", "#115da5", "#105ca4", "#0f5ba3", "#0f5aa3", "#0e59a2",
+    "#0d58a1", "#0c57a0", "#0c56a0", "#0b559f", "#0a549e", "#09539d", "#08529c", "#08519c",
+    "#08509a", "#084f99", "#084e97", "#084c96", "#084b94", "#084a92", "#084991", "#08488f",
+    "#08478e", "#08468c", "#08458b", "#084489", "#084388", "#084286", "#084185", "#084083",
+    "#083f82", "#083e80", "#083d7e", "#083c7d", "#083b7b", "#083a7a", "#083978", "#083877",
+    "#083775", "#083674", "#083572", "#083471", "#08336f", "#08326e", "#08316c", "#08306b",
+)
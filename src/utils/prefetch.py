@@ -0,0 +1,60 @@
+"""
+Bounded cache of values built in a background thread before they're asked for
+Used to build the next cards' views while a reviewer is still reading the current card.
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable
+
+
+class PrefetchCache:
+    def __init__(self, build: Callable, max_size: int = 8, n_workers: int = 1):
+        """
+        @param build: Callable, builds the value for a key from the args given to get/prefetch
+        @param max_size: int, least recently used values are dropped beyond this
+        @param n_workers: int, background threads
+        """
+        self.build = build
+        self.max_size = max_size
+        self.futures = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="prefetch")
+
+    def _future(self, key: Hashable, args: tuple) -> Future:
+        with self.lock:
+            if key in self.futures:
+                self.futures.move_to_end(key)
+                return self.futures[key]
+            future = self.executor.submit(self.build, *args)
+            self.futures[key] = future
+            while len(self.futures) > self.max_size:
+                _, evicted = self.futures.popitem(last=False)
+                evicted.cancel()  # no-op if it's already running
+            return future
+
+    def prefetch(self, key: Hashable, *args) -> None:
+        """
+        Start building the value for key in the background if it isn't cached
+        """
+        self._future(key, args)
+
+    def get(self, key: Hashable, *args) -> Any:
+        """
+        Value for key, waiting for a prefetch in progress or building it now if it wasn't prefetched
+        A build that failed in the background raises here
+        """
+        future = self._future(key, args)
+        if not future.running() and future.cancel():  # still queued behind other prefetches, don't wait for them
+            with self.lock:
+                self.futures.pop(key, None)
+            value = self.build(*args)
+            future = Future()
+            future.set_result(value)
+            with self.lock:
+                self.futures[key] = future
+        return future.result()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.futures
@@ -0,0 +1,189 @@
+"""
+Append-only store of Worldcat fetch results the review app reads while the fetch is still running
+Cards are written as they complete, a few at a time, in immutable parts beside the cards pickle:
+    {root}/parts/{first card:08d}_{n cards}.p   <- pickled list of card rows, in the order they completed
+    {root}/parts/complete                       <- written once the fetch has finished
+A part is written under a temporary name and renamed once complete so a reader never sees half a part,
+and a crash only loses the cards not yet flushed. A card's index is its position in the store so edits
+saved in the app (see CardStore) stay with the right card as more arrive.
+"""
+import pickle
+import posixpath
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import fsspec
+import pandas as pd
+
+RESULT_FLUSH_ROWS = 20
+RESULT_FLUSH_SECONDS = 10.0  # flush sooner if cards are arriving slowly
+RESULT_POLL_SECONDS = 5.0
+RESULT_COMPLETE_POLL_SECONDS = 60.0  # a finished fetch can be resumed, which removes the complete marker
+
+
+def sink_root(save_file: str) -> str:
+    """
+    Results for a cards pickle are stored next to it, e.g. cac-bucket/chinese_matches.p -> cac-bucket/chinese_matches_results
+    @param save_file: str
+    @return: str
+    """
+    return posixpath.splitext(str(save_file).replace("\\", "/"))[0] + "_results"
+
+
+def part_start(path: str) -> int:
+    return int(posixpath.basename(path).split("_")[0])
+
+
+def part_end(path: str) -> int:
+    start, n = posixpath.splitext(posixpath.basename(path))[0].split("_")
+    return int(start) + int(n)
+
+
+class ResultSink:
+    """
+    Written to by one fetch at a time, a fetch resumed after a crash carries on after the cards already stored
+    """
+    def __init__(self, fs: fsspec.AbstractFileSystem, root: str, flush_rows: int = RESULT_FLUSH_ROWS,
+                 flush_seconds: float = RESULT_FLUSH_SECONDS):
+        """
+        @param fs: fsspec.AbstractFileSystem
+        @param root: str, see sink_root
+        @param flush_rows: int, cards per part
+        @param flush_seconds: float, a part is written once its first card has waited this long
+        """
+        self.fs = fs
+        self.root = root
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer = []
+        self.timer = None  # flushes a part flush_seconds after its first card, however slowly the rest arrive
+        self.lock = threading.Lock()
+        self.fs.makedirs(self.parts_dir, exist_ok=True)
+        if self.fs.exists(self.complete_path):  # resuming a finished fetch, readers need to poll again
+            self.fs.rm(self.complete_path)
+        self.n_cards = max((part_end(x) for x in self.fs.glob(posixpath.join(self.parts_dir, "*.p"))), default=0)
+
+    @property
+    def parts_dir(self) -> str:
+        return posixpath.join(self.root, "parts")
+
+    @property
+    def complete_path(self) -> str:
+        return posixpath.join(self.parts_dir, "complete")
+
+    def stored(self) -> pd.DataFrame:
+        """
+        Cards already in the store, e.g. so a resumed fetch can skip them
+        @return: pd.DataFrame
+        """
+        return ResultReader(self.fs, self.root, poll_seconds=0).refresh()
+
+    def add(self, row: Dict) -> None:
+        """
+        Queue a completed card, flushed once flush_rows are waiting or the oldest has waited flush_seconds
+        @param row: Dict, the card's columns, simple_id is set here
+        """
+        with self.lock:
+            self.buffer.append({**row, "simple_id": self.n_cards + len(self.buffer) + 1})
+            if len(self.buffer) >= self.flush_rows or self.flush_seconds <= 0:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.flush_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+        path = posixpath.join(self.parts_dir, f"{self.n_cards:08d}_{len(self.buffer)}.p")
+        with self.fs.open(path + ".tmp", "wb") as f:
+            pickle.dump(self.buffer, f)
+        self.fs.mv(path + ".tmp", path)
+        self.n_cards += len(self.buffer)
+        self.buffer = []
+
+    def close(self, complete: bool = True) -> None:
+        """
+        @param complete: bool, mark the fetch as finished so readers stop polling
+        """
+        self.flush()
+        if complete:
+            self.fs.pipe_file(self.complete_path, b"")
+
+
+class ResultReader:
+    """
+    One per app process, shared by every session, reads each part once
+    """
+    def __init__(self, fs: fsspec.AbstractFileSystem, root: str, prepare: Optional[Callable] = None,
+                 poll_seconds: float = RESULT_POLL_SECONDS, complete_poll_seconds: float = RESULT_COMPLETE_POLL_SECONDS):
+        """
+        @param fs: fsspec.AbstractFileSystem
+        @param root: str, see sink_root
+        @param prepare: Optional[Callable], applied to the cards df each time new cards arrive, e.g. prepare_cards
+        @param poll_seconds: float, the store is listed at most this often
+        @param complete_poll_seconds: float, how often the store is listed once the fetch has finished
+        """
+        self.fs = fs
+        self.root = root
+        self.prepare = prepare
+        self.poll_seconds = poll_seconds
+        self.complete_poll_seconds = complete_poll_seconds
+        self.rows = []
+        self.cards = None
+        self.complete = False
+        self.last_poll = None
+        self.lock = threading.Lock()
+
+    @property
+    def parts_dir(self) -> str:
+        return posixpath.join(self.root, "parts")
+
+    def new_rows(self) -> List[Dict]:
+        """
+        Rows in parts not read yet, parts are taken in order and stop at a gap
+        """
+        self.fs.invalidate_cache(self.parts_dir)  # s3fs would otherwise answer from its listings cache
+        try:
+            paths = self.fs.ls(self.parts_dir, detail=False)
+        except FileNotFoundError:
+            return []
+        self.complete = any(posixpath.basename(x) == "complete" for x in paths)
+        rows = []
+        for path in sorted((x for x in paths if x.endswith(".p")), key=part_start):
+            if part_start(path) < len(self.rows) + len(rows):
+                continue
+            if part_start(path) > len(self.rows) + len(rows):
+                break
+            with self.fs.open(path, "rb") as f:
+                rows.extend(pickle.load(f))
+        return rows
+
+    def refresh(self) -> pd.DataFrame:
+        """
+        The cards stored so far, the store is only listed if poll_seconds have passed since it last was,
+        or complete_poll_seconds once the fetch has finished in case it's resumed
+        @return: pd.DataFrame, indexed by position in the store
+        """
+        with self.lock:
+            interval = self.complete_poll_seconds if self.complete else self.poll_seconds
+            due = self.last_poll is None or time.monotonic() - self.last_poll >= interval
+            if due:
+                self.last_poll = time.monotonic()
+                rows = self.new_rows()
+                if rows or self.cards is None:
+                    self.rows.extend(rows)
+                    cards = pd.DataFrame(self.rows, index=pd.RangeIndex(len(self.rows)))
+                    self.cards = self.prepare(cards) if self.prepare and self.rows else cards
+            return self.cards
+
+    def __len__(self) -> int:
+        return len(self.rows)
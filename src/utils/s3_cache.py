@@ -0,0 +1,110 @@
+"""
+Local disk mirror of S3 objects, validated by ETag
+A cached copy is used as long as the object's ETag (one HEAD request) hasn't changed, so a container
+restart or a reload doesn't download the cards pickle again unless it has been rewritten.
+Objects larger than a part are downloaded with parallel ranged GETs into a temporary file that replaces
+the cached copy once complete.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import fsspec
+
+S3_CACHE_DIR = os.path.join("data", "s3_cache")
+PART_SIZE = 8 * 1024 * 1024
+N_WORKERS = 8
+DOWNLOAD_RETRIES = 3
+
+
+def object_tag(info: Dict) -> str:
+    """
+    ETag on S3, mtime/size for filesystems without one
+    @param info: Dict, fs.info of the object
+    @return: str
+    """
+    return str(info.get("ETag") or (info.get("mtime"), info.get("size")))
+
+
+def cache_paths(cache_dir: str, path: str):
+    """
+    Data and metadata files for an object, named by a hash of its path
+    """
+    name = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, name), os.path.join(cache_dir, name + ".json")
+
+
+def read_meta(meta_path: str) -> Optional[Dict]:
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def download_ranged(fs: fsspec.AbstractFileSystem, path: str, size: int, out_path: str,
+                    part_size: int = PART_SIZE, n_workers: int = N_WORKERS) -> None:
+    """
+    Download an object in part_size ranges on n_workers threads, each part written at its offset
+    @param fs: fsspec.AbstractFileSystem
+    @param path: str
+    @param size: int, object size in bytes
+    @param out_path: str
+    @param part_size: int
+    @param n_workers: int
+    @return: None
+    """
+    with open(out_path, "wb") as f:
+        f.truncate(size)
+
+    def fetch(start):
+        data = fs.cat_file(path, start=start, end=min(start + part_size, size))
+        with open(out_path, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(fetch, range(0, size, part_size)))  # list to raise any part's error
+
+
+def cached_path(fs: fsspec.AbstractFileSystem, path: str, cache_dir: str = S3_CACHE_DIR,
+                part_size: int = PART_SIZE, n_workers: int = N_WORKERS) -> str:
+    """
+    Local copy of an object, only downloaded if the cached copy is missing or its ETag has changed
+    @param fs: fsspec.AbstractFileSystem, usually s3fs.S3FileSystem
+    @param path: str
+    @param cache_dir: str
+    @param part_size: int, objects larger than this are downloaded with parallel ranged GETs
+    @param n_workers: int
+    @return: str, path to the local copy
+    @raise RuntimeError: if the object keeps changing while it's downloaded
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path, meta_path = cache_paths(cache_dir, path)
+
+    info = fs.info(path, refresh=True)  # s3fs would otherwise answer from its listings cache
+    for _ in range(DOWNLOAD_RETRIES):
+        tag = object_tag(info)
+        meta = read_meta(meta_path)
+        if meta and meta["tag"] == tag and os.path.exists(data_path) and os.path.getsize(data_path) == info["size"]:
+            return data_path
+
+        tmp_path = f"{data_path}.{os.getpid()}.tmp"
+        if info["size"] > part_size:
+            download_ranged(fs, path, info["size"], tmp_path, part_size, n_workers)
+        else:
+            fs.get_file(path, tmp_path)
+
+        # Ranged GETs could mix two versions if the object was rewritten mid download
+        info = fs.info(path, refresh=True)
+        if object_tag(info) != tag:
+            os.remove(tmp_path)
+            continue
+        os.replace(tmp_path, data_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"path": path, "tag": tag, "size": info["size"]}, f)
+        return data_path
+
+    raise RuntimeError(f"{path} changed during each of {DOWNLOAD_RETRIES} download attempts")
@@ -1,53 +1,207 @@
 import pickle
 import re
-from typing import Dict, List, Union
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
 
-from matplotlib import colormaps
+import fsspec
 import numpy as np
 import pandas as pd
 import streamlit as st
-from st_aggrid import GridOptionsBuilder, JsCode, AgGrid
-import s3fs
 from pymarc import Record
 
+from src.docs import doc_strings as docs
+from src.data.bib_extraction import cluster_cards
+from src.utils.card_store import CARD_FIELDS, CardStore
+from src.utils.palette import BLUES
+from src.utils.prefetch import PrefetchCache
+from src.utils.result_sink import ResultReader, sink_root
+from src.utils.s3_cache import cached_path
+from src.utils.work_queue import LeaseQueue
+from src.utils.write_behind import WriteBehind
 
-@st.cache_data
-def load_s3(_s3: s3fs.S3FileSystem, s3_path: str):
-    with _s3.open(s3_path, 'rb') as f:
+# st_aggrid and s3fs are slow to import so are only imported once they're needed, keeping the app's cold start fast
+if TYPE_CHECKING:
+    import s3fs
+    from st_aggrid import JsCode
+
+
+@st.cache_resource
+def get_s3() -> "s3fs.S3FileSystem":
+    import s3fs
+    return s3fs.S3FileSystem(anon=False)
+
+
+def load_s3(s3: "s3fs.S3FileSystem", s3_path: str) -> pd.DataFrame:
+    """
+    Load a pickle from S3 through the local disk mirror, only downloaded if its ETag has changed
+    @param s3: s3fs.S3FileSystem
+    @param s3_path: str
+    @return: pd.DataFrame
+    """
+    with open(cached_path(s3, s3_path), 'rb') as f:
         df = pickle.load(f)
     return df
 
 
-def get_pub_date(record: Record) -> int:
-    # Look for a date in first 260$c, if absent include in search anyway
-    f260 = record.get_fields("260")
-    c_subfields = []
-    for x in f260:
-        c_subfields.extend(x.get_subfields("c"))
-    re_260c = re.compile(r"[0-9]{4}")
-    if c_subfields:
-        match = re_260c.search(c_subfields[0])
-        if match:
-            return int(match.group())
-        else:
-            return -9999
+# Brief bibs aren't used by the app, worldcat_matches has the full records
+UNUSED_COLUMNS = ["brief_bibs"]
+# Stored as arrow strings in one buffer per column rather than a python str object per cell
+TEXT_COLUMNS = ["xml", "title", "author", "isbn"]
+
+
+def prepare_cards(cards_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compact copy of the cards pickle with the columns the app derives from it, done once for every session
+    @param cards_df: pd.DataFrame, not modified
+    @return: pd.DataFrame
+    """
+    df = cards_df.drop(columns=[x for x in UNUSED_COLUMNS if x in cards_df])
+    df["author"] = df["author"].fillna("")
+    # Copies/volumes of the same work are reviewed once, the selection is saved to every card in the cluster
+    if "cluster_id" not in df:
+        df["cluster_id"] = cluster_cards(df)
+    for col in TEXT_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype("string[pyarrow]")
+    return df
+
+
+@st.cache_resource
+def load_cards(save_file: str, local: bool) -> pd.DataFrame:
+    """
+    Cards shared by every session in the app process, read only, see session_cards
+    @param save_file: str, local path or s3 key
+    @param local: bool
+    @return: pd.DataFrame
+    """
+    if local:
+        with open(save_file, "rb") as f:
+            cards_df = pickle.load(f)
     else:
-        return -9999
+        cards_df = load_s3(get_s3(), save_file)
+    return prepare_cards(cards_df)
+
+
+@st.cache_resource
+def load_result_reader(save_file: str, local: bool) -> Optional[ResultReader]:
+    """
+    Reader for the cards of a Worldcat fetch still writing to save_file's result sink, shared by every session
+    @param save_file: str, local path or s3 key
+    @param local: bool
+    @return: Optional[ResultReader], None if the cards pickle exists or nothing has been fetched into a sink
+    """
+    fs = fsspec.filesystem("file") if local else get_s3()
+    if fs.exists(save_file) or not fs.exists(sink_root(save_file)):
+        return None
+    return ResultReader(fs, sink_root(save_file), prepare=prepare_cards)
+
 
+def session_cards(shared_cards: pd.DataFrame, store: Union[CardStore, WriteBehind]) -> pd.DataFrame:
+    """
+    A session's view of the shared cards with its card store's edits, and any still being saved, overlaid
+    The frame shares every column with shared_cards except the editable CARD_FIELDS, which are copied
+    (an array of references each) so save_card can update them without touching the shared cards.
+    The view only lives for a rerun, between reruns a session only holds its CardStore,
+    so memory grows with the number of edits rather than the number of sessions.
+    @param shared_cards: pd.DataFrame, see load_cards
+    @param store: Union[CardStore, WriteBehind], synced
+    @return: pd.DataFrame
+    """
+    df = shared_cards.copy(deep=False)
+    for field in CARD_FIELDS:
+        df[field] = shared_cards[field].copy() if field in shared_cards else None
+    return store.apply(df)
 
-def get_008_date(record: Record) -> str:
+
+@st.cache_resource
+def load_work_queue(save_file: str, _card_ids: List) -> LeaseQueue:
+    """
+    One lease queue per cards file shared by every session in the app process
+    @param save_file: str, cache key
+    @param _card_ids: List, unmatched cards in the order to hand them out, not hashed
+    @return: LeaseQueue
     """
-    Slice the date from the correct chunk of the 008 field based on the 6th character ("Type of Date")
+    return LeaseQueue(_card_ids)
+
+
+# 008/06 type of date: date1 alone, or date1-date2 as a range
+SINGLE_DATE_TYPES = "serpt"
+RANGE_DATE_TYPES = "qmikcdu"
+YEAR_REGEX = re.compile(r"[0-9]{4}")
+
+
+def parse_008_year(year: str, fill: str) -> Optional[int]:
+    """
+    Parse a year from the 008, unknown digits (u) are filled, so 197u is 1970 for a start or 1979 for an end
+    @param year: str, 4 chars
+    @param fill: str, "0" or "9"
+    @return: Optional[int]
+    """
+    if len(year) != 4 or year == "uuuu" or not all(c.isdigit() or c == "u" for c in year):
+        return None
+    return int(year.replace("u", fill))
+
+
+def get_008_date_range(record: Record) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Publication start/end years from the 008 date type (06) and date1/date2 (07-10/11-14)
+    A date2 of 9999 (still being published) is kept so open ranges overlap any later year
     @param record: pymarc.Record
-    @return: str
+    @return: Tuple[Optional[int], Optional[int]]
     """
-    f008 = record.get_fields("008")[0].data
-    date_type = f008[6]
-    date_map = {
-        's': slice(7, 11), 'r': slice(7, 11), 'q': slice(7, 15), 'n': slice(0, 0), 'm': slice(7, 15),
-        'c': slice(7, 15), 't': slice(7, 11), 'd': slice(7, 15), 'e': slice(7, 11), 'i': slice(7, 15)
-    }
-    return f008[date_map[date_type]]
+    f008 = record.get_fields("008")
+    if not f008 or len(f008[0].data) < 15:
+        return None, None
+    data = f008[0].data
+    date_type, date1, date2 = data[6], data[7:11], data[11:15]
+
+    start = parse_008_year(date1, "0")
+    if date_type not in SINGLE_DATE_TYPES + RANGE_DATE_TYPES or start is None:
+        return None, None
+    end = parse_008_year(date2, "9") if date_type in RANGE_DATE_TYPES else None
+    if end is None or end < start:
+        end = parse_008_year(date1, "9")
+    return start, end
+
+
+def get_pub_date_range(record: Record) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Publication start/end years from the 008, falling back to years in 264$c then 260$c
+    @param record: pymarc.Record
+    @return: Tuple[Optional[int], Optional[int]], (None, None) if there's no date
+    """
+    start, end = get_008_date_range(record)
+    if start is not None:
+        return start, end
+
+    for field in record.get_fields("264", "260"):
+        years = [int(x) for c in field.get_subfields("c") for x in YEAR_REGEX.findall(c)]
+        if years:
+            return min(years), max(years)
+    return None, None
+
+
+def filter_pub_date(record_df: pd.DataFrame, start: int, end: int) -> np.ndarray:
+    """
+    Records whose publication date range overlaps [start, end], records without a date are kept
+    @param record_df: pd.DataFrame, with publication_start/end cols from create_filter_columns
+    @param start: int
+    @param end: int
+    @return: np.ndarray[bool]
+    """
+    pub_start = record_df["publication_start"].to_numpy(dtype="float64", na_value=np.nan)
+    pub_end = record_df["publication_end"].to_numpy(dtype="float64", na_value=np.nan)
+    return np.isnan(pub_start) | ((pub_start <= end) & (pub_end >= start))
+
+
+def pub_years(record_df: pd.DataFrame) -> np.ndarray:
+    """
+    Distinct start/end years for the date slider, open ended ranges (9999) excluded
+    @param record_df: pd.DataFrame
+    @return: np.ndarray[int]
+    """
+    years = pd.concat([record_df["publication_start"], record_df["publication_end"]]).dropna()
+    return np.unique(years[years < 9999].to_numpy(dtype=int))
 
 
 def pretty_filter_option(option: str) -> str:
@@ -93,34 +247,53 @@ def gen_unique_idx(df: pd.DataFrame) -> pd.DataFrame:
     return out_df.set_index("Repeat Field ID", append=True)
 
 
-def add_subfield_rpt(df, field, split_chr, split_idx):
-    repeat_id = [str(x) for x in range(len(df.loc[field:field]))]
-    if repeat_id == ["0"]:  # TODO not assinging the subfield correctly for fields with only one repeat
-        df.loc[field, "Subfield":"Subfield"] = df.loc[field, df.columns[0]:df.columns[0]].str.split(split_chr).transform(lambda x: x[split_idx])
-    else:
-        df.loc[field, "Subfield":"Subfield"] = df.loc[field, df.columns[0]].str.split(split_chr).transform(lambda x: x[split_idx])
-    df.loc[field, "Rpt":"Rpt"] = repeat_id
+ALIGNED_FIELDS = r"^(6\d\d|880)$"
 
 
-def gen_sf_rpt_unique_idx(df: pd.DataFrame) -> pd.DataFrame:
+def marc_fields_long(records: pd.Series) -> pd.DataFrame:
     """
-    Generate a unique index from one that contains repeated fields
-    @param df: pd.DataFrame
-    @return: pd.DataFrame
+    Every field of every record as one row, the input for align_marc_table
+    @param records: pd.Series, pymarc.Record indexed by record id
+    @return: pd.DataFrame, cols record, Field, value
     """
-    out_df = df.copy()
-    out_df["Subfield"] = ""
-    out_df["Rpt"] = ""
-    dup_idx = out_df.index[out_df.index.duplicated()].unique()
-    unhandled_fields = [x for x in dup_idx if x not in ["500", "650", "880"]]
+    rows = []
+    for record_id, record in records.items():
+        rows.append((record_id, "LDR", str(record.leader)))
+        rows.extend((record_id, x.tag, x.__str__()[6:]) for x in record.get_fields())
+    return pd.DataFrame(rows, columns=["record", "Field", "value"])
 
-    for field, split_chr, split_idx in zip(["500", "650", "880"], ["$", "$", "$"], [0, 0, 1]):
-        if field in out_df.index:
-            add_subfield_rpt(out_df, field, split_chr, split_idx)
-    for dup in unhandled_fields:
-        out_df.loc[dup, "Rpt"] = [str(x) for x in range(len(out_df.loc[dup]))]
 
-    return out_df.set_index(["Subfield", "Rpt"], append=True)
+def align_marc_table(marc_long: pd.DataFrame, record_ids: List[int], aligned_fields: str = ALIGNED_FIELDS) -> pd.DataFrame:
+    """
+    MARC table where identical values of aligned fields (6xx and 880 by default) share a row across records
+    so matching subject headings line up. Other repeated fields are numbered by position within each record.
+    Replaces the per-column merges of gen_sf_rpt_unique_idx/simplify_6xx with one grouped pass.
+    @param marc_long: pd.DataFrame, from marc_fields_long
+    @param record_ids: List[int], records to include, in column order
+    @param aligned_fields: str, regex of fields to align on value
+    @return: pd.DataFrame, index (Field, Repeat Field ID) as from gen_unique_idx, one col per record
+    """
+    long = marc_long[marc_long["record"].isin(record_ids)].copy()
+    aligned = long["Field"].str.match(aligned_fields)
+
+    # repeats of the same value in a record need their own row
+    occurrence = long.groupby(["record", "Field", "value"], sort=False).cumcount()
+    position = long.groupby(["record", "Field"], sort=False).cumcount()
+    long["key"] = np.where(aligned, long["value"] + "\x00" + occurrence.astype(str), position.astype(str))
+
+    # one row per distinct key in order of first appearance within a field
+    rows = long.drop_duplicates(["Field", "key"])[["Field", "key"]].copy()
+    rows["rpt"] = rows.groupby("Field", sort=False).cumcount()
+    n_rows = rows.groupby("Field", sort=False)["rpt"].transform("size")
+    rows["Repeat Field ID"] = np.where(n_rows > 1, rows["rpt"].astype(str), "")
+    rows["field_order"] = [0 if x == "LDR" else int(x) for x in rows["Field"]]
+    rows = rows.sort_values(["field_order", "rpt"], kind="stable")
+
+    long = long.merge(rows[["Field", "key", "Repeat Field ID"]], on=["Field", "key"])
+    table = long.pivot(index=["Field", "Repeat Field ID"], columns="record", values="value")
+    table = table.reindex(index=pd.MultiIndex.from_frame(rows[["Field", "Repeat Field ID"]]), columns=record_ids)
+    table.columns.name = None
+    return table
 
 
 def sort_fields_idx(index: pd.Index) -> pd.Index:
@@ -137,59 +310,6 @@ def sort_fields_idx(index: pd.Index) -> pd.Index:
         return pd.Index(key)
 
 
-def sort_sf_rpt_fields_idx(index):
-    if index.name == "Field":
-        key = [0 if x == "LDR" else int(x) for x in index]
-        return pd.Index(key)
-    elif index.name == "Subfield":
-        key = [x.split("$")[1] if "$" in x else x for x in index]
-        return pd.Index(key)
-    elif index.name == "Rpt":
-        return index
-
-
-def simplify_6xx(df: pd.DataFrame) -> pd.DataFrame:
-    """
-    Pandas magic
-    Arbitrarily assinging repeat_id vals to repeat fields in records means common field values are not matched to each other
-    Get round this by reindexing on an index of all unique values for a subfield
-    Set the values for the reindexed subfield to the newly reindexed one.
-    If there has been reordering this leaves rows of NA at the end of the subfield that can be dropped
-    """
-    if df.shape[1] == 1:
-        return df
-    elif "650" not in df.index:
-        return df
-
-    tidy_df = df.copy()
-    subfields = tidy_df.loc["650"].index.get_level_values(0).unique()
-    for sf in subfields:
-        sf_orig = tidy_df.loc[("650", sf), :]
-        sf_unique_vals = pd.Series(sf_orig.values.flatten()).dropna().unique()
-        if len(sf_orig) < len(sf_unique_vals):
-            continue
-        sf_unique_df = pd.DataFrame(data=sf_unique_vals, columns=pd.Index(["unique_vals"]))
-        for x in sf_orig.columns:
-            sf_unique_df = sf_unique_df.merge(sf_orig[x], how="left", left_on="unique_vals", right_on=x)
-        replacement_df = sf_unique_df.set_index(sf_orig.index[:len(sf_unique_df)]).reindex(sf_orig.index).drop(
-            columns="unique_vals")
-        replacement_df["Field"] = "650"
-        replacement_df["Subfield"] = sf
-        replacement_df = replacement_df.set_index(["Field", "Subfield"], append=True).reorder_levels([1, 2, 0])
-        if not replacement_df.reset_index(drop=True).equals(sf_orig.reset_index(drop=True)):
-            tidy_df.loc[("650", sf), :] = replacement_df
-        else:  # No overlapping terms so flatten naively
-            sf_orig_blank_idx = sf_orig.reset_index(drop=True)
-            blank_idx_df = sf_orig.reset_index().drop(columns=sf_orig.columns)
-            for x in sf_orig_blank_idx.columns:
-                blank_idx_df = blank_idx_df.join(sf_orig_blank_idx[x].dropna().reset_index(drop=True))
-            blank_idx_df["Field"] = "650"
-            blank_idx_df["Subfield"] = sf
-            replacement_df = blank_idx_df.set_index(["Field", "Subfield", "Rpt"])
-            tidy_df.loc[("650", sf), :] = replacement_df
-    return tidy_df
-
-
 def filter_on_generic_fields(
         marc_df: pd.DataFrame,
         fields: Union[None, List[str]],
@@ -233,7 +353,7 @@ def create_filter_columns(record_df: pd.DataFrame, lang_dict: Dict[str, str], se
     has_phys_desc: has a 300 field
     good_encoding_level: 17th char in leader not one of 3, 5, 7
     record_length: total fields in record
-    publication_date:
+    publication_start/publication_end: years from the 008, or 264/260$c if it has no dates, NA if undated
     @param record_df: pd.DataFrame
     @param lang_dict: Dict[str,str]
     @param search_au: str
@@ -263,11 +383,81 @@ def create_filter_columns(record_df: pd.DataFrame, lang_dict: Dict[str, str], se
     record_df["has_phys_desc"] = record_df["record"].apply(lambda x: bool(x.get_fields("300")))
     record_df["good_encoding_level"] = record_df["record"].apply(lambda x: x.leader[17] not in [3, 5, 7])
     record_df["record_length"] = record_df["record"].apply(lambda x: len(x.get_fields()))
-    record_df["publication_date"] = record_df["record"].apply(lambda x: get_pub_date(x))
+    dates = [get_pub_date_range(x) for x in record_df["record"]]
+    record_df["publication_start"] = pd.array([x[0] for x in dates], dtype="Int64")
+    record_df["publication_end"] = pd.array([x[1] for x in dates], dtype="Int64")
 
     return record_df
 
 
+def format_record(record: Record, record_id: int) -> pd.DataFrame:
+    """
+    One record as a column of field strings for the MARC table, indexed by field and repeat field id
+    @param record: pymarc.Record
+    @param record_id: int, column name
+    @return: pd.DataFrame
+    """
+    res = record.get_fields()
+    col = pd.DataFrame(
+        index=pd.Index(["LDR"] + [x.tag for x in res], name="Field"),
+        data=[record.leader] + [x.__str__()[6:] for x in res],
+        columns=[record_id]
+    )
+    return gen_unique_idx(col)
+
+
+def build_card_view(records: List[Record], lang_dict: Dict[str, str], search_au: str) -> Dict:
+    """
+    Everything shown for a card that doesn't depend on the filters chosen, so it can be built ahead of time
+    @param records: List[pymarc.Record], the card's worldcat_matches
+    @param lang_dict: Dict[str, str]
+    @param search_au: str
+    @return: Dict, match_df with filter columns, all_marc_fields, all_languages, pub_years, formatted_records {id: MARC column}
+    and marc_long for align_marc_table
+    """
+    match_df = pd.DataFrame({"record": list(records)})
+    match_df = create_filter_columns(match_df, lang_dict, search_au)
+    return {
+        "match_df": match_df,
+        "all_marc_fields": sorted(list(set(match_df["record"].apply(lambda x: [y.tag for y in x.get_fields()]).sum()))),
+        "all_languages": match_df["language"].unique(),
+        "pub_years": pub_years(match_df),
+        "formatted_records": {i: format_record(record, i) for i, record in match_df["record"].items()},
+        "marc_long": marc_fields_long(match_df["record"])
+    }
+
+
+def card_view_args(cards_df: pd.DataFrame, card_idx: int, lang_dict: Dict[str, str]) -> tuple:
+    author = cards_df.loc[card_idx, "author"]
+    search_au = author.replace(" ", "+") if isinstance(author, str) else ""
+    return cards_df.loc[card_idx, "worldcat_matches"], lang_dict, search_au
+
+
+@st.cache_resource
+def load_card_view_cache(save_file: str) -> PrefetchCache:
+    """
+    Card views shared by every session, built in the background for the cards reviewers are likely to open next
+    @param save_file: str, cache key
+    @return: PrefetchCache
+    """
+    return PrefetchCache(build_card_view, max_size=16)
+
+
+def differing_rows(marc_df: pd.DataFrame) -> np.ndarray:
+    """
+    Rows of the MARC table where the displayed records don't all have the same value, a missing field counts as a value
+    Vectorised over the whole table by comparing every record column with the first
+    With fewer than two records every row is kept
+    @param marc_df: pd.DataFrame, one column per record
+    @return: np.ndarray[bool]
+    """
+    values = marc_df.to_numpy(dtype=object)
+    if values.shape[1] < 2:
+        return np.ones(len(marc_df), dtype=bool)
+    values = np.where(pd.isna(values), "", values)
+    return (values != values[:, :1]).any(axis=1)
+
+
 def gen_gmap(row: pd.Series) -> pd.Series:
     """
     Map a row of values to a row of colours
@@ -296,12 +486,13 @@ def new_line(s):
     return f"\n{s.group()} "
 
 
-def gen_js(colour_mapping: Dict[str, str] = None) -> Union[Dict[str, str], JsCode]:
+def gen_js(colour_mapping: Dict[str, str] = None) -> Union[Dict[str, str], "JsCode"]:
     """
     Generate a string that can be parsed by AG-Grid as a JS fn
     @param colour_mapping: Dict[str, str]
     @return: Dict[str, str]|streamlit-aggrid.JsCode
     """
+    from st_aggrid import JsCode
 
     if not colour_mapping:
         return {'wordBreak': 'normal', 'whiteSpace': 'pre'}
@@ -345,15 +536,11 @@ def gen_js(colour_mapping: Dict[str, str] = None) -> Union[Dict[str, str], JsCod
 def to_hex_colour(blue_val):
     """
     Use mpl "Blues" colourmap to convert [0,1] to hex blues
+    Looked up in the precomputed palette, the same colours as colormaps["Blues"](blue_val)
     @param blue_val:
     @return:
     """
-    if blue_val > 1:
-        blue_val = 1
-    cmap = colormaps["Blues"]
-    r, g, b, a = cmap(blue_val, bytes=True)
-    r_hex, g_hex, b_hex = hex(r)[2:], hex(g)[2:], hex(b)[2:]
-    return f"#{r_hex}{g_hex}{b_hex}"
+    return BLUES[min(max(int(blue_val * len(BLUES)), 0), len(BLUES) - 1)]
 
 
 def gen_grid_options(df: pd.DataFrame, highlight_common_vals: bool, existing_match: int) -> Dict[str, str]:
@@ -369,6 +556,8 @@ def gen_grid_options(df: pd.DataFrame, highlight_common_vals: bool, existing_mat
     @param existing_match: int
     @return: Dict[str, str]
     """
+    from st_aggrid import GridOptionsBuilder
+
     grid_builder = GridOptionsBuilder.from_dataframe(df)
 
     grid_builder.configure_columns(
@@ -410,6 +599,8 @@ def update_marc_table(table, df, highlight_button, existing_match):
     @param existing_match:
     @return:
     """
+    from st_aggrid import AgGrid
+
     grid_options = gen_grid_options(
         df=df, highlight_common_vals=highlight_button, existing_match=existing_match
     )
@@ -423,52 +614,144 @@ def update_marc_table(table, df, highlight_button, existing_match):
     return ag
 
 
-def update_card_table(df: pd.DataFrame, subset: List[str], container: st.container) -> st.dataframe:
+CARD_TABLE_COLUMNS = {
+    "card_id": "ID", "title": "Title", "author": "Author", "selected_match_ocn": "Selected OCLC #",
+    "derivation_complete": "Derivation complete", "shelfmark": "Shelfmark", "lines": "OCR"
+}
+
+
+def card_table_df(df: pd.DataFrame, subset: List[str], card_idxs: Optional[List] = None) -> pd.DataFrame:
+    """
+    The values shown in the card table, OCLC numbers without their prefix
+    @param df: pd.DataFrame
+    @param subset: List[str], columns shown
+    @param card_idxs: Optional[List], only build the rows of these cards
+    @return: pd.DataFrame
+    """
+    table_df = df.loc[:, subset] if card_idxs is None else df.loc[list(card_idxs), subset]
+    table_df = table_df.copy()
+    table_df["selected_match_ocn"] = table_df["selected_match_ocn"].str.strip("ocn"
+                                                                   ).str.strip("ocm"
+                                                                   ).str.strip("on")
+    return table_df
+
+
+def update_card_rows(table_df: pd.DataFrame, df: pd.DataFrame, card_idxs: List) -> pd.DataFrame:
+    """
+    Rebuild the rows of edited cards in place, so a save doesn't rebuild the whole card table
+    @param table_df: pd.DataFrame, from card_table_df
+    @param df: pd.DataFrame
+    @param card_idxs: List
+    @return: pd.DataFrame
+    """
+    table_df.loc[list(card_idxs)] = card_table_df(df, table_df.columns.tolist(), card_idxs)
+    return table_df
+
+
+def update_card_table(table_df: pd.DataFrame, container: st.container,
+                      on_select: Union[str, Callable] = "rerun", key: Optional[str] = None) -> st.dataframe:
     """
     Update the card table at the top of the app
     This covers initial loading and updating once a record has been matched
-    @param df: pd.DataFrame
-    @param subset: List[str]
+    @param table_df: pd.DataFrame, from card_table_df
     @param container: st.container
+    @param on_select: Union[str, Callable], see st.dataframe
+    @param key: Optional[str], widget key, the selection is in st.session_state[key]
     @return: st.dataframe
     """
-    display_df = df.copy()
-    display_df["selected_match_ocn"] = display_df["selected_match_ocn"].str.strip("ocn"
-                                                                      ).str.strip("ocm"
-                                                                      ).str.strip("on")
-    existing_matches = display_df.dropna(subset="selected_match_ocn")
+    existing_matches = table_df.dropna(subset="selected_match_ocn")
     oclc_matches = existing_matches.query("selected_match_ocn != 'No match'").index.values
     no_matches = existing_matches.query("selected_match_ocn == 'No match'").index.values
     select_event = container.dataframe(
-        display_df.loc[:, subset].style.highlight_between(
+        table_df.style.highlight_between(
             subset=pd.IndexSlice[oclc_matches, :], color='#d6f5d6'
         ).highlight_between(subset=pd.IndexSlice[no_matches, :], color='#edcd8c'),
-        column_config={
-            "card_id": "ID", "title": "Title", "author": "Author", "selected_match_ocn": "Selected OCLC #",
-            "derivation_complete": "Derivation complete", "shelfmark": "Shelfmark", "lines": "OCR"
-        },
+        column_config=CARD_TABLE_COLUMNS,
         hide_index=True,
-        on_select="rerun",
-        selection_mode="single-row"
+        on_select=on_select,
+        selection_mode="single-row",
+        key=key
     )
 
     return select_event
 
 
-def push_to_storage(local: bool, save_file: str, df: pd.DataFrame, s3: s3fs.S3FileSystem) -> None:
+def save_card(writer: WriteBehind, df: pd.DataFrame, card_idx, fields: Dict) -> bool:
     """
-    Wrapper for updating and refreshing the cards_df and pushing data back to s3
-    @param local: bool
-    @param save_file: str
+    Queue edits to a single card to be saved in the background and update the cards_df
+    If another cataloguer saved the card first their edit is kept, see show_conflicts
+    @param writer: WriteBehind
     @param df: pd.DataFrame
-    @param s3: s3fs.S3FileSystem
-    @return: None
+    @param card_idx: index of the card in df
+    @param fields: Dict, see card_store.CARD_FIELDS
+    @return: bool, whether the edit was queued
     """
-    if local:
-        pickle.dump(df, open(save_file, "wb"))
-    else:
-        with s3.open(save_file, 'wb') as f:
-            pickle.dump(df, f)
-            st.cache_data.clear()  # Needed if pulling from S3
+    writer.submit(card_idx, fields)
+    for field, value in fields.items():
+        df.loc[card_idx, field] = value
+    return True
+
+
+def show_conflicts(writer: WriteBehind) -> None:
+    """
+    Warn about edits from earlier reruns that weren't saved because another cataloguer saved the card first
+    """
+    for _ in writer.pop_conflicts():
+        st.warning(docs.card_conflict_warning)
 
-    return None
+
+@st.fragment(run_every="2s")
+def show_save_status(writer: WriteBehind) -> None:
+    """
+    Unobtrusive save status, rerun on its own so it changes to saved once the background write finishes
+    """
+    status = writer.status()
+    if status == "saving":
+        st.caption("Saving...")
+    elif status == "saved":
+        st.caption(f"All changes saved at {time.strftime('%H:%M:%S', time.localtime(writer.last_saved))}")
+
+
+def cluster_members(df: pd.DataFrame, card_idx) -> pd.Index:
+    """
+    Cards in the same cluster (copies/volumes of a work) as card_idx, see bib_extraction.cluster_cards
+    @param df: pd.DataFrame
+    @param card_idx: index of the card in df
+    @return: pd.Index, including card_idx
+    """
+    if "cluster_id" not in df:
+        return pd.Index([card_idx])
+    return df.index[df["cluster_id"] == df.loc[card_idx, "cluster_id"]]
+
+
+def member_match_fields(df: pd.DataFrame, member_idx, fields: Dict) -> Dict:
+    """
+    A selection made on one card of a cluster as it applies to another member
+    The selected record is found by OCLC number as members searched separately can have results in a different order
+    @param df: pd.DataFrame
+    @param member_idx: index of the member card in df
+    @param fields: Dict, see card_store.CARD_FIELDS
+    @return: Dict
+    """
+    if not isinstance(fields.get("selected_match"), (int, np.integer)):
+        return fields
+    matches = df.loc[member_idx, "worldcat_matches"]
+    matches = matches if isinstance(matches, list) else []
+    ocns = [x.get_fields("001")[0].data if x.get_fields("001") else None for x in matches]
+    position = ocns.index(fields["selected_match_ocn"]) if fields["selected_match_ocn"] in ocns else None
+    return {**fields, "selected_match": position}
+
+
+def save_cluster(writer: WriteBehind, df: pd.DataFrame, card_idx, fields: Dict) -> bool:
+    """
+    Save edits to every card in card_idx's cluster, see save_card
+    @param writer: WriteBehind
+    @param df: pd.DataFrame
+    @param card_idx: index of the reviewed card in df
+    @param fields: Dict, see card_store.CARD_FIELDS
+    @return: bool, whether the edit to card_idx was saved
+    """
+    saved = save_card(writer, df, card_idx, fields)
+    for member_idx in cluster_members(df, card_idx).drop(card_idx):
+        save_card(writer, df, member_idx, member_match_fields(df, member_idx, fields))
+    return saved
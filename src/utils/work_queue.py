@@ -0,0 +1,149 @@
+"""
+Lease based assignment of cards to reviewers so two people never work on the same card
+"Next card" hands out the next unclaimed card with a lease that times out if the reviewer goes quiet.
+Everything is O(1) amortised: unclaimed cards are a deque, leases a dict and expiry a heap cleaned lazily.
+One queue is shared by every session of the app process (see streamlit_utils.load_work_queue).
+"""
+import heapq
+import threading
+import time
+from collections import deque
+from itertools import islice
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+LEASE_SECONDS = 15 * 60
+
+
+class LeaseQueue:
+    def __init__(self, card_ids: Iterable[Hashable], lease_seconds: float = LEASE_SECONDS, clock: Callable = time.monotonic):
+        self.unclaimed = deque(dict.fromkeys(card_ids))
+        self.queued = set(self.unclaimed)  # cards in unclaimed, so a card is never queued twice
+        self.known = set(self.unclaimed)
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self.leases = {}  # card_id: (reviewer, expiry)
+        self.by_reviewer = {}  # reviewer: card_id
+        self.expiries = []  # heap of (expiry, card_id), entries for renewed/released leases are skipped
+        self.completed = set()
+        self.lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, card_id = heapq.heappop(self.expiries)
+            lease = self.leases.get(card_id)
+            if lease and lease[1] == expiry:
+                self._release(card_id, requeue=True)
+
+    def _release(self, card_id: Hashable, requeue: bool) -> None:
+        reviewer, _ = self.leases.pop(card_id)
+        self.by_reviewer.pop(reviewer, None)
+        if requeue and card_id not in self.completed and card_id not in self.queued:
+            self.unclaimed.appendleft(card_id)  # abandoned cards are handed out first
+            self.queued.add(card_id)
+
+    def _lease(self, card_id: Hashable, reviewer: str, now: float) -> None:
+        expiry = now + self.lease_seconds
+        self.leases[card_id] = (reviewer, expiry)
+        self.by_reviewer[reviewer] = card_id
+        heapq.heappush(self.expiries, (expiry, card_id))
+
+    def next_card(self, reviewer: str, skip: Optional[Callable[[Hashable], bool]] = None) -> Optional[Hashable]:
+        """
+        Release the reviewer's current card back to the queue and lease them the next unclaimed one
+        @param reviewer: str
+        @param skip: Optional[Callable], cards for which this is True are dropped, e.g. matched in another process
+        @return: Optional[Hashable], None when every card is leased or complete
+        """
+        with self.lock:
+            now = self.clock()
+            self._expire(now)
+            current = self.by_reviewer.get(reviewer)
+            if current is not None:
+                self._release(current, requeue=False)
+                if current not in self.completed and current not in self.queued:
+                    self.unclaimed.append(current)
+                    self.queued.add(current)
+
+            while self.unclaimed:
+                card_id = self.unclaimed.popleft()
+                self.queued.discard(card_id)
+                if card_id in self.completed or card_id in self.leases:
+                    continue
+                if skip and skip(card_id):
+                    self.completed.add(card_id)
+                    continue
+                self._lease(card_id, reviewer, now)
+                return card_id
+            return None
+
+    def extend(self, card_ids: Iterable[Hashable]) -> None:
+        """
+        Queue cards that arrived after the queue was created, e.g. while a Worldcat fetch is still running
+        Cards already queued, leased or completed are ignored
+        """
+        with self.lock:
+            new = [x for x in dict.fromkeys(card_ids) if x not in self.known]
+            self.known.update(new)
+            self.queued.update(new)
+            self.unclaimed.extend(new)
+
+    def renew(self, reviewer: str) -> Optional[Hashable]:
+        """
+        Extend the reviewer's lease, called on every rerun of their session
+        @param reviewer: str
+        @return: Optional[Hashable], the leased card, None if the lease had already expired
+        """
+        with self.lock:
+            now = self.clock()
+            self._expire(now)
+            card_id = self.by_reviewer.get(reviewer)
+            if card_id is not None:
+                self._lease(card_id, reviewer, now)
+            return card_id
+
+    def complete(self, card_id: Hashable) -> None:
+        """
+        Take a card out of the queue once it's been matched, releasing any lease on it
+        """
+        with self.lock:
+            self.completed.add(card_id)
+            if card_id in self.leases:
+                self._release(card_id, requeue=False)
+
+    def requeue(self, card_id: Hashable) -> None:
+        """
+        Put a card back in the queue, e.g. after its match is cleared
+        """
+        with self.lock:
+            self.completed.discard(card_id)
+            if card_id not in self.leases and card_id not in self.queued:
+                self.unclaimed.append(card_id)
+                self.queued.add(card_id)
+
+    def peek(self, n: int) -> List[Hashable]:
+        """
+        Up to n cards that will be handed out next, without leasing them
+        """
+        with self.lock:
+            waiting = (x for x in self.unclaimed if x not in self.completed and x not in self.leases)
+            return list(islice(waiting, n))
+
+    def holder(self, card_id: Hashable) -> Optional[str]:
+        """
+        Reviewer currently leasing a card
+        """
+        with self.lock:
+            self._expire(self.clock())
+            lease = self.leases.get(card_id)
+            return lease[0] if lease else None
+
+    def active_leases(self) -> Dict[Hashable, Tuple[str, float]]:
+        with self.lock:
+            self._expire(self.clock())
+            return dict(self.leases)
+
+    def __len__(self) -> int:
+        """
+        Cards still to be handed out, including any that will be skipped when reached
+        """
+        return len(self.unclaimed)
@@ -0,0 +1,258 @@
+"""
+Background writer for a session's card edits
+save_card hands an edit to the writer and returns straight away. A thread writes the edits to the CardStore
+once none have arrived for FLUSH_DELAY seconds, so a burst of clicks (save match, correct shelfmark, derivation
+complete) becomes one new version per card and one manifest update.
+Every edit is appended to a local journal before save_card returns and the journal is cleared once the edits
+are written. A journal left behind by a crashed session is picked up by the next writer created for the store.
+The thread ends once the session has been idle for IDLE_SECONDS and is restarted by its next edit, so the writers
+of sessions that have gone don't keep a thread each.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from src.utils.card_store import CardStore, CardConflict, overlay, to_json
+
+JOURNAL_DIR = os.path.join("data", "interim", "card_journal")
+FLUSH_DELAY = 0.5
+MAX_FLUSH_DELAY = 5.0  # flush even if edits keep arriving
+RETRY_SECONDS = 5.0
+ORPHAN_SECONDS = 60  # a journal untouched for this long belongs to a session that has gone
+IDLE_SECONDS = 60.0
+
+
+class WriteBehind:
+    def __init__(self, store: CardStore, journal_dir: str = JOURNAL_DIR, delay: float = FLUSH_DELAY,
+                 orphan_seconds: float = ORPHAN_SECONDS, idle_seconds: float = IDLE_SECONDS):
+        """
+        @param store: CardStore, only used through the writer once it's created
+        @param journal_dir: str, local directory for journals
+        @param delay: float, seconds without a new edit before flushing
+        @param orphan_seconds: float, journals older than this are taken over
+        @param idle_seconds: float, the thread ends after this long without an edit to write
+        """
+        self.store = store
+        self.delay = delay
+        self.idle_seconds = idle_seconds
+        self.journal_dir = os.path.join(journal_dir, hashlib.sha1(store.root.encode("utf-8")).hexdigest()[:16])
+        self.journal_path = os.path.join(self.journal_dir, f"{uuid.uuid4()}.jsonl")
+        self.pending = {}  # idx: fields waiting to be written
+        self.in_flight = {}  # idx: fields being written
+        self.recovered = {}  # idx: time of edits taken over from a crashed session's journal
+        self.manifest_due = {}  # idx: version written but not yet in the manifest
+        self.conflicts = []
+        self.last_saved = None
+        self.lock = threading.Lock()  # pending, in_flight and the journal
+        self.flush_lock = threading.Lock()  # the writer thread and close() can both flush
+        self.store_lock = threading.RLock()  # the store is used by the session and the writer thread
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None  # set and cleared under lock, see submit and run
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.adopt_orphans(orphan_seconds)
+        with self.lock:
+            self.start()
+
+    def start(self) -> None:
+        """
+        Start the writer thread if it isn't running, call with lock held
+        """
+        if self.thread is None and not self.closed:
+            self.thread = threading.Thread(target=self.run, name="card-writer", daemon=True)
+            self.thread.start()
+
+    def journal(self, entry: Dict) -> None:
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, default=to_json) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rewrite_journal(self) -> None:
+        """
+        Replace the journal with the edits still to be written, or remove it if there are none
+        """
+        if not self.pending:
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+            return
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for idx, fields in self.pending.items():
+                f.write(json.dumps({"idx": idx, "fields": fields, "time": time.time()}, default=to_json) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def adopt_orphans(self, orphan_seconds: float) -> None:
+        """
+        Take over the unwritten edits of sessions that crashed
+        A journal is claimed by renaming it so two new sessions can't both replay it
+        """
+        for path in glob.glob(os.path.join(self.journal_dir, "*.jsonl")):
+            if time.time() - os.path.getmtime(path) < orphan_seconds:
+                continue
+            claimed = f"{self.journal_path}.{os.path.basename(path)}.claimed"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue  # claimed by another session
+            with open(claimed, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # partly written last line
+                    self.pending[entry["idx"]] = {**self.pending.get(entry["idx"], {}), **entry["fields"]}
+                    self.recovered[entry["idx"]] = entry.get("time", 0)
+            with self.lock:
+                self.rewrite_journal()
+            os.remove(claimed)
+            logging.info(f"Recovered unsaved edits to {len(self.recovered)} cards from {path}")
+        if self.pending:
+            self.wake.set()
+
+    def submit(self, idx, fields: Dict) -> None:
+        """
+        Queue an edit to a card, journalled before returning
+        @param idx: card index in the cards df
+        @param fields: Dict, values for some of CARD_FIELDS
+        """
+        idx = str(idx)
+        with self.lock:
+            self.pending[idx] = {**self.pending.get(idx, {}), **fields}
+            self.recovered.pop(idx, None)
+            self.journal({"idx": idx, "fields": fields, "time": time.time()})
+            self.wake.set()
+            self.start()
+
+    def write_recovered(self, idx: str, fields: Dict) -> Optional[int]:
+        """
+        Recovered edits don't know which version they were made on, they're written unless the card was saved since
+        """
+        try:
+            return self.store.write(idx, fields, manifest=False)["version"]
+        except CardConflict as e:
+            if e.record.get("saved", 0) > self.recovered.get(idx, 0):
+                logging.warning(f"Recovered edit to card {idx} dropped, the card was saved since")
+                return None
+            return self.store.write(idx, fields, manifest=False)["version"]
+
+    def flush(self) -> bool:
+        """
+        Write every pending edit, one new version per card and one manifest update
+        @return: bool, False if the store couldn't be reached, the edits are kept for the next attempt
+        """
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self) -> bool:
+        with self.lock:
+            self.in_flight, self.pending = self.pending, {}
+        if not self.in_flight and not self.manifest_due:
+            return True
+
+        written = set()
+        try:
+            with self.store_lock:
+                for idx, fields in self.in_flight.items():
+                    try:
+                        if idx in self.recovered:
+                            version = self.write_recovered(idx, fields)
+                        else:
+                            version = self.store.write(idx, fields, manifest=False)["version"]
+                        if version is not None:
+                            self.manifest_due[idx] = version
+                    except CardConflict as e:
+                        with self.lock:
+                            self.conflicts.append(e)
+                    written.add(idx)
+                if self.manifest_due:
+                    self.store.update_manifest(self.manifest_due)
+                    self.manifest_due = {}
+        except Exception:
+            logging.exception("Saving card edits failed, retrying")
+            with self.lock:
+                for idx, fields in self.in_flight.items():
+                    if idx not in written:
+                        self.pending[idx] = {**fields, **self.pending.get(idx, {})}
+                self.in_flight = {}
+            return False
+
+        with self.lock:
+            for idx in written:
+                self.recovered.pop(idx, None)
+            self.in_flight = {}
+            self.rewrite_journal()
+            self.last_saved = time.time()
+        return True
+
+    def run(self) -> None:
+        while not self.closed:
+            if not self.wake.wait(self.idle_seconds):
+                with self.lock:
+                    if not self.wake.is_set():  # an edit submitted now starts a new thread
+                        self.thread = None
+                        return
+            self.wake.clear()
+            deadline = time.monotonic() + MAX_FLUSH_DELAY
+            while time.monotonic() < deadline and self.wake.wait(self.delay):  # more edits arrived, keep waiting
+                self.wake.clear()
+            if not self.flush():
+                with self.lock:
+                    if os.path.exists(self.journal_path):
+                        os.utime(self.journal_path)  # still alive, don't let another session take the journal over
+                time.sleep(RETRY_SECONDS)
+                self.wake.set()
+
+    def sync(self) -> List[str]:
+        """
+        See CardStore.sync
+        """
+        with self.store_lock:
+            return self.store.sync()
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Overlay stored edits then edits still to be written onto the cards df, in place
+        @param df: pd.DataFrame
+        @return: pd.DataFrame
+        """
+        with self.store_lock:
+            self.store.apply(df)
+        with self.lock:
+            overlay(df, self.in_flight)
+            return overlay(df, self.pending)
+
+    def pop_conflicts(self) -> List[CardConflict]:
+        """
+        Edits that weren't written because another session saved the card first, their edit is kept
+        """
+        with self.lock:
+            conflicts, self.conflicts = self.conflicts, []
+        return conflicts
+
+    def status(self) -> Optional[str]:
+        """
+        @return: Optional[str], "saving", "saved" or None if nothing has been saved yet
+        """
+        with self.lock:
+            if self.pending or self.in_flight:
+                return "saving"
+            return "saved" if self.last_saved else None
+
+    def close(self) -> None:
+        self.closed = True
+        self.wake.set()
+        self.flush()
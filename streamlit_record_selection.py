@@ -3,16 +3,20 @@ Removed any data processing prior to delivery of cards_df to simplify env for st
 Will need to prepare elsewhere then pull in as pickle or csv
 """
 import os
-import pickle
 import platform
+import uuid
+from typing import Dict, List, Optional
 
+import fsspec
 import pandas as pd
 import streamlit as st
-from PIL import Image
-import s3fs
 
 import cfg
 from src.utils import streamlit_utils as st_utils
+from src.utils.card_store import CardStore, store_root
+from src.utils.result_sink import RESULT_POLL_SECONDS
+from src.utils.work_queue import LeaseQueue
+from src.utils.write_behind import WriteBehind
 from src.docs import doc_strings as docs
 
 st.set_page_config(layout="wide")
@@ -23,8 +27,6 @@ if platform.system() == "Linux":  # community cloud runs linux
 elif platform.system() == "Windows":
     LOCAL_DATA = True  # edit if want to trial remote data locally
 
-s3 = s3fs.S3FileSystem(anon=False)
-
 st.title("Worldcat results for searches for catalogue card title/author")
 
 with open("sidebar_docs.txt", encoding="utf-8") as f:
@@ -32,231 +34,197 @@ with open("sidebar_docs.txt", encoding="utf-8") as f:
 with st.sidebar:
     st.markdown(sidebar_docs_txt)
 
+# The cards are loaded once per app process and shared read only between sessions
+# Until the cards pickle is written they're read from the result sink of a Worldcat fetch that may still be running
+result_reader = None
 if st.session_state["testing"]:
-    cards_df = st.session_state["cards_df"]
+    shared_cards = st_utils.prepare_cards(st.session_state["cards_df"])
+    st.session_state["save_file"] = st.session_state.get("save_file", "data/processed/test_matches.p")
     pass  # cards_df and save_file defined in tests
 elif LOCAL_DATA:
     st.session_state["save_file"] = "data/processed/chinese_matches.p"
-    cards_df = pickle.load(open(st.session_state["save_file"], "rb"))
+    result_reader = st_utils.load_result_reader(st.session_state["save_file"], local=True)
+    if result_reader is None:
+        shared_cards = st_utils.load_cards(st.session_state["save_file"], local=True)
+    else:
+        shared_cards = result_reader.refresh()
     st.write("Loaded cards info from local")
 else:
     st.session_state["save_file"] = 'cac-bucket/chinese_matches.p'
-    cards_df = st_utils.load_s3(s3, st.session_state["save_file"])
+    result_reader = st_utils.load_result_reader(st.session_state["save_file"], local=False)
+    if result_reader is None:
+        shared_cards = st_utils.load_cards(st.session_state["save_file"], local=False)
+    else:
+        shared_cards = result_reader.refresh()
     st.write("Loaded cards info from AWS")
 
+
+@st.fragment(run_every=RESULT_POLL_SECONDS)
+def watch_results(n_cards: int) -> None:
+    """
+    Rerun the app when more cards have been fetched
+    """
+    if len(result_reader.refresh()) > n_cards:
+        st.rerun()
+    st.info(docs.fetch_running_info.format(n=n_cards) if n_cards else docs.fetch_waiting_info)
+
+
+if result_reader is not None and not result_reader.complete:
+    with st.sidebar:
+        watch_results(len(shared_cards))
+if len(shared_cards) == 0:
+    st.stop()
+
+# Cataloguers' edits are saved per card beside the cards pickle, which is never rewritten by the app
+# Syncing only checks for a newer manifest version unless another session has saved a card
+# Edits are written by a background thread so saving doesn't wait on storage, it ends once the session is idle
+edits_root = store_root(st.session_state["save_file"])
+if st.session_state.get("card_writer") is None or st.session_state["card_writer"].store.root != edits_root:
+    if st.session_state.get("card_writer") is not None:
+        st.session_state["card_writer"].close()
+    store_fs = fsspec.filesystem("file") if LOCAL_DATA or st.session_state["testing"] else st_utils.get_s3()
+    st.session_state["card_writer"] = WriteBehind(CardStore(store_fs, edits_root))
+card_writer = st.session_state["card_writer"]
+card_writer.sync()
+st_utils.show_conflicts(card_writer)
+cards_df = st_utils.session_cards(shared_cards, card_writer)  # only the session's edits are its own
+
+# Work queue, "Next card" leases an unmatched card nobody else is working on
+st.session_state["reviewer"] = st.session_state.get("reviewer", str(uuid.uuid4()))
+cluster_reps = cards_df["cluster_id"].to_numpy() == cards_df.index.to_numpy()
+unmatched_cards = cards_df.index[cards_df["selected_match_ocn"].isna() & cards_df["worldcat_matches"].notna() & cluster_reps]
+work_queue = st_utils.load_work_queue(str(st.session_state["save_file"]), unmatched_cards.tolist())
+if result_reader is not None:
+    work_queue.extend(unmatched_cards.tolist())  # cards fetched since the queue was created
+
+
+def lease_next_card():
+    card_id = work_queue.next_card(
+        st.session_state["reviewer"], skip=lambda x: pd.notna(cards_df.loc[x, "selected_match_ocn"])
+    )
+    if card_id is not None:
+        st.session_state["readable_card_id"] = int(cards_df.loc[card_id, "simple_id"])
+
+
+with st.sidebar:
+    st.button("Next card", on_click=lease_next_card, help=docs.next_card_help)
+    st.write(f"{len(work_queue)} cards waiting, {len(work_queue.active_leases())} being reviewed")
+    st_utils.show_save_status(card_writer)
+
 number_of_cards_container = st.empty()
 card_table_instructions = st.empty()
-card_table_container = st.empty()
 subset = ["simple_id", "title", "author", "selected_match_ocn", "derivation_complete", "shelfmark", "lines"]
+card_table_df = st_utils.card_table_df(cards_df, subset)
+
+
+def select_card() -> None:
+    """
+    Called only when the table selection changes, so Next card isn't overridden by an old selection
+    """
+    selected_rows = st.session_state["card_table_selection"]["selection"]["rows"]
+    if selected_rows:
+        st.session_state["readable_card_id"] = int(selected_rows[0]) + 1
+        st.rerun()  # a different card, everything below the table changes
+
 
-card_selection = st_utils.update_card_table(df=cards_df, subset=subset, container=card_table_container)
+# The page is split into fragments that rerun on their own, each given the data it depends on
+# Saves are made in widget callbacks which rerun only the fragments showing the edited cards
+@st.fragment(key="card_table")
+def card_table(table_df: pd.DataFrame) -> None:
+    st_utils.update_card_table(table_df, container=st.container(), on_select=select_card, key="card_table_selection")
+
+
+card_table(card_table_df)
 
 nulls = len(cards_df) - len(cards_df.dropna(subset="worldcat_matches"))
 number_of_cards_container.write(
     f"Showing {len(cards_df.dropna(subset='worldcat_matches'))} cards with Worldcat results."
     # f"out of of {len(cards_df)} total cards, omitting {nulls} without results."
 )
-
 card_table_instructions.write(docs.card_table_instructions)
 
-if not card_selection["selection"]["rows"]:
-    st.session_state["readable_card_id"] = st.session_state.get("readable_card_id", 1)
-else:
-    st.session_state["readable_card_id"] = int(card_selection["selection"]["rows"][0]) + 1
+st.session_state["readable_card_id"] = st.session_state.get("readable_card_id", 1)
 
-card_idx = cards_df.query("simple_id == @st.session_state['readable_card_id']").index.values[0]
-st.session_state["card_idx"] = card_idx
 
-st.session_state["existing_match"] = cards_df.loc[card_idx, "selected_match"]
-st.session_state["match_exists"] = isinstance(st.session_state["existing_match"], int)
+def reviewed_card(cards_df: pd.DataFrame):
+    """
+    The index of the card being reviewed, looked up again by callbacks so a save goes to the card the page will show
+    """
+    return cards_df.query("simple_id == @st.session_state['readable_card_id']").index.values[0]
 
-if st.session_state["match_exists"]:
-    apparent_oclc_num = cards_df.loc[card_idx, "selected_match_ocn"]
-    actual_oclc_num = cards_df.loc[card_idx, "worldcat_matches"][st.session_state["existing_match"]].get_fields("001")[0].data
-    if apparent_oclc_num != actual_oclc_num:
-        st.warning(docs.oclc_num_warning)
 
-cards_df["author"] = cards_df["author"].apply(lambda x: x if x else "")
+def save_shelfmark(cards_df: pd.DataFrame, card_idx, writer: WriteBehind, table_df: pd.DataFrame) -> None:
+    sm_correction = st.session_state[f"shelfmark_{card_idx}"]
+    if sm_correction != cards_df.loc[card_idx, "shelfmark"]:
+        if st_utils.save_card(writer, cards_df, card_idx, {"shelfmark": sm_correction}):  # copies have their own
+            st.session_state["shelfmark_message"] = "Shelfmark updated"
+        st_utils.update_card_rows(table_df, cards_df, [card_idx])
+    st.rerun(["card_table", "shelfmark", "selection"])  # the selection panel shows the shelfmark
 
-st.write("\n")
-st.subheader("Select from Worldcat results")
 
-card_jpg_path = os.path.join("data/raw/chinese/1016992", cards_df.loc[card_idx, "xml"][:-5] + ".jpg")
+@st.fragment(key="shelfmark")
+def shelfmark_input(cards_df: pd.DataFrame, card_idx, writer: WriteBehind, table_df: pd.DataFrame) -> None:
+    sm = cards_df.loc[card_idx, 'shelfmark']
+    st.text_input(label=f"The extracted shelfmark is {sm}. If incorrect change the value below and press enter.",
+                  value=sm, key=f"shelfmark_{card_idx}", on_change=save_shelfmark,
+                  args=(cards_df, card_idx, writer, table_df))
+    if "shelfmark_message" in st.session_state:
+        st.markdown(f":green[{st.session_state.pop('shelfmark_message')}]")
 
-search_ti = cards_df.loc[card_idx, 'title'].replace(' ', '+')
-search_au = cards_df.loc[card_idx, 'author'].replace(' ', '+')
-search_term = f"https://www.worldcat.org/search?q=ti%3A{search_ti}+AND+au%3A{search_au}"
 
-ic_left, ic_centred = st.columns([0.3, 0.7])
-ic_centred.image(Image.open(card_jpg_path), use_column_width=True)
-label_text = f"""You can check the [Worldcat search]({search_term}) for this card"""
-ic_left.write(label_text)
-sm = cards_df.loc[card_idx, 'shelfmark']
-sm_correction = ic_left.text_input(label=f"The extracted shelfmark is {sm}. If incorrect change the value below and press enter.", value=sm)
-if sm != sm_correction:
-    ic_left.markdown(f":green[Shelfmark updated]")
-    cards_df.loc[card_idx, 'shelfmark'] = sm_correction
-    st_utils.update_card_table(df=cards_df, subset=subset, container=card_table_container)
-    st_utils.push_to_storage(local=LOCAL_DATA, save_file=st.session_state["save_file"], df=cards_df, s3=s3)
+NO_CORRECT_TEXT = "No correct results"
 
-filtered_records_empty = ic_left.empty()
 
-minimal_cataloguing_view = ic_left.toggle("Minimal cataloguing view", value=True, help=docs.min_cat_help_text)
-
-marc_table = st.empty()
-match_df = pd.DataFrame({"record": list(cards_df.loc[card_idx, "worldcat_matches"])})
-match_df = st_utils.create_filter_columns(match_df, cfg.LANG_DICT, search_au)
-all_marc_fields = sorted(list(set(match_df["record"].apply(lambda x: [y.tag for y in x.get_fields()]).sum())))
-all_languages = match_df["language"].unique()
-
-# Filters form
-with st.form("filters"):
-    apply_col, max_to_display_col, removed_records_col = st.columns([0.1, 0.2, 0.7])
-
-    apply_filters = apply_col.form_submit_button(label="Apply filters")
-
-    max_to_display = int(
-        max_to_display_col.number_input("Max records to display", min_value=1, value=5, help=docs.max_to_display_help)
-    )
-
-    # It is possible to remove a previously selected record from the comparison
-    records_to_ignore = removed_records_col.multiselect(
-        label="Select incorrect records you'd like to remove from the comparison",
-        options=match_df.index
-    )
-
-    if "English" in all_languages:
-        default_lang = "English"
+def save_selection(cards_df: pd.DataFrame, writer: WriteBehind, work_queue: LeaseQueue,
+                   table_df: pd.DataFrame) -> None:
+    card_idx = reviewed_card(cards_df)
+    cluster = st_utils.cluster_members(cards_df, card_idx)
+    selected_match = st.session_state["selected_match"]
+    if selected_match == NO_CORRECT_TEXT:
+        match_fields = {"selected_match": "No match", "selected_match_ocn": "No match"}
+        message = "Non-match recorded!"
     else:
-        default_lang = None
-
-    lang_select = st.multiselect(
-        "Select Cataloguing Language (040 $b)",
-        match_df["language"].unique(),
-        format_func=lambda x: f"{x} ({len(match_df.query('language == @x'))} total)",
-        default=default_lang
-    )
-
-    st.write("####")
-    _, date_slider_col, _ = st.columns([0.05, 0.9, 0.05])
-    pub_dates = match_df.query("publication_date > -9999")["publication_date"].sort_values().dropna().unique().astype(int)
-    if len(pub_dates) == 0:
-        pub_dates = [1900, 2000]
-    elif len(pub_dates) == 1:
-        pub_dates = [pub_dates[0] - 1, pub_dates[0], pub_dates[0] + 1]
-    date_slider = date_slider_col.select_slider(
-        label='Select publication year',
-        options=pub_dates,
-        value=(min(pub_dates), max(pub_dates)),
-        help=(docs.date_select_help)
-    )
-
-    st.write("####")
-    generic_field_col, generic_field_contains_col, _, include_recs_without_field_col = st.columns([0.26, 0.38, 0.033, 0.19], vertical_alignment="bottom")
-    search_on_marc_fields = generic_field_col.multiselect(
-        "Select MARC field",
-        all_marc_fields,
-        help="[LoC MARC fields](https://www.loc.gov/marc/bibliographic/)"
-    )
-    search_terms = generic_field_contains_col.text_input("MARC field contains", help=(docs.generic_field_search_help))
-
-    search_terms = search_terms.split(";")
-    if search_terms == [""]:  # clear if no search terms
-        search_terms, search_on_marc_fields = [], []
-    include_recs_without_field = include_recs_without_field_col.checkbox("Allow records without specified MARC fields")
-
-    if len(search_on_marc_fields) != len(search_terms):
-        st.markdown(
-            (f":red[**Searching on {len(search_on_marc_fields)} MARC fields, "
-             f"but {len(search_terms.split(';'))} search terms specified. "
-             f"Please change number of searched on MARC fields or number of ';' seperated search terms**]")
-        )
-
-    # filter option columns defined below to display in the filters users can choose from
-    filter_options = ["num_subject_access", "num_rda", "num_linked", "has_phys_desc", "good_encoding_level", "record_length"]
-
-    sort_options_col, highlight_col = st.columns([0.65, 0.2], gap="large", vertical_alignment="center")
-    sort_options = sort_options_col.multiselect(label=("Select how to sort matching records."), options=filter_options,
-                                                format_func=st_utils.pretty_filter_option, help=(docs.sort_options_help))
-
-    highlight_button = highlight_col.checkbox("Highlight common fields", value=True,
-                                              help="Highlight field values that are common between two or more records.")
-
-
-if not lang_select:
-    lang_select = all_languages
-filter_query = "language in @lang_select" \
-               "& ((@date_slider[0] <= publication_date and publication_date <= @date_slider[1])" \
-               "or publication_date == -9999)"
-filtered_df = match_df.query(filter_query).copy()
-st.session_state["filtered_df"] = filtered_df
-sorted_filtered_df = filtered_df.sort_values(by=sort_options, ascending=False)
-
-formatted_records, fmt_new_idx = [], []
-for i in range(len(sorted_filtered_df)):
-    res = sorted_filtered_df.iloc[i, 0].get_fields()
-    ldr = sorted_filtered_df.iloc[i, 0].leader
-    col = pd.DataFrame(
-        index=pd.Index(["LDR"] + [x.tag for x in res], name="Field"),
-        data=[ldr] + [x.__str__()[6:] for x in res],
-        columns=[sorted_filtered_df.iloc[i].name]
-    )
-    formatted_records.append(st_utils.gen_unique_idx(col))
-    # fmt_new_idx.append(st_utils.gen_sf_rpt_unique_idx(col))
-
-marc_table_all_recs_df = pd.concat(formatted_records, axis=1).sort_index(key=st_utils.sort_fields_idx)
-st.session_state["marc_table_all_recs_df"] = marc_table_all_recs_df  # for testing
-# new_marc_table = pd.concat(fmt_new_idx, axis=1).sort_index()
-# st_utils.simplify_6xx(new_marc_table)
-
-marc_table_filtered_recs = st_utils.filter_on_generic_fields(marc_table_all_recs_df, search_on_marc_fields,
-                                                             search_terms, include_recs_without_field)
-st.session_state["marc_table_filtered_recs"] = marc_table_filtered_recs  # for testing
-match_ids = marc_table_filtered_recs.columns.tolist()
-
-record = "records"
-if len(records_to_ignore) == 1: record = "record"
-n_displayed = min([max_to_display, len(match_ids)])
-filtered_records_text = f"""
-[Max records to display](#filters) set to {max_to_display}. Displaying {n_displayed} of {len(match_ids)} filtered records.\n
-{len(match_df)} total records.  
-{len(match_df) - len(match_ids)} removed by filters.  
-{len(records_to_ignore)} incorrect {record} removed by user.
-"""
-filtered_records_empty.write(filtered_records_text)
-
-records_to_display = [x for x in match_ids if x not in records_to_ignore]
-excluded_fields = ["063", "064", "068", "072", "078", "079", "250", "776"]
-useful_fields = ~marc_table_all_recs_df.index.droplevel(1).isin(excluded_fields)
-marc_grid_df = marc_table_all_recs_df.loc[useful_fields, records_to_display[:max_to_display]].dropna(how="all")
-
-minimal_repeat_fields = [x for x in marc_grid_df.index.droplevel(1) if x[0] in ["3", "6"]]
-minimal_fields = minimal_repeat_fields + ["100", "245", "260", "880"]  # 100, 245, 260, 300s, 600s, 880s
-if minimal_cataloguing_view:
-    marc_grid_df = marc_grid_df.loc[marc_grid_df.index.droplevel(1).isin(minimal_fields)]
-
-marc_grid_df = marc_grid_df.reset_index().transform(lambda x: x.str.replace(r"\$\w", st_utils.new_line, regex=True))
-marc_grid_df.columns = [str(x) for x in marc_grid_df.columns]
-
-# for testing
-st.session_state["marc_grid_df"] = marc_grid_df
-st.session_state["ag"] = st_utils.update_marc_table(marc_table, marc_grid_df, highlight_button, st.session_state["existing_match"])
-
-select_col, derive_col = st.columns([0.35, 0.35], gap="large")
-with select_col:
+        oclc_num = cards_df.loc[card_idx, "worldcat_matches"][selected_match].get_fields("001")[0].data
+        match_fields = {"selected_match": selected_match, "selected_match_ocn": oclc_num}
+        message = "Selection saved!"
+    if st_utils.save_cluster(writer, cards_df, card_idx, match_fields):
+        for member_idx in cluster:
+            work_queue.complete(member_idx)
+        st.session_state["selection_message"] = message
+    st_utils.update_card_rows(table_df, cards_df, cluster)
+    st.rerun(["card_table", "card"])  # the warnings and MARC grid show the match too
+
+
+def clear_selection(cards_df: pd.DataFrame, writer: WriteBehind, work_queue: LeaseQueue,
+                    table_df: pd.DataFrame) -> None:
+    card_idx = reviewed_card(cards_df)
+    cluster = st_utils.cluster_members(cards_df, card_idx)
+    clear_fields = {"selected_match": None, "selected_match_ocn": None, "derivation_complete": None}
+    if st_utils.save_cluster(writer, cards_df, card_idx, clear_fields):
+        work_queue.requeue(cards_df.loc[card_idx, "cluster_id"])
+        st.session_state["selection_message"] = "Selection cleared!"
+    st_utils.update_card_rows(table_df, cards_df, cluster)
+    st.rerun(["card_table", "card"])  # the warnings and MARC grid show the match too
+
+
+@st.fragment(key="selection")
+def selection_panel(cards_df: pd.DataFrame, card_idx, cluster: pd.Index, options: List, writer: WriteBehind,
+                    work_queue: LeaseQueue, table_df: pd.DataFrame) -> None:
+    callback_args = (cards_df, writer, work_queue, table_df)
     with st.form("record_selection"):
         closest_result_col, save_col = st.columns([0.6, 0.4])
-        no_correct_text = "No correct results"
-        selected_match = closest_result_col.radio(
+        closest_result_col.radio(
             label="Which is the closest Worldcat result?",
-            options=(records_to_display[:max_to_display] + [no_correct_text])
+            options=(options + [NO_CORRECT_TEXT]),
+            key="selected_match"
         )
 
         save_col.write("Saving will show the shelfmark and OCLC number for Record Manager. See sidebar for more info on Record Manager.")
-        save_res = save_col.form_submit_button(label="Save selection")
-        clear_res = save_col.form_submit_button(label="Clear selection")
+        save_col.form_submit_button(label="Save selection", on_click=save_selection, args=callback_args)
+        save_col.form_submit_button(label="Clear selection", on_click=clear_selection, args=callback_args)
 
-        success_empty = st.empty()
+        if "selection_message" in st.session_state:
+            st.success(st.session_state.pop("selection_message"), icon="✅")
 
         sm_field = "852"
         info_text = f"""
@@ -274,63 +242,254 @@ with select_col:
         oclc_num_copy = oclc_num_col.empty()
 
         sm_label_col.write(f"Shelfmark ({sm_field} field):")
-        sm_col.code(sm)
+        sm_col.code(cards_df.loc[card_idx, "shelfmark"])
 
         ocr_text_label_col.write("OCR text (500 field):")
         oclc_text_copy = ocr_text_col.empty()
 
-        if st.session_state["match_exists"]:
+        if isinstance(cards_df.loc[card_idx, "selected_match"], int):
             oclc_num = cards_df.loc[card_idx, "selected_match_ocn"]
             copy_instruction.info(info_text)
             oclc_num_copy.code(oclc_num.strip('ocn').strip('ocm').strip('on'))
             oclc_text_copy.code("\n".join(cards_df.loc[card_idx, "lines"]))
-
-        if save_res:
-            if selected_match == no_correct_text:
-                cards_df.loc[card_idx, ["selected_match", "selected_match_ocn"]] = "No match"
-                st_utils.update_card_table(cards_df, subset, card_table_container)
-                st_utils.push_to_storage(local=LOCAL_DATA, save_file=st.session_state["save_file"], df=cards_df, s3=s3)
-                success_empty.success("Non-match recorded!", icon="✅")
-            else:
-                oclc_num = cards_df.loc[card_idx, "worldcat_matches"][selected_match].get_fields("001")[0].data
-                cards_df.loc[card_idx, "selected_match"] = selected_match
-                cards_df.loc[card_idx, "selected_match_ocn"] = oclc_num
-
-                st_utils.update_card_table(cards_df, subset, card_table_container)
-                st_utils.push_to_storage(local=LOCAL_DATA, save_file=st.session_state["save_file"], df=cards_df, s3=s3)
-                st_utils.update_marc_table(marc_table, marc_grid_df, highlight_button, st.session_state["existing_match"])
-
-                copy_instruction.info(info_text)
-                oclc_num_copy.code(oclc_num.strip('ocn').strip('ocm').strip('on'))
-                oclc_text_copy.code("\n".join(cards_df.loc[card_idx, "lines"]))
-
-                success_empty.success("Selection saved!", icon="✅")
-
-        if clear_res:
-            cards_df.loc[card_idx, ["selected_match", "selected_match_ocn", "derivation_complete"]] = None
-            st_utils.update_card_table(cards_df, subset, card_table_container)
-            st_utils.push_to_storage(local=LOCAL_DATA, save_file=st.session_state["save_file"], df=cards_df, s3=s3)
-            st_utils.update_marc_table(marc_table, marc_grid_df, highlight_button, existing_match=False)
-
-            copy_instruction.write("")
+        else:
             oclc_num_copy.code("")
             oclc_text_copy.code("")
 
-            success_empty.success("Selection cleared!", icon="✅")
 
-with derive_col:
+def save_derivation(cards_df: pd.DataFrame, card_idx, cluster: pd.Index, writer: WriteBehind,
+                    table_df: pd.DataFrame, complete: Optional[bool]) -> None:
+    if st_utils.save_cluster(writer, cards_df, card_idx, {"derivation_complete": complete}):
+        st.session_state["derivation_message"] = "Derivation complete!" if complete else "Derivation cleared!"
+    st_utils.update_card_rows(table_df, cards_df, cluster)
+    st.rerun(["card_table", "derivation"])
+
+
+@st.fragment(key="derivation")
+def derivation_panel(cards_df: pd.DataFrame, card_idx, cluster: pd.Index, writer: WriteBehind,
+                     table_df: pd.DataFrame) -> None:
     with st.form("derive_complete"):
         st.write(docs.derivation_complete)
-        derivation_complete = st.form_submit_button(label="Derivation complete")
-        if derivation_complete:
-            cards_df.loc[card_idx, "derivation_complete"] = True
-            st_utils.update_card_table(cards_df, subset, card_table_container)
-            st_utils.push_to_storage(local=LOCAL_DATA, save_file=st.session_state["save_file"], df=cards_df, s3=s3)
-            st.success("Derivation complete!", icon="✅")
-
-        mark_uncomplete = st.form_submit_button(label="Undo derivation complete")
-        if mark_uncomplete:
-            cards_df.loc[card_idx, "derivation_complete"] = None
-            st_utils.update_card_table(cards_df, subset, card_table_container)
-            st_utils.push_to_storage(local=LOCAL_DATA, save_file=st.session_state["save_file"], df=cards_df, s3=s3)
-            st.success("Derivation cleared!", icon="✅")
+        st.form_submit_button(label="Derivation complete", on_click=save_derivation,
+                              args=(cards_df, card_idx, cluster, writer, table_df, True))
+        st.form_submit_button(label="Undo derivation complete", on_click=save_derivation,
+                              args=(cards_df, card_idx, cluster, writer, table_df, None))
+        if "derivation_message" in st.session_state:
+            st.success(st.session_state.pop("derivation_message"), icon="✅")
+
+
+@st.fragment(key="review")
+def review_panel(cards_df: pd.DataFrame, card_idx, cluster: pd.Index, card_view: Dict, writer: WriteBehind,
+                 work_queue: LeaseQueue, table_df: pd.DataFrame, filtered_records_container: st.container,
+                 minimal_cataloguing_view: bool, align_subjects: bool, differences_only: bool) -> None:
+    """
+    Filters, the MARC grid and the selection and derivation panels, applying filters reruns only this
+    """
+    marc_table = st.empty()
+    identical_fields_container = st.empty()
+    match_df = card_view["match_df"]
+    all_marc_fields = card_view["all_marc_fields"]
+    all_languages = card_view["all_languages"]
+
+    # Filters form
+    with st.form("filters"):
+        apply_col, max_to_display_col, removed_records_col = st.columns([0.1, 0.2, 0.7])
+
+        apply_filters = apply_col.form_submit_button(label="Apply filters")
+
+        max_to_display = int(
+            max_to_display_col.number_input("Max records to display", min_value=1, value=5, help=docs.max_to_display_help)
+        )
+
+        # It is possible to remove a previously selected record from the comparison
+        records_to_ignore = removed_records_col.multiselect(
+            label="Select incorrect records you'd like to remove from the comparison",
+            options=match_df.index
+        )
+
+        if "English" in all_languages:
+            default_lang = "English"
+        else:
+            default_lang = None
+
+        lang_select = st.multiselect(
+            "Select Cataloguing Language (040 $b)",
+            match_df["language"].unique(),
+            format_func=lambda x: f"{x} ({len(match_df.query('language == @x'))} total)",
+            default=default_lang
+        )
+
+        st.write("####")
+        _, date_slider_col, _ = st.columns([0.05, 0.9, 0.05])
+        pub_dates = card_view["pub_years"]
+        if len(pub_dates) == 0:
+            pub_dates = [1900, 2000]
+        elif len(pub_dates) == 1:
+            pub_dates = [pub_dates[0] - 1, pub_dates[0], pub_dates[0] + 1]
+        date_slider = date_slider_col.select_slider(
+            label='Select publication year',
+            options=pub_dates,
+            value=(min(pub_dates), max(pub_dates)),
+            help=(docs.date_select_help)
+        )
+
+        st.write("####")
+        generic_field_col, generic_field_contains_col, _, include_recs_without_field_col = st.columns([0.26, 0.38, 0.033, 0.19], vertical_alignment="bottom")
+        search_on_marc_fields = generic_field_col.multiselect(
+            "Select MARC field",
+            all_marc_fields,
+            help="[LoC MARC fields](https://www.loc.gov/marc/bibliographic/)"
+        )
+        search_terms = generic_field_contains_col.text_input("MARC field contains", help=(docs.generic_field_search_help))
+
+        search_terms = search_terms.split(";")
+        if search_terms == [""]:  # clear if no search terms
+            search_terms, search_on_marc_fields = [], []
+        include_recs_without_field = include_recs_without_field_col.checkbox("Allow records without specified MARC fields")
+
+        if len(search_on_marc_fields) != len(search_terms):
+            st.markdown(
+                (f":red[**Searching on {len(search_on_marc_fields)} MARC fields, "
+                 f"but {len(search_terms.split(';'))} search terms specified. "
+                 f"Please change number of searched on MARC fields or number of ';' seperated search terms**]")
+            )
+
+        # filter option columns defined below to display in the filters users can choose from
+        filter_options = ["num_subject_access", "num_rda", "num_linked", "has_phys_desc", "good_encoding_level", "record_length"]
+
+        sort_options_col, highlight_col = st.columns([0.65, 0.2], gap="large", vertical_alignment="center")
+        sort_options = sort_options_col.multiselect(label=("Select how to sort matching records."), options=filter_options,
+                                                    format_func=st_utils.pretty_filter_option, help=(docs.sort_options_help))
+
+        highlight_button = highlight_col.checkbox("Highlight common fields", value=True,
+                                                  help="Highlight field values that are common between two or more records.")
+
+
+    if not lang_select:
+        lang_select = all_languages
+    record_filter = match_df["language"].isin(lang_select) & st_utils.filter_pub_date(match_df, *date_slider)
+    filtered_df = match_df[record_filter].copy()
+    st.session_state["filtered_df"] = filtered_df
+    sorted_filtered_df = filtered_df.sort_values(by=sort_options, ascending=False)
+
+    if align_subjects:
+        marc_table_all_recs_df = st_utils.align_marc_table(card_view["marc_long"], sorted_filtered_df.index.tolist())
+    else:
+        formatted_records = [card_view["formatted_records"][i] for i in sorted_filtered_df.index]
+        marc_table_all_recs_df = pd.concat(formatted_records, axis=1).sort_index(key=st_utils.sort_fields_idx)
+    st.session_state["marc_table_all_recs_df"] = marc_table_all_recs_df  # for testing
+
+    marc_table_filtered_recs = st_utils.filter_on_generic_fields(marc_table_all_recs_df, search_on_marc_fields,
+                                                                 search_terms, include_recs_without_field)
+    st.session_state["marc_table_filtered_recs"] = marc_table_filtered_recs  # for testing
+    match_ids = marc_table_filtered_recs.columns.tolist()
+
+    record = "records"
+    if len(records_to_ignore) == 1: record = "record"
+    n_displayed = min([max_to_display, len(match_ids)])
+    filtered_records_text = f"""
+    [Max records to display](#filters) set to {max_to_display}. Displaying {n_displayed} of {len(match_ids)} filtered records.\n
+    {len(match_df)} total records.  
+    {len(match_df) - len(match_ids)} removed by filters.  
+    {len(records_to_ignore)} incorrect {record} removed by user.
+    """
+    filtered_records_container.write(filtered_records_text)
+
+    records_to_display = [x for x in match_ids if x not in records_to_ignore]
+    excluded_fields = ["063", "064", "068", "072", "078", "079", "250", "776"]
+    useful_fields = ~marc_table_all_recs_df.index.droplevel(1).isin(excluded_fields)
+    marc_grid_df = marc_table_all_recs_df.loc[useful_fields, records_to_display[:max_to_display]].dropna(how="all")
+
+    minimal_repeat_fields = [x for x in marc_grid_df.index.droplevel(1) if x[0] in ["3", "6"]]
+    minimal_fields = minimal_repeat_fields + ["100", "245", "260", "880"]  # 100, 245, 260, 300s, 600s, 880s
+    if minimal_cataloguing_view:
+        marc_grid_df = marc_grid_df.loc[marc_grid_df.index.droplevel(1).isin(minimal_fields)]
+
+    # Rows that are the same in every record are summarised once rather than sent to the grid
+    if differences_only and marc_grid_df.shape[1] > 1:
+        differs = st_utils.differing_rows(marc_grid_df)
+        identical_fields = marc_grid_df.loc[~differs].iloc[:, :1].set_axis(["Value"], axis=1).reset_index()
+        marc_grid_df = marc_grid_df.loc[differs]
+        with identical_fields_container.expander(f"{len(identical_fields)} fields identical in all displayed records"):
+            st.dataframe(identical_fields, hide_index=True)
+
+    marc_grid_df = marc_grid_df.reset_index().transform(lambda x: x.str.replace(r"\$\w", st_utils.new_line, regex=True))
+    marc_grid_df.columns = [str(x) for x in marc_grid_df.columns]
+
+    # for testing
+    st.session_state["marc_grid_df"] = marc_grid_df
+    existing_match = cards_df.loc[card_idx, "selected_match"]
+    st.session_state["ag"] = st_utils.update_marc_table(marc_table, marc_grid_df, highlight_button, existing_match)
+
+    select_col, derive_col = st.columns([0.35, 0.35], gap="large")
+    with select_col:
+        selection_panel(cards_df, card_idx, cluster, records_to_display[:max_to_display], writer, work_queue, table_df)
+    with derive_col:
+        derivation_panel(cards_df, card_idx, cluster, writer, table_df)
+
+
+@st.fragment(key="card")
+def card_panel(cards_df: pd.DataFrame, writer: WriteBehind, work_queue: LeaseQueue, table_df: pd.DataFrame) -> None:
+    """
+    Everything below the card table, it all shows the reviewed card so saving a match reruns it with the card table
+    """
+    card_idx = reviewed_card(cards_df)
+    st.session_state["card_idx"] = card_idx
+
+    work_queue.renew(st.session_state["reviewer"])
+    if work_queue.holder(card_idx) not in [None, st.session_state["reviewer"]]:
+        st.warning(docs.card_leased_warning)
+
+    cluster = st_utils.cluster_members(cards_df, card_idx)
+    if len(cluster) > 1:
+        other_ids = cards_df.loc[cluster.drop(card_idx), "simple_id"].astype(str)
+        st.info(docs.cluster_info.format(n=len(cluster) - 1, ids=", ".join(other_ids)))
+
+    st.session_state["existing_match"] = cards_df.loc[card_idx, "selected_match"]
+    st.session_state["match_exists"] = isinstance(st.session_state["existing_match"], int)
+
+    if st.session_state["match_exists"]:
+        apparent_oclc_num = cards_df.loc[card_idx, "selected_match_ocn"]
+        actual_oclc_num = cards_df.loc[card_idx, "worldcat_matches"][st.session_state["existing_match"]].get_fields("001")[0].data
+        if apparent_oclc_num != actual_oclc_num:
+            st.warning(docs.oclc_num_warning)
+
+    st.write("\n")
+    st.subheader("Select from Worldcat results")
+
+    card_xml = cards_df.loc[card_idx, "xml"]
+
+    search_ti = cards_df.loc[card_idx, 'title'].replace(' ', '+')
+    search_au = cards_df.loc[card_idx, 'author'].replace(' ', '+')
+    search_term = f"https://www.worldcat.org/search?q=ti%3A{search_ti}+AND+au%3A{search_au}"
+
+    ic_left, ic_centred = st.columns([0.3, 0.7])
+    if pd.notna(card_xml):  # cards streamed from a Worldcat fetch have no card image
+        ic_centred.image(os.path.join("data/raw/chinese/1016992", card_xml[:-5] + ".jpg"), use_column_width=True)
+    label_text = f"""You can check the [Worldcat search]({search_term}) for this card"""
+    ic_left.write(label_text)
+
+    with ic_left:
+        shelfmark_input(cards_df, card_idx, writer, table_df)
+
+    filtered_records_container = ic_left.container()  # not an empty(), the nested review fragment can only write to blocks
+
+    minimal_cataloguing_view = ic_left.toggle("Minimal cataloguing view", value=True, help=docs.min_cat_help_text)
+    align_subjects = ic_left.toggle("Align subject headings", value=False, help=docs.align_subjects_help)
+    differences_only = ic_left.toggle("Differences only", value=False, help=docs.differences_only_help)
+
+    # Usually built in the background while the previous card was being reviewed, shared so don't modify
+    card_view_cache = st_utils.load_card_view_cache(str(st.session_state["save_file"]))
+    card_view = card_view_cache.get(card_idx, *st_utils.card_view_args(cards_df, card_idx, cfg.LANG_DICT))
+
+    review_panel(cards_df, card_idx, cluster, card_view, writer, work_queue, table_df, filtered_records_container,
+                 minimal_cataloguing_view, align_subjects, differences_only)
+
+    # Build the views of the cards most likely to be opened next while this one is reviewed
+    table_next = cards_df.index[cards_df.index.get_loc(card_idx) + 1:][:2].tolist()
+    for next_idx in work_queue.peek(2) + table_next:
+        if isinstance(cards_df.loc[next_idx, "worldcat_matches"], list):
+            card_view_cache.prefetch(next_idx, *st_utils.card_view_args(cards_df, next_idx, cfg.LANG_DICT))
+
+
+card_panel(cards_df, card_writer, work_queue, card_table_df)
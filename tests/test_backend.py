@@ -1,8 +1,102 @@
 import pickle
+import numpy as np
+import pandas as pd
 import src.utils.streamlit_utils as su
 
 
 def test_df_cols():
     SAVE_FILE = "data/processed/401_cards.p"
     cards_df = pickle.load(open(SAVE_FILE, "rb"))
-    assert "worldcat_matches" in cards_df.columns
\ No newline at end of file
+    assert "worldcat_matches" in cards_df.columns
+
+
+def test_align_marc_table():
+    from pymarc import Field, Record, Subfield
+
+    def record(ocn, subjects):
+        rec = Record()
+        rec.add_field(Field(tag="001", data=ocn))
+        for subject in subjects:
+            rec.add_field(Field(tag="650", indicators=[" ", "0"], subfields=[Subfield("a", subject)]))
+        return rec
+
+    records = pd.Series({
+        0: record("1", ["History", "China"]),
+        1: record("2", ["China", "Poetry", "China"]),
+    })
+    table = su.align_marc_table(su.marc_fields_long(records), [1, 0])
+    assert table.columns.to_list() == [1, 0]
+    assert table.index.names == ["Field", "Repeat Field ID"]
+    subjects = table.loc["650"]
+    assert len(subjects) == 4  # History, China, China again, Poetry
+    china = subjects[subjects[0].str.endswith("$aChina", na=False)]
+    assert china[1].str.endswith("$aChina").to_list() == [True]  # the shared heading is on one row
+    assert table.loc[("001", ""), 1] == "2"
+
+
+def test_pub_date_range():
+    from pymarc import parse_xml_to_array
+
+    records = parse_xml_to_array("tests/date_types.xml")
+    ranges = {r.get_fields("008")[0].data[6]: su.get_pub_date_range(r) for r in records}
+    assert ranges["s"] == (1979, 1979)
+    assert ranges["r"] == (1970, 1970)  # reprint date, not the unknown original
+    assert ranges["m"] == (1969, 1971)
+    assert ranges["c"] == (1970, 9999)  # 197u, still published
+    assert ranges["n"] == (None, None)  # no dates in the 008 or a year in 260$c
+
+    record_df = pd.DataFrame({
+        "publication_start": pd.array([1939, 1960, None, 1970], dtype="Int64"),
+        "publication_end": pd.array([1939, 1969, None, 9999], dtype="Int64")
+    })
+    assert su.filter_pub_date(record_df, 1939, 1946).tolist() == [True, False, True, False]
+    assert su.filter_pub_date(record_df, 1965, 1980).tolist() == [False, True, True, True]
+    assert su.pub_years(record_df).tolist() == [1939, 1960, 1969, 1970]
+
+
+def test_differing_rows():
+    marc_df = pd.DataFrame(
+        {0: ["a", "b", None, "d"], 1: ["a", "c", None, None], 2: ["a", "b", None, "d"]},
+        index=pd.MultiIndex.from_tuples([("245", 0), ("260", 0), ("300", 0), ("650", 0)])
+    )
+    assert su.differing_rows(marc_df).tolist() == [False, True, False, True]
+    assert su.differing_rows(marc_df[[0]]).tolist() == [True] * 4
+
+
+def test_update_card_rows():
+    cards = pd.DataFrame({
+        "simple_id": [1, 2], "title": ["A", "B"], "selected_match_ocn": ["ocm1", None], "shelfmark": ["ORB.1", "ORB.2"]
+    }, index=[10, 11])
+    table_df = su.card_table_df(cards, ["simple_id", "selected_match_ocn", "shelfmark"])
+    assert table_df.loc[10, "selected_match_ocn"] == "1" and pd.isna(table_df.loc[11, "selected_match_ocn"])
+
+    cards.loc[11, ["selected_match_ocn", "shelfmark"]] = ["on22", "ORB.3"]
+    cards.loc[10, "shelfmark"] = "ORB.10"  # not passed so not rebuilt
+    su.update_card_rows(table_df, cards, [11])
+    assert table_df.loc[11].tolist() == [2, "22", "ORB.3"]
+    assert table_df.loc[10, "shelfmark"] == "ORB.1"
+
+
+def test_session_cards(tmp_path):
+    import fsspec
+    from src.utils.card_store import CardStore
+    from src.utils.write_behind import WriteBehind
+
+    cards = pd.DataFrame({
+        "simple_id": [1, 2], "title": ["A", "A"], "author": [None, "B"], "isbn": [None, None], "brief_bibs": [{}, {}],
+        "worldcat_matches": [[], []], "selected_match": [None, None], "selected_match_ocn": [None, None],
+        "derivation_complete": [None, None], "shelfmark": ["ORB.1", "ORB.2"]
+    }, index=[10, 11])
+    shared = su.prepare_cards(cards)
+    assert "brief_bibs" not in shared and "brief_bibs" in cards
+    assert shared.loc[10, "author"] == ""
+
+    store = CardStore(fsspec.filesystem("file"), str(tmp_path / "edits"))
+    store.write(11, {"selected_match_ocn": "ocm1"})
+    writer = WriteBehind(store, journal_dir=str(tmp_path / "journal"))
+    view = su.session_cards(shared, writer)
+    assert view.loc[11, "selected_match_ocn"] == "ocm1"
+    assert su.save_card(writer, view, 10, {"shelfmark": "ORB.10"})
+    assert view.loc[10, "shelfmark"] == "ORB.10"
+    assert shared.loc[10, "shelfmark"] == "ORB.1" and pd.isna(shared.loc[11, "selected_match_ocn"])
+    assert np.shares_memory(view["worldcat_matches"].to_numpy(), shared["worldcat_matches"].to_numpy())  # not copied
@@ -0,0 +1,53 @@
+import pandas as pd
+
+import src.data.bib_extraction as be
+
+
+page_lines = {
+    "0_title.xml": ["A TALE OF", "TWO CITIES", "DICKENS (Charles)"],
+    "0_isbn.xml": ["Penguin Classics", "ISBN O-14-O44913-2"],
+    "1_title.xml": ["ONLY ONE LINE"],
+    "1_isbn.xml": ["ISBN 978-0-19-953556-9 (pbk)"],
+    "2_title.xml": ["TITLE", "AUTHOR"],
+    "2_isbn.xml": ["ISBN 1234567890"],
+    "3_isbn.xml": [],
+}
+
+
+def test_validate_isbns():
+    raw = pd.Series(["0-14-044913-2", "978 0 19 953556 9", "O8O442957X", "1234567890", "9780199535560", None])
+    validated = be.validate_isbns(raw)
+    assert validated["isbn_valid"].tolist() == [True, True, True, False, False, False]
+    assert validated["isbn"].tolist()[:3] == ["9780140449136", "9780199535569", "9780804429573"]
+    assert validated["isbn"].isna().tolist()[3:] == [True, True, True]
+
+
+def test_isbn10_to_isbn13():
+    assert be.isbn10_to_isbn13("0140449132") == "9780140449136"
+    assert be.isbn10_to_isbn13("080442957X") == "9780804429573"
+
+
+def test_extract_bib_table():
+    bib_table = be.extract_bib_table(page_lines)
+    assert bib_table.dtypes.astype(str).to_dict() == be.BIB_TABLE_DTYPES
+    assert bib_table["work"].tolist() == ["0", "1", "2", "3"]
+
+    work_0 = bib_table.iloc[0]
+    assert work_0["title"] == "A TALE OF TWO CITIES"
+    assert work_0["author"] == "DICKENS (Charles)"
+    assert work_0["isbn_raw"] == "O-14-O44913-2"
+    assert work_0["isbn"] == "9780140449136"
+
+    assert pd.isna(bib_table.loc[1, "title"])  # a single line can't be split into title/author
+    assert bib_table["isbn_valid"].tolist() == [True, True, False, False]
+    assert bib_table["isbn"].isna().tolist() == [False, False, True, True]
+
+
+def test_cluster_cards():
+    df = pd.DataFrame({
+        "title": ["Féng ling du", "FENG LING DU.", "Other", "Other", None, "Vol", "Vol"],
+        "author": ["Duanmu", "duanmu", None, "X", None, "A", "A"],
+        "isbn": [None, None, "0140449132", "9780140449136", None, "9780199535569", "9780140449136"]
+    }, index=list("abcdefg"))
+    # copies match on title/author or ISBN, different ISBNs are different works even with the same title
+    assert be.cluster_cards(df).tolist() == ["a", "a", "c", "c", "e", "f", "c"]
@@ -0,0 +1,85 @@
+import fsspec
+import pandas as pd
+import pytest
+
+from src.utils import card_store
+from src.utils.card_store import CardStore, CardConflict, ManifestConflict, compact, store_root
+
+
+@pytest.fixture()
+def cards():
+    return pd.DataFrame(
+        {"selected_match": [None, None], "selected_match_ocn": [None, None], "derivation_complete": [None, None],
+         "shelfmark": ["ORB.1", "ORB.2"]},
+        index=[10, 11], dtype=object
+    )
+
+
+def test_store_root():
+    assert store_root("cac-bucket/chinese_matches.p") == "cac-bucket/chinese_matches_edits"
+    assert store_root("data\\processed\\chinese_matches.p") == "data/processed/chinese_matches_edits"
+
+
+def test_sync_between_sessions(tmp_path, cards):
+    fs = fsspec.filesystem("file")
+    alice, bob = CardStore(fs, str(tmp_path)), CardStore(fs, str(tmp_path))
+    assert alice.sync() == []
+
+    alice.write(10, {"selected_match": 2, "selected_match_ocn": "ocm123"})
+    assert bob.sync() == ["10"]
+    bob_cards = bob.apply(cards.copy())
+    assert bob_cards.loc[10, "selected_match_ocn"] == "ocm123"
+    assert bob_cards.loc[11, "selected_match_ocn"] is None
+    assert bob.sync() == []  # manifest unchanged
+
+    # bob has seen alice's edit so can build on it
+    bob.write(10, {"derivation_complete": True})
+    assert alice.sync() == ["10"]
+    assert alice.records["10"]["selected_match_ocn"] == "ocm123"
+    assert alice.version(10) == 2
+
+
+def test_write_conflict(tmp_path, cards):
+    fs = fsspec.filesystem("file")
+    alice, bob = CardStore(fs, str(tmp_path)), CardStore(fs, str(tmp_path))
+    alice.write(11, {"shelfmark": "ORB.22"})
+
+    with pytest.raises(CardConflict) as e:
+        bob.write(11, {"shelfmark": "ORB.99"})  # bob hasn't synced so would overwrite alice
+    assert e.value.record["shelfmark"] == "ORB.22"
+    assert bob.version(11) == 1
+
+    bob.write(11, {"shelfmark": "ORB.99"})
+    assert compact(CardStore(fs, str(tmp_path)), cards).loc[11, "shelfmark"] == "ORB.99"
+    assert cards.loc[11, "shelfmark"] == "ORB.2"
+
+
+def test_manifest_race(tmp_path, monkeypatch):
+    fs = fsspec.filesystem("file")
+    alice, bob = CardStore(fs, str(tmp_path)), CardStore(fs, str(tmp_path))
+    alice.write(10, {"shelfmark": "ORB.11"}, manifest=False)
+    bob.write(11, {"shelfmark": "ORB.22"}, manifest=False)
+
+    # both read the same manifest version, bob's write loses the race and is merged into alice's manifest
+    read_version = alice.latest_manifest_version()
+    monkeypatch.setattr(CardStore, "latest_manifest_version", lambda self: read_version)
+    alice.update_manifest({"10": 1})
+    with pytest.raises(ManifestConflict):
+        bob.update_manifest({"11": 1})
+    monkeypatch.undo()
+
+    bob.update_manifest({"11": 1})
+    carol = CardStore(fs, str(tmp_path))
+    assert sorted(carol.sync()) == ["10", "11"]
+    assert carol.manifest_version == 2
+
+
+def test_legacy_manifest(tmp_path):
+    fs = fsspec.filesystem("file")
+    alice = CardStore(fs, str(tmp_path))
+    alice.write(10, {"shelfmark": "ORB.11"}, manifest=False)
+    fs.pipe_file(f"{tmp_path}/{card_store.LEGACY_MANIFEST}", b'{"10": 1}')
+    assert CardStore(fs, str(tmp_path)).sync() == ["10"]
+
+    alice.update_manifest({"10": 1})  # already in the legacy manifest
+    assert alice.latest_manifest_version() == 0
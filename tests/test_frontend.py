@@ -1,8 +1,11 @@
 import os
 import pickle
+import fsspec
 import pytest
 from streamlit.testing.v1 import AppTest
 
+from src.utils.card_store import CardStore, compact, store_root
+
 
 @pytest.fixture()
 def cards():
@@ -52,27 +55,27 @@ def test_remove_record(app):
 
 def test_cat_lang(app):
     app.run()
-    assert app.session_state["filtered_df"].shape == (9, 12)
+    assert app.session_state["filtered_df"].shape == (9, 13)
 
     app.multiselect[1].set_value([])  # remove same record as test_max_to_display
     app.button[0].click()
     app.run()
-    assert app.session_state["filtered_df"].shape == (12, 12)
+    assert app.session_state["filtered_df"].shape == (12, 13)
 
 
 def test_pub_year(app):
     app.run()
-    assert app.session_state["filtered_df"].shape == (9, 12)
+    assert app.session_state["filtered_df"].shape == (9, 13)
 
     app.select_slider[0].set_value([1939, 1946])  # remove same record as test_max_to_display
     app.button[0].click()
     app.run()
-    assert app.session_state["filtered_df"].shape == (7, 12)
+    assert app.session_state["filtered_df"].shape == (6, 13)  # [196-?] in 260$c, dated 196u in the 008, now excluded
 
     app.select_slider[0].set_value([1939, 1939])  # remove same record as test_max_to_display
     app.button[0].click()
     app.run()
-    assert app.session_state["filtered_df"].shape == (5, 12)
+    assert app.session_state["filtered_df"].shape == (4, 13)
 
 
 def test_generic_filter(app):
@@ -177,6 +180,15 @@ def test_cards():
     return pickle.load(open("tests\\10_cards_test.p", "rb"))
 
 
+def saved_cards(app, cards):
+    """
+    Cards with every edit saved to the card store applied, as another session would see them
+    """
+    app.session_state["card_writer"].flush()
+    store = CardStore(fsspec.filesystem("file"), store_root(app.session_state["save_file"]))
+    return compact(store, cards)
+
+
 def test_save_match(test_cards, app, tmp_path):
     subset = ["simple_id", "title", "author", "selected_match_ocn", "derivation_complete", "shelfmark", "lines"]
     assert test_cards.loc[:, subset].shape == (10, 7)
@@ -194,14 +206,14 @@ def test_save_match(test_cards, app, tmp_path):
     app.columns[14].button[1].click()
     app.run()
     assert app.dataframe[0].value.iloc[0]["selected_match_ocn"] is None  # sometimes gets cast to str
-    assert pickle.load(open(app.session_state["save_file"], "rb")).iloc[0]["selected_match_ocn"] is None
+    assert saved_cards(app, test_cards).iloc[0]["selected_match_ocn"] is None
 
     app.columns[14].radio[0].set_value(0)
     app.columns[14].button[0].click()
     app.run()
     assert app.dataframe[0].value.iloc[0]["selected_match_ocn"] == "23921305"
-    assert os.path.exists(app.session_state["save_file"])
-    assert pickle.load(open(app.session_state["save_file"], "rb")).iloc[0]["selected_match_ocn"] == "ocm23921305"
+    assert os.path.exists(store_root(app.session_state["save_file"]))
+    assert saved_cards(app, test_cards).iloc[0]["selected_match_ocn"] == "ocm23921305"
 
     # test non-default card
     app.session_state["readable_card_id"] = 5
@@ -209,13 +221,13 @@ def test_save_match(test_cards, app, tmp_path):
     app.columns[14].button[0].click()
     app.run()
     assert app.dataframe[0].value.iloc[4]["selected_match_ocn"] == "11283982"  # sometimes gets cast to str
-    assert pickle.load(open(app.session_state["save_file"], "rb")).iloc[4]["selected_match_ocn"] == "ocm11283982"
+    assert saved_cards(app, test_cards).iloc[4]["selected_match_ocn"] == "ocm11283982"
 
     app.session_state["readable_card_id"] = 5
     app.columns[14].button[1].click()
     app.run()
     assert app.dataframe[0].value.iloc[4]["selected_match_ocn"] is None  # sometimes gets cast to str
-    assert pickle.load(open(app.session_state["save_file"], "rb")).iloc[4]["selected_match_ocn"] is None
+    assert saved_cards(app, test_cards).iloc[4]["selected_match_ocn"] is None
 
 
 def test_save_and_clear(test_cards, app, tmp_path):
@@ -239,7 +251,7 @@ def test_save_and_clear(test_cards, app, tmp_path):
     assert app.session_state["readable_card_id"] == 6
     assert app.dataframe[0].value.iloc[0]["selected_match_ocn"] == "23921305"
     assert app.dataframe[0].value.iloc[5]["selected_match_ocn"] is None
-    assert pickle.load(open(app.session_state["save_file"], "rb")).iloc[5]["selected_match_ocn"] is None
+    assert saved_cards(app, test_cards).iloc[5]["selected_match_ocn"] is None
 
 
 cards_df = pickle.load(open("data\\processed\\chinese_matches.p", "rb"))
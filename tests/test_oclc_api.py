@@ -0,0 +1,365 @@
+import asyncio
+import gc
+import time
+
+from bookops_worldcat.errors import WorldcatRequestError
+
+import src.data.oclc_api as oa
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+def brief_rec(ocn, isbns):
+    return {"oclcNumber": ocn, "isbns": isbns}
+
+
+def test_batch_isbn_query():
+    assert oa.batch_isbn_query(["9780140449136", "0140449132", "9780140449136"]) == "bn:9780140449136 OR bn:0140449132"
+
+
+def test_isbn_match_key():
+    assert oa.isbn_match_key("0-14-044913-2") == "9780140449136"
+    assert oa.isbn_match_key("978 0 14 044913 6") == "9780140449136"
+
+
+def test_demux_isbn_batch():
+    isbns = {"1": "9780140449136", "2": "0-19-953556-3", "3": "9780000000002"}
+    brief_bibs = {
+        "numberOfRecords": 3,
+        "briefRecords": [
+            brief_rec("1", ["9780140449136", "0140449132"]),
+            brief_rec("2", ["9780140449136"]),
+            brief_rec("3", ["9780199535569"]),
+        ]
+    }
+    resolved, ambiguous = oa.demux_isbn_batch(brief_bibs, isbns)
+    assert ambiguous == []
+    assert [x["oclcNumber"] for x in resolved["1"]["briefRecords"]] == ["1", "2"]
+    assert resolved["2"]["numberOfRecords"] == 1  # ISBN-10 on card matched to ISBN-13 in record
+    assert resolved["3"] == {"numberOfRecords": 0, "briefRecords": []}
+
+    # a record that can't be assigned means cards without matches might own it
+    brief_bibs["briefRecords"].append(brief_rec("4", []))
+    brief_bibs["numberOfRecords"] = 4
+    resolved, ambiguous = oa.demux_isbn_batch(brief_bibs, isbns)
+    assert ambiguous == ["3"]
+    assert set(resolved) == {"1", "2"}
+
+    # truncated results mean any card could be missing records
+    brief_bibs["numberOfRecords"] = 60
+    resolved, ambiguous = oa.demux_isbn_batch(brief_bibs, isbns)
+    assert resolved == {}
+    assert ambiguous == ["1", "2", "3"]
+
+
+def test_batch_search_brief_bib_isbn():
+    class FakeSession:
+        def __init__(self):
+            self.queries = []
+
+        async def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            isbns = [x[3:] for x in q.split(" OR ")]
+            recs = [brief_rec(isbn, [isbn]) for isbn in isbns if not isbn.endswith("0")]
+            return FakeResponse({"numberOfRecords": len(recs), "briefRecords": recs})
+
+    session = FakeSession()
+    isbns = {i: f"97800000000{i:02d}" for i in range(25)}
+    resolved, ambiguous = asyncio.run(oa.batch_search_brief_bib_isbn(isbns, session=session, batch_size=10))
+    assert len(session.queries) == 3
+    assert ambiguous == []
+    assert resolved[1]["briefRecords"][0]["oclcNumber"] == "9780000000001"
+    assert resolved[10]["numberOfRecords"] == 0
+
+
+def test_rate_budget():
+    budget = oa.RateBudget(max_calls=10, period=60, headroom=0.8)
+    budget.record(n=7)
+    assert budget.used() == 7
+    assert not budget.near_limit()
+    budget.record()
+    assert budget.near_limit()
+    assert not oa.speculate("title", "9780140449136", True, budget)
+    assert oa.speculate("title", "9780140449136", True, oa.RateBudget())
+    assert not oa.speculate(None, "9780140449136", True, None)
+
+
+def test_rate_budget_acquire():
+    budget = oa.RateBudget(max_calls=2, period=0.2)
+
+    async def calls():
+        t0 = time.monotonic()
+        await asyncio.gather(*[budget.acquire() for _ in range(5)])
+        return time.monotonic() - t0
+
+    assert asyncio.run(calls()) >= 0.4  # 5 calls at 2 per 0.2s need 3 windows
+    assert budget.used() <= 2
+
+
+def test_speculative_search():
+    class FakeSession:
+        def __init__(self, isbn_hits):
+            self.isbn_hits = isbn_hits
+            self.cancelled = False
+
+        async def brief_bibs_search(self, q, **kwargs):
+            if q.startswith("bn:"):
+                await asyncio.sleep(0.01)
+                return FakeResponse({"numberOfRecords": self.isbn_hits, "briefRecords": []})
+            try:
+                await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+            return FakeResponse({"numberOfRecords": 3, "briefRecords": []})
+
+    budget = oa.RateBudget()
+    session = FakeSession(isbn_hits=1)
+    res = asyncio.run(oa.async_search_brief_bib_cac(
+        "title", "author", "9780140449136", session=session, speculative=True, budget=budget
+    ))
+    assert res["numberOfRecords"] == 1
+    assert session.cancelled
+    assert budget.used() == 2
+
+    session = FakeSession(isbn_hits=0)
+    res = asyncio.run(oa.async_search_brief_bib_cac("title", "author", "9780140449136", session=session, speculative=True))
+    assert res["numberOfRecords"] == 3
+    assert not session.cancelled
+
+    res = asyncio.run(oa.async_search_brief_bib_cac(None, None, "9780140449136", session=session))
+    assert res["numberOfRecords"] == 0  # no title to fall back to
+
+
+def test_speculative_search_sync():
+    class FakeSession:
+        def __init__(self):
+            self.queries = []
+
+        def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            return FakeResponse({"numberOfRecords": 0 if q.startswith("bn:") else 3})
+
+    class FakeExecutor(oa.ThreadPoolExecutor):
+        submitted = 0
+
+        def submit(self, *args, **kwargs):
+            self.submitted += 1
+            return super().submit(*args, **kwargs)
+
+    budget, session = oa.RateBudget(max_calls=10, headroom=0.5), FakeSession()
+    with FakeExecutor(max_workers=1) as executor:
+        for _ in range(3):
+            res = oa.search_brief_bib("title", "author", "9780140449136", session=session, speculative=True,
+                                      budget=budget, executor=executor)
+            assert res["numberOfRecords"] == 3
+    assert executor.submitted == 2  # the third didn't fit in the budget's headroom so ran one search at a time
+    assert budget.used() == 6
+    assert len(session.queries) == 6
+
+
+def test_process_queue_priorities():
+    class FakeSession:
+        def __init__(self):
+            self.queries = []
+
+        async def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            if q == 'ti:"flaky" and au:"b"' and self.queries.count(q) == 1:
+                raise WorldcatRequestError("500 Server Error")
+            n = 0 if q.startswith("bn:") else 1
+            return FakeResponse({"numberOfRecords": n, "briefRecords": [{"oclcNumber": q}] * n})
+
+        async def bib_get(self, oclc_num):
+            self.queries.append(oclc_num)
+            raise WorldcatRequestError("404 Client Error")
+
+    async def run(session, brief_bibs, full_bibs):
+        queue = asyncio.PriorityQueue()
+        for item in [
+            oa.BriefBibSearch.for_card(0, "flaky", "b", None),
+            oa.MusicSearch.for_record(1, "score", "c", 1900),
+            oa.BriefBibSearch.for_card(2, "title", "a", "9780140449136"),
+            oa.FullBibFetch.for_record(3, "ocn2", rank=2),
+            oa.FullBibFetch.for_record(3, "ocn1", rank=1),
+        ]:
+            await queue.put(item)
+        worker = asyncio.create_task(oa.process_queue(queue, session=session, brief_bibs_out=brief_bibs, full_bibs_out=full_bibs))
+        await queue.join()
+        worker.cancel()
+
+    session, brief_bibs, full_bibs = FakeSession(), {}, {3: []}
+    asyncio.run(run(session, brief_bibs, full_bibs))
+    assert session.queries == [
+        "bn:9780140449136", "ocn1", "ocn2",  # ISBNs then full records in review order
+        'ti:"flaky" and au:"b"', 'ti:"score" AND au:"c" AND yr:1900', 'ti:"title" and au:"a"',  # fallbacks
+        'ti:"flaky" and au:"b"', "ocn1", "ocn2",  # retries
+    ]
+    assert brief_bibs[0]["numberOfRecords"] == 1
+    assert brief_bibs[1]["numberOfRecords"] == 1  # music searches reach their branch
+    assert brief_bibs[2]["briefRecords"][0]["oclcNumber"] == 'ti:"title" and au:"a"'
+    assert full_bibs[3] == ["404 Client Error", "404 Client Error"]
+
+
+def marcxml_doc(ocn):
+    from pymarc import Field, Record, record_to_xml
+    record = Record()
+    record.add_field(Field(tag="001", data=ocn))
+    return record_to_xml(record, namespace=True).decode("utf-8")
+
+
+def test_marcxml_parser():
+    from concurrent.futures import ProcessPoolExecutor
+
+    class FakeXml:
+        def __init__(self, text):
+            self.text = text
+
+    class FakeSession:
+        async def bib_get(self, oclc_num):
+            await asyncio.sleep(0)
+            return FakeXml(marcxml_doc(oclc_num))
+
+    async def run(parser, full_bibs):
+        queue = asyncio.PriorityQueue()
+        for i in range(5):
+            await queue.put(oa.FullBibFetch.for_record(0, f"ocn{i}", rank=i))
+        workers = [
+            asyncio.create_task(oa.process_queue(queue, session=FakeSession(), full_bibs_out=full_bibs, parser=parser))
+            for _ in range(5)
+        ]
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        submissions = []
+        submit = executor.submit
+        executor.submit = lambda *args, **kwargs: submissions.append(args) or submit(*args, **kwargs)
+        parser, full_bibs = oa.MarcXmlParser(executor, batch_size=3), {0: []}
+        asyncio.run(run(parser, full_bibs))
+        parser.close()
+
+    assert sorted(x["001"].data for x in full_bibs[0]) == [f"ocn{i}" for i in range(5)]
+    assert [len(x[1]) for x in submissions] == [3, 2]  # batched, the last batch sent after the delay
+
+    records = oa.parse_marcxml_batch([marcxml_doc("ocn1"), "<record"])
+    assert records[0]["001"].data == "ocn1" and isinstance(records[1], Exception)
+
+
+def test_process_queue_parse_error():
+    class FakeXml:
+        def __init__(self, text):
+            self.text = text
+
+    class FakeSession:
+        async def bib_get(self, oclc_num):
+            return FakeXml("<record" if oclc_num == "bad" else marcxml_doc(oclc_num))
+
+    async def run(parser, full_bibs):
+        queue = asyncio.PriorityQueue()
+        for ocn in ["bad", "ocn1"]:
+            await queue.put(oa.FullBibFetch.for_record(0, ocn))
+        worker = asyncio.create_task(oa.process_queue(queue, session=FakeSession(), full_bibs_out=full_bibs, parser=parser))
+        await asyncio.wait_for(queue.join(), timeout=5)  # the bad record doesn't end the worker
+        worker.cancel()
+
+    with oa.ThreadPoolExecutor(max_workers=1) as executor:
+        full_bibs = {0: []}
+        asyncio.run(run(oa.MarcXmlParser(executor), full_bibs))
+    assert isinstance(full_bibs[0][0], str) and full_bibs[0][1]["001"].data == "ocn1"
+
+
+def test_requeue():
+    async def run(maxsize):
+        queue = asyncio.PriorityQueue(maxsize=maxsize)
+        await queue.put(oa.FullBibFetch.for_record(0, "ocn1"))
+        item = await queue.get()
+        await queue.put(oa.FullBibFetch.for_record(1, "ocn2"))  # full for a bounded queue
+        oa.requeue(queue, item.retry())
+        gc.collect()  # the pending put survives collection
+        assert (await queue.get()).idx == 1
+        queue.task_done()
+        assert (await asyncio.wait_for(queue.get(), timeout=1)).idx == 0
+        queue.task_done()
+        await asyncio.wait_for(queue.join(), timeout=1)
+
+    asyncio.run(run(1))
+    asyncio.run(run(0))
+    assert not oa._requeue_tasks
+
+
+def test_rank_brief_records():
+    recs = [
+        {"oclcNumber": "1", "title": "Bleak house", "creator": "Charles Dickens", "generalFormat": "Video"},
+        {"oclcNumber": "2", "title": "Great expectations", "creator": "Charles Dickens", "generalFormat": "Book",
+         "catalogingInfo": {"catalogingLanguage": "eng"}},
+        {"oclcNumber": "3", "title": "Great expectations", "creator": "Dickens, Charles", "generalFormat": "Book",
+         "catalogingInfo": {"catalogingLanguage": "eng"}, "isbns": ["9780140439564"], "machineReadableDate": "1996"},
+        {"oclcNumber": "4", "title": "Great expectations", "creator": "Charles Dickens", "generalFormat": "Book"},
+    ]
+    brief_bibs = {"numberOfRecords": 4, "briefRecords": recs}
+    assert oa.rank_brief_records(brief_bibs, ti="GREAT EXPECTATIONS", au="Dickens, Charles") == ["2", "3", "4", "1"]
+    assert oa.rank_brief_records(brief_bibs, ti="Great expectations", isbn="0-14-043956-1") == ["3", "2", "4", "1"]
+    assert oa.rank_brief_records(brief_bibs, ti="Great expectations", year=1997)[0] == "3"
+    assert oa.rank_brief_records({"numberOfRecords": 0}) == []
+    assert oa.rank_brief_records("404 Client Error") == []
+
+
+def test_fetch_full_bibs():
+    class FakeXml:
+        def __init__(self, text):
+            self.text = text
+
+    class FakeSession:
+        def __init__(self):
+            self.fetched = []
+
+        async def bib_get(self, oclc_num):
+            self.fetched.append(oclc_num)
+            if oclc_num == "5":
+                raise WorldcatRequestError("404 Client Error")
+            return FakeXml(marcxml_doc(f"ocm{oclc_num}"))
+
+        def sync_bib_get(self, oclc_num):
+            self.fetched.append(oclc_num)
+            return FakeXml(marcxml_doc(f"ocn{oclc_num}"))
+
+    work_brief_bibs = {
+        "0": {"numberOfRecords": 4, "briefRecords": [brief_rec(x, []) for x in ["1", "2", "3", "4"]]},
+        "1": {"numberOfRecords": 2, "briefRecords": [brief_rec("5", []), brief_rec("1", ["9780140449136"])]},
+        "2": {"numberOfRecords": 0},
+    }
+    work_bib_info = {"1": {"ISBN": "9780140449136"}}
+    session = FakeSession()
+    with oa.ThreadPoolExecutor(max_workers=1) as executor:
+        full_bibs = asyncio.run(oa.fetch_full_bibs(
+            work_brief_bibs, work_bib_info, session, top_k=2, parser=oa.MarcXmlParser(executor)
+        ))
+    assert sorted(session.fetched) == ["1", "2", "5", "5"]  # "1" fetched once for both works, "5" retried
+    assert full_bibs["0"]["ranked"] == ["1", "2", "3", "4"]
+    assert [x["001"].data for x in full_bibs["0"]["records"]] == ["ocm1", "ocm2"]
+    assert full_bibs["1"]["ranked"] == ["1", "5"]  # ISBN match first
+    assert [x["001"].data for x in full_bibs["1"]["records"]] == ["ocm1"]
+    assert full_bibs["2"] == {"ranked": [], "records": []}
+
+    session.bib_get, session.fetched = session.sync_bib_get, []
+    assert [x["001"].data for x in oa.fetch_more_full_bibs(full_bibs["0"], session, n=1)] == ["ocn3"]
+    assert [x["001"].data for x in oa.fetch_more_full_bibs(full_bibs["1"], session)] == ["ocn5"]  # failed one retried
+    assert oa.fetch_more_full_bibs(full_bibs["1"], session) == []
+    assert session.fetched == ["3", "5"]
+    assert len(full_bibs["0"]["records"]) == 3
+
+
+def test_collect_full_bibs_missing_result():
+    record = oa.parse_marcxml(marcxml_doc("ocm1"))
+    fetched = {"1": [record], "2": [], "3": ["404 Client Error"]}  # "2" recorded no result
+    full_bibs = oa.collect_full_bibs({"0": ["1", "2", "3"], "1": ["2"]}, fetched, top_k=3)
+    assert full_bibs["0"]["records"] == [record]
+    assert full_bibs["1"] == {"ranked": ["2"], "records": []}
@@ -0,0 +1,222 @@
+import asyncio
+import os
+import pickle
+
+import src.data.pipeline as pl
+from src.data.oclc_api import BriefBibSearch
+
+
+def page_xml(lines):
+    text_lines = "".join(f"<TextLine><Coords/><TextEquiv><Unicode>{x}</Unicode></TextEquiv></TextLine>" for x in lines)
+    return (f"<PcGts><Metadata/><Page><TextRegion><Coords/>{text_lines}"
+            f"<TextEquiv><Unicode/></TextEquiv></TextRegion></Page></PcGts>")
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def json(self):
+        return self.data
+
+
+class FakeXml:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeSession:
+    def __init__(self):
+        self.queries, self.fetched = [], []
+
+    async def brief_bibs_search(self, q, **kwargs):
+        self.queries.append(q)
+        recs = [{"oclcNumber": x, "isbns": [x[3:]]} for x in q.split(" OR ")]
+        return FakeResponse({"numberOfRecords": len(recs), "briefRecords": recs})
+
+    async def bib_get(self, oclc_num):
+        self.fetched.append(oclc_num)
+        return FakeXml(f'<record xmlns="http://www.loc.gov/MARC21/slim"><controlfield tag="001">{oclc_num}</controlfield></record>')
+
+
+async def run_stages(doc_id, session, from_stage="parse"):
+    xml_q, lines_q, bib_q = (asyncio.Queue(maxsize=2) for _ in range(3))
+    stages = {
+        "parse": lambda: [
+            pl.files_stage(doc_id, xml_q), pl.parse_stage(doc_id, xml_q, lines_q), pl.bib_stage(doc_id, lines_q, bib_q)
+        ],
+        "bib": lambda: [pl.lines_checkpoint_stage(doc_id, lines_q), pl.bib_stage(doc_id, lines_q, bib_q)],
+        "oclc": lambda: [pl.bib_checkpoint_stage(doc_id, bib_q)],
+    }[from_stage]()
+    *_, brief_bibs = await asyncio.gather(*stages, pl.oclc_stage(doc_id, bib_q, session, n_workers=2))
+    return brief_bibs
+
+
+def test_pipeline_stages(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/raw/1")
+    for work, isbn in enumerate(["0-14-044913-2", "978-0-19-953556-9", "1234567890"]):
+        open(f"data/raw/1/{work}_title.xml", "w").write(page_xml(["TITLE", f"AUTHOR {work}"]))
+        open(f"data/raw/1/{work}_isbn.xml", "w").write(page_xml([f"ISBN {isbn}"]))
+
+    session = FakeSession()
+    brief_bibs = asyncio.run(run_stages(1, session))
+    assert set(brief_bibs) == {"0", "1", "2"}
+    isbn_queries = " OR ".join(q for q in session.queries if q.startswith("bn:"))
+    assert set(isbn_queries.split(" OR ")) == {"bn:9780140449136", "bn:9780199535569"}
+    assert 'ti:"TITLE" and au:"AUTHOR 2"' in session.queries  # invalid ISBN goes straight to title/author
+    assert len(pl.read_checkpoint(pl.checkpoint_path(1, "lines.jsonl"))) == 6
+    assert len(pl.read_checkpoint(pl.checkpoint_path(1, "bib_info.jsonl"))) == 3
+
+    # resuming skips works with checkpointed results
+    for from_stage in ["parse", "bib", "oclc"]:
+        session = FakeSession()
+        assert asyncio.run(run_stages(1, session, from_stage)) == brief_bibs
+        assert session.queries == []
+
+
+def test_read_checkpoint_truncated(tmp_path):
+    path = tmp_path / "x.jsonl"
+    pl.append_checkpoint(str(path), {"work": "0"})
+    with open(path, "a") as f:
+        f.write('{"work": "1", "bri')
+    assert pl.read_checkpoint(str(path)) == [{"work": "0"}]
+
+
+def test_pipeline_clusters(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/raw/1")
+    cards = [("0-14-044913-2", "A"), ("978-0-14-044913-6", "A"), ("1234567890", "B"), ("", "B")]
+    for work, (isbn, author) in enumerate(cards):
+        open(f"data/raw/1/{work}_title.xml", "w").write(page_xml(["TITLE", f"AUTHOR {author}"]))
+        open(f"data/raw/1/{work}_isbn.xml", "w").write(page_xml([f"ISBN {isbn}"]))
+
+    session = FakeSession()
+    brief_bibs = asyncio.run(run_stages(1, session))
+    assert set(brief_bibs) == {"0", "1", "2", "3"}
+    assert brief_bibs["0"] == brief_bibs["1"]
+    assert session.queries.count('ti:"TITLE" and au:"AUTHOR B"') == 1
+    isbn_queries = " OR ".join(q for q in session.queries if q.startswith("bn:"))
+    assert isbn_queries.split(" OR ") == ["bn:9780140449136"]
+    assert len(pl.read_checkpoint(pl.checkpoint_path(1, "brief_bibs.jsonl"))) == 4
+
+
+def test_run_batch_shares_pool(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for doc_id, isbn in [(1, "0-14-044913-2"), (2, "978-0-19-953556-9")]:
+        os.makedirs(f"data/raw/{doc_id}")
+        open(f"data/raw/{doc_id}/0_title.xml", "w").write(page_xml(["TITLE", f"AUTHOR {doc_id}"]))
+        open(f"data/raw/{doc_id}/0_isbn.xml", "w").write(page_xml([f"ISBN {isbn}"]))
+        open(f"data/raw/{doc_id}/1_title.xml", "w").write(page_xml(["TITLE", "AUTHOR X"]))
+        open(f"data/raw/{doc_id}/1_isbn.xml", "w").write(page_xml(["ISBN 1234567890"]))
+
+    session = FakeSession()
+
+    class FakeAsyncSession:
+        def __init__(self, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return session
+
+        async def __aexit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(pl.bw, "AsyncMetadataSession", FakeAsyncSession)
+    monkeypatch.setattr(pl, "fetch_full_bibs", None)  # full records are fetched on the shared pool's workers
+    results = asyncio.run(pl.run_batch([(0, 1), (0, 2), (0, 3)], from_stage="parse", n_workers=2, token="token"))
+    assert results[1]["0"]["briefRecords"][0]["oclcNumber"] == "bn:9780140449136"
+    assert results[2]["0"]["briefRecords"][0]["oclcNumber"] == "bn:9780199535569"
+    assert set(results[1]) == set(results[2]) == {"0", "1"}
+    assert results[3] == {}  # no pages, nothing to search
+    assert session.queries.count('ti:"TITLE" and au:"AUTHOR X"') == 2  # clustering is per document
+    assert os.path.exists(pl.checkpoint_path(2, "brief_bibs.p"))
+
+    full_bibs = pickle.load(open(pl.checkpoint_path(1, "full_bibs.p"), "rb"))
+    assert full_bibs["0"]["ranked"] == ["bn:9780140449136"]
+    assert full_bibs["0"]["records"][0]["001"].data == "bn:9780140449136"
+    assert session.fetched.count('ti:"TITLE" and au:"AUTHOR X"') == 2 and len(session.fetched) == 4
+    session.queries, session.fetched = [], []
+    asyncio.run(pl.run_batch([(0, 1)], from_stage="oclc", n_workers=2, token="token"))
+    assert session.queries == session.fetched == []  # searches and full records both checkpointed
+
+
+def test_full_bibs_stage_failed(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from bookops_worldcat.errors import WorldcatRequestError
+    from src.data.oclc_api import MarcXmlParser
+
+    monkeypatch.chdir(tmp_path)
+    pl.append_checkpoint(pl.checkpoint_path(1, "bib_info.jsonl"), {"work": "0", "title": "A"})
+
+    class FlakySession(FakeSession):
+        down = True
+
+        async def bib_get(self, oclc_num):
+            if oclc_num == "ocn2" and self.down:
+                raise WorldcatRequestError("500 Server Error")
+            return await super().bib_get(oclc_num)
+
+    brief_bibs = {
+        "0": {"numberOfRecords": 1, "briefRecords": [{"oclcNumber": "ocn1"}]},
+        "1": {"numberOfRecords": 1, "briefRecords": [{"oclcNumber": "ocn2"}]},
+    }
+    session = FlakySession()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        full_bibs = asyncio.run(pl.full_bibs_stage(1, brief_bibs, session, parser=MarcXmlParser(executor)))
+        assert full_bibs["1"]["records"] == []
+        assert set(pickle.load(open(pl.checkpoint_path(1, "full_bibs.p"), "rb"))) == {"0"}
+
+        session.down, session.fetched = False, []
+        full_bibs = asyncio.run(pl.full_bibs_stage(1, brief_bibs, session, parser=MarcXmlParser(executor)))
+    assert session.fetched == ["ocn2"]  # only the failed work is fetched again
+    assert full_bibs["1"]["records"][0]["001"].data == "ocn2"
+
+
+def test_pool_survives_other_errors():
+    class BrokenSession(FakeSession):
+        async def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            if "BROKEN" in q:
+                raise KeyError("numberOfRecords")  # e.g. a malformed response
+            return await super().brief_bibs_search(q, **kwargs)
+
+    async def run(session):
+        pool = pl.OclcWorkerPool(session, n_workers=1)
+        brief_bibs = {}
+        queue = pool.register(1, brief_bibs)
+        await queue.put(BriefBibSearch.for_card("0", "BROKEN", "A", None))
+        await queue.put(BriefBibSearch.for_card("1", "TITLE", "B", None))
+        await asyncio.wait_for(pool.join(1), timeout=5)
+        pool.close()
+        return brief_bibs
+
+    session = BrokenSession()
+    brief_bibs = asyncio.run(run(session))
+    assert brief_bibs["0"] == "'numberOfRecords'"
+    assert session.queries.count('ti:"BROKEN" and au:"A"') == 2  # retried like a WorldcatRequestError
+    assert brief_bibs["1"]["numberOfRecords"] == 1  # the worker carried on
+
+
+def test_cluster_member_gets_error(tmp_path, monkeypatch):
+    from bookops_worldcat.errors import WorldcatRequestError
+
+    monkeypatch.chdir(tmp_path)
+
+    class DownSession(FakeSession):
+        async def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            raise WorldcatRequestError("500 Server Error")
+
+    async def run(session):
+        bib_q = asyncio.Queue()
+        await bib_q.put({"0": {"title": "TITLE", "author": "B"}, "1": {"title": "TITLE", "author": "B"}})
+        await bib_q.put(pl.DONE)
+        return await pl.oclc_stage(1, bib_q, session, n_workers=1)
+
+    session = DownSession()
+    brief_bibs = asyncio.run(run(session))
+    assert brief_bibs == {"0": "500 Server Error", "1": "500 Server Error"}  # "1" waited on "0"'s search
+    assert len(set(session.queries)) == 1
+    assert pl.read_checkpoint(pl.checkpoint_path(1, "brief_bibs.jsonl")) == []  # searched again on a rerun
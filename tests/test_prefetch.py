@@ -0,0 +1,40 @@
+import threading
+import time
+
+from src.utils.prefetch import PrefetchCache
+
+
+def test_prefetch_builds_in_background():
+    built = []
+
+    def build(x):
+        time.sleep(0.05)
+        built.append((x, threading.current_thread().name))
+        return x * 2
+
+    cache = PrefetchCache(build, max_size=2)
+    cache.prefetch(1, 1)
+    time.sleep(0.1)
+    assert built[0][1].startswith("prefetch")
+    assert cache.get(1, 1) == 2
+    assert len(built) == 1  # not built again
+
+    cache.prefetch(2, 2)
+    cache.prefetch(3, 3)  # queued behind 2, evicts 1
+    assert 1 not in cache
+    assert cache.get(3, 3) == 6  # built now rather than waiting behind 2
+    assert built[-1] == (3, threading.current_thread().name)
+
+
+def test_prefetch_error_raised_on_get():
+    def build(x):
+        raise ValueError(x)
+
+    cache = PrefetchCache(build)
+    cache.prefetch("a", "a")
+    try:
+        cache.get("a", "a")
+    except ValueError as e:
+        assert str(e) == "a"
+    else:
+        assert False
@@ -0,0 +1,73 @@
+import csv
+
+import fsspec
+import pandas as pd
+from pymarc import MARCReader
+
+from src.data.record_manager import export_cards
+from src.utils.card_store import CardStore
+
+
+def make_cards():
+    return pd.DataFrame(
+        {"simple_id": [1, 2, 3], "selected_match": [None, None, None], "selected_match_ocn": [None, None, None],
+         "derivation_complete": [None, None, None], "shelfmark": ["ORB.1", "ORB.2", "ORB.3"],
+         "lines": [["Title one", "Author"], ["Title two"], ["Title three"]]},
+        index=[10, 11, 12], dtype=object
+    )
+
+
+def test_export_marc_since_last(tmp_path):
+    fs = fsspec.filesystem("file")
+    store, cards = CardStore(fs, str(tmp_path / "edits")), make_cards()
+    store.write(10, {"selected_match": 0, "selected_match_ocn": "ocm123"})
+    store.write(11, {"selected_match": "No match", "selected_match_ocn": "No match"})
+
+    out = str(tmp_path / "batch.mrc")
+    assert export_cards(cards, store, out, since_last=True) == 1
+    with open(out, "rb") as f:
+        records = list(MARCReader(f))
+    assert records[0]["001"].data == "123"
+    assert records[0]["852"]["j"] == "ORB.1"
+    assert records[0]["500"]["a"] == "Title one Author"
+    assert cards.loc[10, "selected_match_ocn"] is None  # base cards left alone
+
+    store.write(12, {"selected_match": 1, "selected_match_ocn": "ocn456"})
+    assert export_cards(cards, store, out, since_last=True) == 1  # card 10 already exported
+    store.write(10, {"shelfmark": "ORB.10"})
+    assert export_cards(cards, store, out, since_last=True) == 1  # edited since
+    assert export_cards(cards, store, out, since_last=True) == 0
+    assert export_cards(cards, store, out) == 2
+
+
+def test_export_csv(tmp_path):
+    fs = fsspec.filesystem("file")
+    store = CardStore(fs, str(tmp_path / "edits"))
+    store.write(10, {"selected_match": 0, "selected_match_ocn": "on99", "derivation_complete": True})
+    store.write(12, {"selected_match": 1, "selected_match_ocn": "ocn456"})
+
+    out = str(tmp_path / "batch.csv")
+    assert export_cards(make_cards(), store, out, fmt="csv", derivation=False) == 1
+    with open(out, encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert rows == [
+        {"card_id": "3", "oclc_number": "456", "shelfmark": "ORB.3", "ocr_text": "Title three", "derivation_complete": "False"}
+    ]
+
+
+def test_export_without_shelfmark(tmp_path):
+    fs = fsspec.filesystem("file")
+    store, cards = CardStore(fs, str(tmp_path / "edits")), make_cards()
+    cards.loc[10, "shelfmark"], cards.loc[12, "shelfmark"] = None, float("nan")
+    store.write(10, {"selected_match": 0, "selected_match_ocn": "ocm123"})
+    store.write(12, {"selected_match": 1, "selected_match_ocn": "ocn456"})
+
+    out = str(tmp_path / "batch.mrc")
+    assert export_cards(cards, store, out) == 2
+    with open(out, "rb") as f:
+        assert [record.get_fields("852") for record in MARCReader(f)] == [[], []]
+
+    out = str(tmp_path / "batch.csv")
+    export_cards(cards, store, out, fmt="csv")
+    with open(out, encoding="utf-8", newline="") as f:
+        assert [row["shelfmark"] for row in csv.DictReader(f)] == ["", ""]
@@ -0,0 +1,64 @@
+import pickle
+import time
+
+import fsspec
+
+from src.utils.result_sink import ResultReader, ResultSink, sink_root
+
+
+def test_sink_root():
+    assert sink_root("cac-bucket/chinese_matches.p") == "cac-bucket/chinese_matches_results"
+
+
+def test_stream_results(tmp_path):
+    fs, root = fsspec.filesystem("file"), str(tmp_path / "matches_results")
+    sink = ResultSink(fs, root, flush_rows=2, flush_seconds=60)
+    reader = ResultReader(fs, root, poll_seconds=0)
+    assert len(reader.refresh()) == 0
+
+    for work in ["a", "b", "c"]:
+        sink.add({"work": work})
+    cards = reader.refresh()
+    assert cards["work"].tolist() == ["a", "b"]  # c is waiting for a full part
+    assert cards["simple_id"].tolist() == [1, 2]
+
+    sink.flush()
+    sink = ResultSink(fs, root, flush_rows=2, flush_seconds=0)  # a resumed fetch carries on after c
+    sink.add({"work": "d"})  # flushed straight away
+    fs.pipe_file(f"{root}/parts/00000009_1.p", pickle.dumps([{"work": "z"}]))  # after a gap, not read
+    cards = reader.refresh()
+    assert cards["work"].tolist() == ["a", "b", "c", "d"]
+    assert cards.index.tolist() == [0, 1, 2, 3] and cards["simple_id"].tolist() == [1, 2, 3, 4]
+    assert not reader.complete
+
+    sink.close()
+    reader.refresh()
+    assert reader.complete
+    sink.add({"work": "e"})
+    assert len(reader.refresh()) == 4  # no more polling once the fetch is complete
+
+
+def test_flush_timer(tmp_path):
+    fs, root = fsspec.filesystem("file"), str(tmp_path / "matches_results")
+    sink = ResultSink(fs, root, flush_rows=10, flush_seconds=0.1)
+    reader = ResultReader(fs, root, poll_seconds=0)
+    sink.add({"work": "a"})
+    assert len(reader.refresh()) == 0
+    time.sleep(0.3)  # no more cards arrive, the part is written anyway
+    assert reader.refresh()["work"].tolist() == ["a"]
+
+
+def test_resumed_after_complete(tmp_path):
+    fs, root = fsspec.filesystem("file"), str(tmp_path / "matches_results")
+    sink = ResultSink(fs, root, flush_seconds=0)
+    reader = ResultReader(fs, root, poll_seconds=0, complete_poll_seconds=0.1)
+    sink.add({"work": "a"})
+    sink.close()
+    assert len(reader.refresh()) == 1 and reader.complete
+
+    sink = ResultSink(fs, root, flush_seconds=0)  # resuming removes the complete marker
+    sink.add({"work": "b"})
+    assert len(reader.refresh()) == 1  # polled slowly once complete
+    time.sleep(0.15)
+    assert reader.refresh()["work"].tolist() == ["a", "b"]
+    assert not reader.complete
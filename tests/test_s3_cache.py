@@ -0,0 +1,61 @@
+import os
+
+import fsspec
+import pytest
+
+from src.utils.s3_cache import cached_path
+
+
+def test_cached_path_local(tmp_path):
+    fs = fsspec.filesystem("file")
+    src = str(tmp_path / "cards.p")
+    fs.pipe_file(src, b"x" * 100)
+    cache_dir = str(tmp_path / "cache")
+
+    local = cached_path(fs, src, cache_dir=cache_dir, part_size=30)
+    assert open(local, "rb").read() == b"x" * 100
+    mtime = os.path.getmtime(local)
+    assert cached_path(fs, src, cache_dir=cache_dir, part_size=30) == local
+    assert os.path.getmtime(local) == mtime  # unchanged so not downloaded again
+
+    fs.pipe_file(src, b"y" * 50)
+    assert open(cached_path(fs, src, cache_dir=cache_dir, part_size=30), "rb").read() == b"y" * 50
+
+
+@pytest.fixture()
+def s3(monkeypatch):
+    pytest.importorskip("moto")
+    s3fs = pytest.importorskip("s3fs")
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    fs = s3fs.S3FileSystem(endpoint_url=f"http://{host}:{port}")
+    fs.mkdir("cac-bucket")
+    yield fs
+    server.stop()
+
+
+def test_cached_path_s3(s3, tmp_path):
+    data = os.urandom(1000)
+    s3.pipe_file("cac-bucket/cards.p", data)
+    cache_dir = str(tmp_path / "cache")
+
+    downloads = []
+    cat_file = s3.cat_file
+    s3.cat_file = lambda *args, **kwargs: downloads.append(kwargs) or cat_file(*args, **kwargs)
+
+    local = cached_path(s3, "cac-bucket/cards.p", cache_dir=cache_dir, part_size=300, n_workers=4)
+    assert open(local, "rb").read() == data
+    assert sorted(x["start"] for x in downloads) == [0, 300, 600, 900]
+
+    downloads.clear()
+    assert cached_path(s3, "cac-bucket/cards.p", cache_dir=cache_dir, part_size=300) == local
+    assert downloads == []  # ETag unchanged
+
+    s3.pipe_file("cac-bucket/cards.p", data[:500])
+    assert open(cached_path(s3, "cac-bucket/cards.p", cache_dir=cache_dir, part_size=300), "rb").read() == data[:500]
@@ -0,0 +1,47 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+import src.utils.streamlit_utils as su
+
+# Only needed once a card is shown or data is read from S3, not at import
+LAZY_MODULES = ["matplotlib", "st_aggrid", "s3fs", "PIL"]
+# Seconds to import the app's modules in a fresh interpreter, ~0.8s when measured locally with streamlit and pandas
+IMPORT_BUDGET = 3.0
+
+IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import cfg
+import src.utils.streamlit_utils
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "loaded": [m for m in {LAZY_MODULES} if m in sys.modules],
+    "lang_dict_loaded": cfg.load_lang_dict.cache_info().currsize > 0
+}}))
+"""
+
+
+@pytest.fixture(scope="module")
+def cold_import():
+    out = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_heavy_modules_lazy(cold_import):
+    assert cold_import["loaded"] == []
+    assert not cold_import["lang_dict_loaded"]
+
+
+def test_import_budget(cold_import):
+    assert cold_import["seconds"] < IMPORT_BUDGET
+
+
+def test_palette_matches_matplotlib():
+    colormaps = pytest.importorskip("matplotlib").colormaps
+    for val in [0.0, 0.03, 0.25, 0.5, 0.51, 0.99, 1.0, 1.06]:
+        r, g, b, _ = colormaps["Blues"](min(val, 1.0), bytes=True)
+        assert su.to_hex_colour(val) == f"#{r:02x}{g:02x}{b:02x}"
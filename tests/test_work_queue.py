@@ -0,0 +1,78 @@
+from src.utils.work_queue import LeaseQueue
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_next_card_never_collides():
+    queue = LeaseQueue(range(5), lease_seconds=60, clock=FakeClock())
+    cards = [queue.next_card(f"reviewer-{i}") for i in range(5)]
+    assert cards == [0, 1, 2, 3, 4]
+    assert queue.next_card("reviewer-5") is None
+    assert queue.holder(2) == "reviewer-2"
+
+    queue.complete(0)
+    assert queue.next_card("reviewer-0") is None
+    assert queue.holder(0) is None
+
+
+def test_moving_on_requeues_card():
+    queue = LeaseQueue(range(3), clock=FakeClock())
+    assert queue.next_card("a") == 0
+    assert queue.next_card("a") == 1  # unfinished card goes to the back of the queue
+    assert queue.next_card("b") == 2
+    assert queue.next_card("c") == 0
+
+
+def test_lease_expiry_and_renew():
+    clock = FakeClock()
+    queue = LeaseQueue(range(3), lease_seconds=60, clock=clock)
+    assert queue.next_card("a") == 0
+    assert queue.next_card("b") == 1
+
+    clock.now = 50
+    assert queue.renew("a") == 0
+    clock.now = 70  # b's lease has expired, a's was renewed
+    assert queue.holder(1) is None
+    assert set(queue.active_leases()) == {0}
+    assert queue.next_card("c") == 1  # abandoned cards are handed out first
+    assert queue.renew("b") is None
+
+
+def test_skip_and_requeue():
+    queue = LeaseQueue(range(4), clock=FakeClock())
+    matched = {0, 1}
+    assert queue.next_card("a", skip=lambda x: x in matched) == 2
+
+    queue.complete(2)
+    queue.requeue(2)  # match cleared
+    assert queue.next_card("b") == 3
+    assert queue.next_card("c") == 2
+
+    queue = LeaseQueue(range(3), clock=FakeClock())
+    queue.complete(1)
+    queue.requeue(1)
+    queue.requeue(1)  # still queued, not added again
+    assert len(queue) == 3
+    assert queue.peek(3) == [0, 1, 2]
+
+
+def test_peek():
+    queue = LeaseQueue(range(4), clock=FakeClock())
+    queue.next_card("a")
+    queue.complete(1)
+    assert queue.peek(2) == [2, 3]
+    assert queue.next_card("b") == 2
+
+
+def test_extend():
+    queue = LeaseQueue([0, 1], clock=FakeClock())
+    assert queue.next_card("a") == 0
+    queue.complete(0)
+    queue.extend([0, 1, 2, 3])  # only cards the queue hasn't seen are added
+    assert queue.peek(5) == [1, 2, 3]
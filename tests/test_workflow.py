@@ -0,0 +1,222 @@
+import asyncio
+import pickle
+import time
+
+import pytest
+
+import src.data.accession_workflow as aw
+
+
+def test_parse_pages():
+    assert aw.parse_pages("all") is None
+    assert aw.parse_pages("1,3-5, 8") == {1, 3, 4, 5, 8}
+
+
+def test_run_recognition_jobs(monkeypatch):
+    job_lengths = {1: 0.02, 2: 0.2}  # doc_id: seconds until the job finishes
+    started, downloaded = {}, {}
+
+    def run_text_recognition(session, collection_id, doc_id, model_id, pages="all"):
+        started[doc_id] = time.perf_counter()
+        return {"jobId": doc_id}
+
+    def check_job_status(session, collection_id, job_id):
+        done = time.perf_counter() - started[job_id] > job_lengths[job_id]
+        return {"state": "FINISHED" if done else "RUNNING", "progress": 50}
+
+    def download_document(session, collection_id, doc_id, pages="all"):
+        downloaded[doc_id] = time.perf_counter()
+
+    monkeypatch.setattr(aw, "run_text_recognition", run_text_recognition)
+    monkeypatch.setattr(aw, "check_job_status", check_job_status)
+    monkeypatch.setattr(aw, "download_document", download_document)
+
+    results = asyncio.run(aw.run_recognition_jobs(
+        None, 1, [1, (2, "1-4")], model_id=1, min_interval=0.01, max_interval=0.05
+    ))
+    assert [r["state"] for r in results] == ["FINISHED", "FINISHED"]
+    assert results[1]["pages"] == "1-4"
+    assert downloaded[1] < started[2] + job_lengths[2]  # fast job downloaded before the slow one finished
+
+
+def test_poll_job_gives_up(monkeypatch):
+    statuses = []
+    monkeypatch.setattr(aw, "check_job_status", lambda session, collection_id, job_id: statuses.pop(0))
+
+    statuses[:] = [None, {"state": "RUNNING"}, None, None, {"state": "FINISHED"}]
+    assert asyncio.run(aw.poll_job(None, 1, 1, min_interval=0.01, max_errors=3))["state"] == "FINISHED"
+
+    statuses[:] = [None, None, None]
+    with pytest.raises(RuntimeError):
+        asyncio.run(aw.poll_job(None, 1, 1, min_interval=0.01, max_errors=3))
+
+    statuses[:] = [{"state": "RUNNING", "progress": 10}] * 100
+    with pytest.raises(TimeoutError):
+        asyncio.run(aw.poll_job(None, 1, 1, min_interval=0.01, max_interval=0.01, timeout=0.1))
+    assert len(statuses) > 80  # gave up without polling until the statuses ran out
+
+
+def test_transkribus_session_token(monkeypatch):
+    class FakeResponse:
+        def __init__(self, status_code, data=None):
+            self.status_code = status_code
+            self.data = data
+
+        def json(self):
+            return self.data
+
+        def raise_for_status(self):
+            pass
+
+    logins = []
+
+    def authorise(refresh_token=None):
+        logins.append(refresh_token)
+        n = len(logins)
+        return FakeResponse(200, {"access_token": f"a{n}", "expires_in": 300, "refresh_token": f"r{n}", "refresh_expires_in": 1800})
+
+    sent = []
+
+    def request(self, method, url, *args, headers=None, **kwargs):
+        sent.append(headers["Authorization"])
+        return FakeResponse(401 if len(sent) == 2 else 200)
+
+    monkeypatch.setattr(aw, "authorise", authorise)
+    monkeypatch.setattr(aw.requests.Session, "request", request)
+
+    session = aw.TranskribusSession(refresh_margin=60)
+    session.get("https://transkribus.eu/TrpServer/rest/jobs/1")
+    session.get("https://transkribus.eu/TrpServer/rest/jobs/1")  # 401, refreshed and retried
+    assert sent == ["Bearer a1", "Bearer a1", "Bearer a2"]
+    assert logins == [None, "r1"]
+
+    session._expires_at = time.monotonic() + 30  # inside the refresh margin
+    session.get("https://transkribus.eu/TrpServer/rest/jobs/1")
+    assert sent[-1] == "Bearer a3"
+    assert logins == [None, "r1", "r2"]
+
+
+def test_queue_oclc_searches_unsearchable():
+    class FakeResponse:
+        def __init__(self, data):
+            self.data = data
+
+        def json(self):
+            return self.data
+
+    class FakeSession:
+        def __init__(self):
+            self.queries = []
+
+        async def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            return FakeResponse({"numberOfRecords": 0})
+
+    async def run(session, brief_bibs, on_result):
+        queue = asyncio.PriorityQueue()
+        bib_info = {"0": {}, "1": {"ISBN": "9780140449136"}, "2": {"title": "A"}}
+        n_queued = await aw.queue_oclc_searches(bib_info, queue, session, brief_bibs, on_result=on_result)
+        return n_queued, [queue.get_nowait().idx for _ in range(queue.qsize())]
+
+    session, brief_bibs, results = FakeSession(), {}, {}
+    n_queued, queued = asyncio.run(run(session, brief_bibs, results.__setitem__))
+    assert n_queued == 1 and queued == ["2"]
+    assert brief_bibs["0"] == aw.NO_SEARCH_FIELDS
+    assert brief_bibs["1"]["numberOfRecords"] == 0
+    assert set(results) == {"1"}  # the batch's empty result is a real result
+    assert session.queries == ["bn:9780140449136"]
+
+
+def test_oclc_record_fetch_sink(tmp_path, monkeypatch):
+    import fsspec
+    from pymarc import Field, Record, record_to_xml
+    from src.utils.result_sink import ResultReader, ResultSink
+
+    fs, root = fsspec.filesystem("file"), str(tmp_path / "matches_results")
+    reader = ResultReader(fs, root, poll_seconds=0)
+
+    class FakeResponse:
+        def __init__(self, data=None, text=None):
+            self.data, self.text = data, text
+
+        def json(self):
+            return self.data
+
+    class FakeSession:
+        def __init__(self):
+            self.cards_before_slow_search = None
+            self.queries = []
+
+        async def brief_bibs_search(self, q, **kwargs):
+            self.queries.append(q)
+            if "SLOW" in q:
+                await asyncio.sleep(0.2)
+                self.cards_before_slow_search = len(reader.refresh())
+            if "NOTHING" in q:
+                return FakeResponse({"numberOfRecords": 0})
+            ocn = "1" if q.startswith("bn:") else "2"
+            return FakeResponse({"numberOfRecords": 1, "briefRecords": [{"oclcNumber": ocn, "isbns": ["9780140449136"]}]})
+
+        async def bib_get(self, oclc_num):
+            record = Record()
+            record.add_field(Field(tag="001", data=f"ocm{oclc_num}"))
+            return FakeResponse(text=record_to_xml(record, namespace=True).decode("utf-8"))
+
+    session = FakeSession()
+
+    class FakeAsyncSession:
+        def __init__(self, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return session
+
+        async def __aexit__(self, *exc):
+            return False
+
+    monkeypatch.setattr(aw.bw, "AsyncMetadataSession", FakeAsyncSession)
+    bib_info = {
+        "0": {"title": "A", "ISBN": "9780140449136"}, "1": {"title": "A", "ISBN": "9780140449136"},
+        "2": {"title": "SLOW", "author": "X"}
+    }
+    sink = ResultSink(fs, root, flush_rows=1)
+    asyncio.run(aw.oclc_record_fetch(bib_info, str(tmp_path / "brief_bibs.p"), token="token", sink=sink))
+
+    assert session.cards_before_slow_search == 2  # both copies reviewable before the last search finished
+    cards = reader.refresh()
+    assert reader.complete
+    assert cards["work"].tolist() == ["0", "1", "2"]
+    assert [x[0]["001"].data for x in cards["worldcat_matches"]] == ["ocm1", "ocm1", "ocm2"]
+
+    # resuming, e.g. after a crash, doesn't search or add the stored works again
+    session.queries = []
+    sink = ResultSink(fs, root, flush_rows=1)
+    bib_info["3"], bib_info["N"] = {"title": "B", "author": "Y"}, {"title": "NOTHING", "author": "Y"}
+    asyncio.run(aw.oclc_record_fetch(bib_info, str(tmp_path / "brief_bibs.p"), token="token", sink=sink))
+    assert sorted(session.queries) == ['ti:"B" and au:"Y"', 'ti:"NOTHING" and au:"Y"']
+    cards = ResultReader(fs, root, poll_seconds=0).refresh().set_index("work")
+    assert sorted(cards.index) == ["0", "1", "2", "3", "N"]
+    assert cards.loc["N", "worldcat_matches"] is None  # stored without results, not shown for review
+    assert set(pickle.load(open(tmp_path / "brief_bibs.p", "rb"))) == {"0", "1", "2", "3", "N"}
+
+    session.queries = []
+    asyncio.run(aw.oclc_record_fetch(bib_info, str(tmp_path / "brief_bibs.p"), token="token", sink=ResultSink(fs, root)))
+    assert session.queries == []  # the card without results isn't searched again
+
+    # a failed fetch still shuts down the parser's process pool
+    closed = []
+
+    class Parser(aw.MarcXmlParser):
+        def close(self):
+            closed.append(True)
+            super().close()
+
+    class BrokenSink(ResultSink):
+        def close(self, complete=True):
+            raise OSError("bucket unavailable")
+
+    monkeypatch.setattr(aw, "MarcXmlParser", Parser)
+    bib_info["4"] = {"title": "C", "author": "Z"}
+    with pytest.raises(OSError):
+        asyncio.run(aw.oclc_record_fetch(bib_info, str(tmp_path / "brief_bibs.p"), token="token", sink=BrokenSink(fs, root)))
+    assert closed == [True]
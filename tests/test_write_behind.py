@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+import fsspec
+import pandas as pd
+
+from src.utils.card_store import CardStore, compact
+from src.utils.write_behind import WriteBehind
+
+
+def make_cards():
+    return pd.DataFrame(
+        {"selected_match": [None, None], "selected_match_ocn": [None, None], "derivation_complete": [None, None],
+         "shelfmark": ["ORB.1", "ORB.2"]},
+        index=[10, 11], dtype=object
+    )
+
+
+def wait_for(writer, timeout=5):
+    t0 = time.monotonic()
+    while writer.status() != "saved" and time.monotonic() - t0 < timeout:
+        time.sleep(0.02)
+    return writer.status()
+
+
+def test_coalesced_flush(tmp_path):
+    fs = fsspec.filesystem("file")
+    store = CardStore(fs, str(tmp_path / "edits"))
+    writer = WriteBehind(store, journal_dir=str(tmp_path / "journal"), delay=0.1)
+    writer.submit(10, {"selected_match": 0, "selected_match_ocn": "ocm1"})
+    writer.submit(10, {"shelfmark": "ORB.10"})
+    writer.submit(10, {"derivation_complete": True})
+    assert writer.status() == "saving"
+    assert writer.apply(make_cards()).loc[10, "shelfmark"] == "ORB.10"  # shown before it's written
+
+    assert wait_for(writer) == "saved"
+    assert store.version(10) == 1  # three edits, one version
+    assert os.listdir(writer.journal_dir) == []
+    saved = compact(CardStore(fs, str(tmp_path / "edits")), make_cards())
+    assert saved.loc[10, ["selected_match_ocn", "shelfmark", "derivation_complete"]].tolist() == ["ocm1", "ORB.10", True]
+    writer.close()
+
+
+def test_conflict_reported(tmp_path):
+    fs = fsspec.filesystem("file")
+    root = str(tmp_path / "edits")
+    writer = WriteBehind(CardStore(fs, root), journal_dir=str(tmp_path / "journal"), delay=0.05)
+    CardStore(fs, root).write(11, {"shelfmark": "ORB.22"})  # another session
+    writer.submit(11, {"shelfmark": "ORB.99"})
+    wait_for(writer)
+    assert [e.record["shelfmark"] for e in writer.pop_conflicts()] == ["ORB.22"]
+    assert writer.apply(make_cards()).loc[11, "shelfmark"] == "ORB.22"
+    writer.close()
+
+
+def test_crashed_journal_recovered(tmp_path):
+    fs = fsspec.filesystem("file")
+    root, journal_dir = str(tmp_path / "edits"), str(tmp_path / "journal")
+    crashed = WriteBehind(CardStore(fs, root), journal_dir=journal_dir, delay=60)
+    crashed.closed = True  # the thread never flushes
+    crashed.submit(10, {"selected_match_ocn": "ocm5"})
+    old = time.time() - 120
+    os.utime(crashed.journal_path, (old, old))
+    with open(crashed.journal_path) as f:
+        assert json.loads(f.readline())["fields"] == {"selected_match_ocn": "ocm5"}
+
+    writer = WriteBehind(CardStore(fs, root), journal_dir=journal_dir, delay=0.05, orphan_seconds=60)
+    assert wait_for(writer) == "saved"
+    assert compact(CardStore(fs, root), make_cards()).loc[10, "selected_match_ocn"] == "ocm5"
+    assert os.listdir(writer.journal_dir) == []
+    writer.close()
+
+
+def test_idle_thread_ends(tmp_path):
+    fs = fsspec.filesystem("file")
+    store = CardStore(fs, str(tmp_path / "edits"))
+    writer = WriteBehind(store, journal_dir=str(tmp_path / "journal"), delay=0.05, idle_seconds=0.2)
+    thread = writer.thread
+    thread.join(timeout=5)
+    assert not thread.is_alive() and writer.thread is None
+
+    writer.submit(10, {"shelfmark": "ORB.10"})  # restarts the thread
+    assert writer.thread is not None
+    assert wait_for(writer) == "saved"
+    assert store.version(10) == 1
+    writer.close()
@@ -16,3 +16,32 @@ def test_extract_labelled_xml():
     assert record["title"] == ["KAUL-I-TAIYIB"]
     assert record["author"] == ["BARNI (Muhammad Ilyas), Maulana, M.A., LL.B."]
     assert record["shelfmark"] == ["14115. e. 72"]
+
+
+def test_extract_labelled_xml_namespace_detection():
+    record = xmle.extract_labelled_xml("tests/0001_24567971014.xml")
+    assert record["title"] == ["KAUL-I-TAIYIB"]
+    assert record["shelfmark"] == ["14115. e. 72"]
+
+
+def test_extract_multi_line_title(tmp_path):
+    xml = f"""<PcGts xmlns="{ns[1:-1]}"><Page>
+    <TextRegion custom="readingOrder {{index:0;}} structure {{type:title;}}">
+        <TextLine><TextEquiv><Unicode>A TALE OF</Unicode></TextEquiv></TextLine>
+        <TextLine><TextEquiv><Unicode>TWO CITIES</Unicode></TextEquiv></TextLine>
+    </TextRegion>
+    <TextRegion custom="readingOrder {{index:1;}}">
+        <TextLine><TextEquiv><Unicode>untagged</Unicode></TextEquiv></TextLine>
+    </TextRegion>
+    </Page></PcGts>"""
+    xml_path = tmp_path / "card.xml"
+    xml_path.write_text(xml)
+    record = xmle.extract_labelled_xml(xml_path)
+    assert record["title"] == ["A TALE OF TWO CITIES"]
+    assert record["author"] == []
+
+
+def test_extract_labelled_xml_dir():
+    cards_df = xmle.extract_labelled_xml_dir("tests", pattern="0001_*.xml", n_workers=1)
+    assert cards_df.shape == (1, 4)
+    assert cards_df.loc[0, "author"] == ["BARNI (Muhammad Ilyas), Maulana, M.A., LL.B."]